@@ -0,0 +1,92 @@
+# Time how long wait_for_jobs_to_finish takes to notice that the last job of a stage is done,
+# using the fake qsub/qstat from fake_pbs.py instead of a real PBS server.
+#
+#   python benchmarks/bench_job_tracking.py --jobs 16
+#   python benchmarks/bench_job_tracking.py --jobs 16 --legacy    (fixed 60 s polling, no sentinels)
+
+import argparse
+import logging
+import os
+import random
+import subprocess
+import sys
+import tempfile
+import time
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+from dragon_breath import sentinel_file_path, wait_for_jobs_to_finish
+
+FAKE_PBS = os.path.join(os.path.dirname(os.path.abspath(__file__)), 'fake_pbs.py')
+
+
+def install_fake_pbs(bin_dir):
+    """
+    Put qsub, qstat and qdel shims pointing at fake_pbs.py in front of PATH.
+    """
+    os.makedirs(bin_dir, exist_ok=True)
+    for command in ('qsub', 'qstat', 'qdel'):
+        shim = os.path.join(bin_dir, command)
+        with open(shim, 'w') as file:
+            file.write(f'#!/bin/sh\nexec {sys.executable} {FAKE_PBS} {command} "$@"\n')
+        os.chmod(shim, 0o755)
+    os.environ['PATH'] = bin_dir + os.pathsep + os.environ['PATH']
+
+
+def submit_sleep_job(subband, duration, prefix, with_sentinel):
+    os.makedirs(subband, exist_ok=True)
+    trap = f"trap 'echo $? > {sentinel_file_path(subband, subband, prefix)}' EXIT" if with_sentinel else ""
+    pbs_script_file = f"{prefix}_{subband}.pbs"
+    with open(pbs_script_file, 'w') as file:
+        file.write(f"""#!/bin/bash
+#PBS -N {prefix}_{subband}
+#PBS -o {subband}/{prefix}_{subband}.log
+
+cd {os.getcwd()}
+{trap}
+sleep {duration}
+echo finished
+""")
+    result = subprocess.run(f"qsub {pbs_script_file}", shell=True, stdout=subprocess.PIPE, check=True)
+    return result.stdout.decode().strip(), subband
+
+
+def main():
+    parser = argparse.ArgumentParser()
+    parser.add_argument('--jobs', type=int, default=8)
+    parser.add_argument('--min-duration', type=float, default=2.0)
+    parser.add_argument('--max-duration', type=float, default=10.0)
+    parser.add_argument('--legacy', action='store_true', help='poll every 60 s without sentinels, like the old loop')
+    args = parser.parse_args()
+
+    logger = logging.getLogger('bench_job_tracking')
+    logging.basicConfig(level=logging.WARNING)
+
+    work_dir = tempfile.mkdtemp(prefix='bench_job_tracking_')
+    spool_dir = os.path.join(work_dir, 'spool')
+    os.environ['FAKE_PBS_SPOOL'] = spool_dir
+    os.makedirs(spool_dir)
+    install_fake_pbs(os.path.join(work_dir, 'bin'))
+    os.chdir(work_dir)
+
+    prefix = 'bench'
+    job_info = [submit_sleep_job(f"spw{i}", round(random.uniform(args.min_duration, args.max_duration), 2), prefix, not args.legacy)
+                for i in range(args.jobs)]
+
+    if args.legacy:
+        all_successful, failed_jobs = wait_for_jobs_to_finish(job_info, work_dir, logger, prefix, min_interval=60, max_interval=60)
+    else:
+        all_successful, failed_jobs = wait_for_jobs_to_finish(job_info, work_dir, logger, prefix)
+    returned = time.time()
+
+    last_exit = max(os.path.getmtime(os.path.join(spool_dir, f)) for f in os.listdir(spool_dir) if f.endswith('.exit'))
+    with open(os.path.join(spool_dir, 'qstat.calls')) as file:
+        qstat_calls = len(file.readlines())
+
+    print(f"jobs: {args.jobs}  successful: {all_successful}  failed: {failed_jobs}")
+    print(f"latency after last job exit: {returned - last_exit:.2f} s")
+    print(f"qstat invocations: {qstat_calls}")
+
+
+if __name__ == '__main__':
+    main()
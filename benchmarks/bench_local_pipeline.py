@@ -0,0 +1,92 @@
+# Run the per-subband pipeline DAG end to end on this machine with the local executor. Every stage is
+# a stand-in job script that keeps its cores busy for a while instead of running CASA, with the same
+# #PBS resource lines as the real stages, so the scheduling and tracking are what gets timed.
+#
+#   python benchmarks/bench_local_pipeline.py --subbands 8 --cores 16
+
+import argparse
+import logging
+import os
+import random
+import sys
+import tempfile
+import time
+from functools import partial
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+from dragon_breath import sentinel_file_path, clear_sentinel, submit_pbs_script
+from dragon_dance import add_task, run_dag
+from rock_slide import LocalExecutor, use_executor
+
+# (prefix, ppn, dependencies) for the stages of one subband
+STAGES = [
+    ('mstransform', 1, []),
+    ('flag_cal', 6, ['mstransform']),
+    ('flag_src', 6, ['mstransform']),
+    ('apply_cal_cal', 6, ['flag_cal']),
+    ('apply_cal_src', 6, ['flag_cal', 'flag_src']),
+    ('flag_after_cal_cal', 6, ['apply_cal_cal']),
+    ('flag_after_cal_src', 6, ['apply_cal_src']),
+]
+
+
+def stand_in_stage(prefix, subband, ppn, duration, logger, depend=None):
+    """
+    Write a job script that burns ppn cores for duration seconds and submit it.
+    """
+    sentinel_file = sentinel_file_path(subband, subband, prefix)
+    clear_sentinel(sentinel_file, logger)
+    pbs_script_file = f"{prefix}_{subband}.pbs"
+    with open(pbs_script_file, 'w') as file:
+        file.write(f"""#!/bin/bash
+#PBS -N {prefix}_{subband}
+#PBS -l nodes=1:ppn={ppn}
+#PBS -o {subband}/{prefix}_{subband}.log
+
+cd {os.getcwd()}
+trap 'echo $? > {sentinel_file}' EXIT
+for i in $(seq {ppn}); do timeout {duration} sh -c 'while :; do :; done' & done
+wait
+echo finished
+""")
+    return submit_pbs_script(pbs_script_file, subband, logger, depend)
+
+
+def main():
+    parser = argparse.ArgumentParser()
+    parser.add_argument('--subbands', type=int, default=4)
+    parser.add_argument('--cores', type=int, default=os.cpu_count())
+    parser.add_argument('--min-duration', type=float, default=1.0)
+    parser.add_argument('--max-duration', type=float, default=4.0)
+    args = parser.parse_args()
+
+    logger = logging.getLogger('bench_local_pipeline')
+    logging.basicConfig(level=logging.WARNING)
+    use_executor(LocalExecutor(cores=args.cores))
+
+    work_dir = tempfile.mkdtemp(prefix='bench_local_pipeline_')
+    os.chdir(work_dir)
+
+    dag = {}
+    busy = 0.0
+    for i in range(args.subbands):
+        subband = f"spw{i}"
+        os.makedirs(subband)
+        for prefix, ppn, deps in STAGES:
+            duration = round(random.uniform(args.min_duration, args.max_duration), 2)
+            busy += duration * min(ppn, args.cores)
+            add_task(dag, f"{prefix}_{subband}", subband, prefix,
+                     partial(stand_in_stage, prefix, subband, ppn, duration, logger),
+                     [f"{dep}_{subband}" for dep in deps])
+
+    start = time.monotonic()
+    all_successful, failed_tasks = run_dag(dag, work_dir, logger, min_interval=1, max_interval=5)
+    elapsed = time.monotonic() - start
+
+    print(f"subbands: {args.subbands}  cores: {args.cores}  successful: {all_successful} {failed_tasks}")
+    print(f"wall time: {elapsed:.1f} s  core utilisation: {100 * busy / (elapsed * args.cores):.0f} %")
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,59 @@
+# Throughput of the flag_after_cal stage on Multi-MSs against the number of mpicasa processes. Every run
+# works on fresh copies of cal.ms and src.ms (made by the split stage with mms_axis set, and already
+# calibrated), so the flags of one run do not change the next.
+#
+#   python benchmarks/bench_mpi_scaling.py --casa-dir /home/apal/casa-6.6.4-34-py3.8.el8 \
+#       --cal spw0/cal.ms --src spw0/src.ms --ranks 1 3 5 9
+#
+# One process is the client, so -n N gives N - 1 servers; -n 1 runs without mpicasa.
+
+import argparse
+import os
+import re
+import shutil
+import subprocess
+import sys
+import tempfile
+import time
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+from dragon_breath import casa_command, flag_after_cal_script
+from growth import count_visibilities
+
+
+def main():
+    parser = argparse.ArgumentParser()
+    parser.add_argument('--casa-dir', required=True)
+    parser.add_argument('--cal', required=True)
+    parser.add_argument('--src', required=True)
+    parser.add_argument('--ranks', type=int, nargs='+', default=[1, 3, 5, 9])
+    args = parser.parse_args()
+
+    visibilities = count_visibilities(args.cal) + count_visibilities(args.src)
+    work_dir = tempfile.mkdtemp(prefix='bench_mpi_scaling_', dir=os.path.dirname(os.path.abspath(args.src)))
+    script_file = os.path.join(work_dir, 'run_flag_after_cal.py')
+    with open(script_file, 'w') as file:
+        file.write(flag_after_cal_script(os.path.join(work_dir, 'cal.ms'), os.path.join(work_dir, 'src.ms')))
+
+    first = None
+    for ranks in args.ranks:
+        for name, ms in (('cal.ms', args.cal), ('src.ms', args.src)):
+            shutil.rmtree(os.path.join(work_dir, name), ignore_errors=True)
+            shutil.copytree(ms, os.path.join(work_dir, name), symlinks=True)
+
+        start = time.monotonic()
+        result = subprocess.run(casa_command(args.casa_dir, script_file, ranks), shell=True, cwd=work_dir,
+                                stdout=subprocess.PIPE, stderr=subprocess.STDOUT)
+        elapsed = time.monotonic() - start
+        servers = len(set(re.findall(r'MPIServer-(\d+)', result.stdout.decode(errors='replace'))))
+        first = first or elapsed
+
+        print(f"-n {ranks:<3} exit {result.returncode}  {elapsed:8.1f} s  {visibilities / elapsed / 1e6:8.2f} Mvis/s  "
+              f"servers used {servers}/{max(0, ranks - 1)}  speed-up over the first run {first / elapsed:5.2f}")
+
+    shutil.rmtree(work_dir)
+
+
+if __name__ == '__main__':
+    main()
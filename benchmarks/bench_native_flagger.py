@@ -0,0 +1,98 @@
+# The native flagger (slash.py) against flagdata on a synthetic MS with known RFI: the rflag passes of
+# flag_after_cal (all uvrange bins, 2min and 1min) and the tfcrop run of flag_src, each on its own copy
+# of the MS. Prints the time, the flagged fraction, how much of the planted RFI was found and how much
+# clean data was lost. Needs python-casacore; flagdata is only run when casatasks can be imported.
+#
+#   python benchmarks/bench_native_flagger.py --nant 30 --nchan 512 --times 60 --workers 8
+
+import argparse
+import importlib.util
+import os
+import shutil
+import sys
+import tempfile
+import time
+
+import numpy as np
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+from dragon_breath import RFLAG_AFTER_CAL, RFLAG_AFTER_CAL_PASSES, TFCROP, flag_command
+from slash import flag_ms
+from surf import make_synthetic_ms
+
+RFI_CHANNELS = (40, 41, 100, 250)
+
+
+def read_flags(ms_name):
+    from casacore.tables import table
+    with table(ms_name, ack=False) as tb:
+        return tb.getcol('FLAG'), tb.getcol('ANTENNA1') != tb.getcol('ANTENNA2')
+
+
+def score(label, ms_name, seconds, truth):
+    flags, cross = read_flags(ms_name)
+    flags, truth = flags[cross], truth[cross]
+    print(f"{label:<22} {seconds:8.2f} s   flagged {100 * flags.mean():6.2f}%   "
+          f"RFI found {100 * (flags & truth).sum() / max(truth.sum(), 1):6.2f}%   "
+          f"clean data lost {100 * (flags & ~truth).sum() / max((~truth).sum(), 1):6.2f}%")
+    return flags
+
+
+def run_casa(ms_name, passes):
+    from casatasks import flagdata
+    flagdata(vis=ms_name, mode='list', inpfile=[flag_command(params) for params in passes],
+             action='apply', flagbackup=False)
+
+
+def main():
+    parser = argparse.ArgumentParser()
+    parser.add_argument('--nant', type=int, default=30)
+    parser.add_argument('--nchan', type=int, default=512)
+    parser.add_argument('--scans', type=int, default=2)
+    parser.add_argument('--times', type=int, default=30, help="time steps per scan")
+    parser.add_argument('--workers', type=int, default=None)
+    args = parser.parse_args()
+
+    rflag = [dict(RFLAG_AFTER_CAL, datacolumn='data', ntime=ntime, uvrange=uvrange)
+             for ms, ntime, uvrange in RFLAG_AFTER_CAL_PASSES if ms == 'src']
+    runs = [('rflag passes', rflag), ('tfcrop', [TFCROP])]
+    rfi_times = (5, args.times + 12)
+
+    work_dir = tempfile.mkdtemp(prefix='bench_native_flagger_')
+    try:
+        clean_ms = os.path.join(work_dir, 'synthetic.ms')
+        make_synthetic_ms(clean_ms, nant=args.nant, nchan=args.nchan, nscan=args.scans, times_per_scan=args.times,
+                          rfi_channels=RFI_CHANNELS, rfi_times=rfi_times)
+        from casacore.tables import table
+        with table(clean_ms, ack=False) as tb:
+            nrow_per_step = len(np.unique(tb.getcol('ANTENNA1') * args.nant + tb.getcol('ANTENNA2')))
+        truth = np.zeros((args.scans * args.times * nrow_per_step, args.nchan, 2), dtype=bool)
+        truth[:, list(RFI_CHANNELS)] = True
+        for step in rfi_times:
+            truth[step * nrow_per_step:(step + 1) * nrow_per_step] = True
+
+        for label, passes in runs:
+            ms_name = os.path.join(work_dir, 'native.ms')
+            shutil.copytree(clean_ms, ms_name)
+            start = time.monotonic()
+            flag_ms(ms_name, passes, workers=args.workers)
+            native = score(f"native {label}", ms_name, time.monotonic() - start, truth)
+            shutil.rmtree(ms_name)
+
+            if importlib.util.find_spec('casatasks') is None:
+                print(f"{'flagdata ' + label:<22} skipped, casatasks cannot be imported")
+                continue
+            ms_name = os.path.join(work_dir, 'casa.ms')
+            shutil.copytree(clean_ms, ms_name)
+            start = time.monotonic()
+            run_casa(ms_name, passes)
+            casa = score(f"flagdata {label}", ms_name, time.monotonic() - start, truth)
+            shutil.rmtree(ms_name)
+            print(f"{'':<22} the two agree on {100 * (native == casa).mean():.2f}% of the data")
+    finally:
+        shutil.rmtree(work_dir)
+
+
+if __name__ == '__main__':
+    main()
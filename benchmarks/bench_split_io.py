@@ -0,0 +1,78 @@
+# Count the bytes the split stage reads, old way (two mstransforms per subband) against the
+# per-subband single read and the single sweep over the band. Run it inside CASA so the tasks
+# run in this process and show up in /proc/self/io:
+#
+#   casa --nologger --nogui -c benchmarks/bench_split_io.py rcs.ms 1634+627,3C286 RXCS
+#
+# rchar counts every byte handed to read(), cached or not, read_bytes only what came from disk.
+
+import os
+import shutil
+import sys
+import tempfile
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+from dragon_breath import split_band_script, subbanding_script
+
+SUBBANDS = {
+    "spw0": "0:124~573",
+    "spw1": "0:574~1023",
+    "spw2": "0:1024~1473",
+    "spw3": "0:1474~1923"
+}
+
+
+def read_io():
+    counters = {}
+    with open('/proc/self/io', 'r') as file:
+        for line in file:
+            key, value = line.split(':')
+            counters[key] = int(value)
+    return counters
+
+
+def legacy_script(ms_name, spw, output_dir, cal_name, src_name):
+    return f"""mstransform(vis='{ms_name}', spw='{spw}', outputvis='{output_dir}/cal.ms', field='{cal_name}', datacolumn='DATA')
+mstransform(vis='{ms_name}', spw='{spw}', outputvis='{output_dir}/src.ms', field='{src_name}', datacolumn='DATA')
+"""
+
+
+def measure(label, scripts, work_dir):
+    for subband in SUBBANDS:
+        os.makedirs(os.path.join(work_dir, subband), exist_ok=True)
+    os.makedirs(os.path.join(work_dir, 'band'), exist_ok=True)
+
+    before = read_io()
+    cwd = os.getcwd()
+    os.chdir(work_dir)
+    try:
+        for script in scripts:
+            exec(script, globals())
+    finally:
+        os.chdir(cwd)
+    after = read_io()
+
+    for subband in SUBBANDS:
+        shutil.rmtree(os.path.join(work_dir, subband))
+    rchar = after['rchar'] - before['rchar']
+    read_bytes = after['read_bytes'] - before['read_bytes']
+    print(f"{label:<24} rchar {rchar / 1e9:10.3f} GB   read_bytes {read_bytes / 1e9:10.3f} GB")
+    return rchar
+
+
+def main():
+    ms_name, cal_name, src_name = os.path.abspath(sys.argv[-3]), sys.argv[-2], sys.argv[-1]
+    work_dir = tempfile.mkdtemp(prefix='bench_split_io_', dir=os.path.dirname(ms_name))
+
+    legacy = measure('two mstransforms', [legacy_script(ms_name, spw, subband, cal_name, src_name)
+                                          for subband, spw in SUBBANDS.items()], work_dir)
+    per_subband = measure('one read per subband', [subbanding_script(ms_name, spw, subband, cal_name, src_name)
+                                                  for subband, spw in SUBBANDS.items()], work_dir)
+    sweep = measure('single sweep', [split_band_script(ms_name, SUBBANDS, cal_name, src_name, 'band')], work_dir)
+    shutil.rmtree(work_dir)
+
+    print(f"reduction: per subband {legacy / per_subband:.1f}x, single sweep {legacy / sweep:.1f}x")
+
+
+main()
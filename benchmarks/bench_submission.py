@@ -0,0 +1,85 @@
+# Time to get one stage of every subband into the queue: one blocking qsub after the other, all of them
+# side by side (quick_attack.submit_jobs), and as one job array. Runs against the fake qsub/qstat of
+# fake_pbs.py with a slow, flaky server, then waits for every job's sentinel to check no subband was lost.
+#
+#   python benchmarks/bench_submission.py --subbands 32 --latency 0.5 --fail-rate 0.2
+
+import argparse
+import logging
+import os
+import shutil
+import sys
+import tempfile
+import time
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+from bench_job_tracking import install_fake_pbs
+from dragon_breath import sentinel_file_path, read_sentinel, submit_pbs_script
+from quick_attack import PendingJob, submit_jobs
+
+
+def write_job(subband, prefix):
+    os.makedirs(subband, exist_ok=True)
+    pbs_script_file = f"{prefix}_{subband}.pbs"
+    with open(pbs_script_file, 'w') as file:
+        file.write(f"""#!/bin/bash
+#PBS -N {prefix}_{subband}
+#PBS -l nodes=1:ppn=1
+#PBS -l walltime=00:15:00
+#PBS -o {subband}/{prefix}_{subband}.log
+
+cd {os.getcwd()}
+trap 'echo $? > {sentinel_file_path(subband, subband, prefix)}' EXIT
+sleep 0.5
+""")
+    return pbs_script_file
+
+
+def wait_for_sentinels(subbands, prefix, timeout=120):
+    deadline = time.monotonic() + timeout
+    missing = list(subbands)
+    while missing and time.monotonic() < deadline:
+        missing = [s for s in missing if read_sentinel(sentinel_file_path(s, s, prefix)) is None]
+        time.sleep(0.2)
+    return missing
+
+
+def main():
+    parser = argparse.ArgumentParser()
+    parser.add_argument('--subbands', type=int, default=32)
+    parser.add_argument('--latency', type=float, default=0.5, help="seconds every qsub takes")
+    parser.add_argument('--fail-rate', type=float, default=0.2, help="fraction of qsub calls that time out")
+    args = parser.parse_args()
+
+    logging.basicConfig(level=logging.WARNING, format='%(levelname)s %(message)s')
+    logger = logging.getLogger('bench_submission')
+    work_dir = tempfile.mkdtemp(prefix='bench_submission_')
+    os.environ['FAKE_PBS_SPOOL'] = os.path.join(work_dir, 'spool')
+    os.environ['FAKE_PBS_LATENCY'] = str(args.latency)
+    os.environ['FAKE_PBS_FAIL_RATE'] = str(args.fail_rate)
+    install_fake_pbs(os.path.join(work_dir, 'bin'))
+    os.chdir(work_dir)
+    subbands = [f"spw{i}" for i in range(args.subbands)]
+
+    try:
+        for mode in ('sequential', 'concurrent', 'array'):
+            scripts = [write_job(subband, mode) for subband in subbands]
+            start = time.monotonic()
+            if mode == 'sequential':
+                job_ids = [submit_pbs_script(script, subband, logger)[0] for script, subband in zip(scripts, subbands)]
+            else:
+                jobs = [PendingJob(script, subband, group=mode) for script, subband in zip(scripts, subbands)]
+                job_ids = submit_jobs(jobs, logger, use_arrays=mode == 'array')
+            elapsed = time.monotonic() - start
+            lost = [subband for subband, job_id in zip(subbands, job_ids) if not job_id]
+            missing = wait_for_sentinels([s for s in subbands if s not in lost], mode)
+            print(f"{mode:<11} {args.subbands} jobs submitted in {elapsed:6.2f} s, "
+                  f"{len(lost)} not submitted, {len(missing)} never ran")
+    finally:
+        os.chdir('/')
+        shutil.rmtree(work_dir)
+
+
+if __name__ == '__main__':
+    main()
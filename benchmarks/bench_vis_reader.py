@@ -0,0 +1,83 @@
+# Amplitude statistics of a synthetic MS, streamed in chunks (surf.py) against reading the whole
+# DATA and FLAG columns at once. Prints the time and the growth of the peak RSS of each, and checks
+# that the planted bad antennas come out lowest. Needs python-casacore.
+#
+#   python benchmarks/bench_vis_reader.py --nant 30 --nchan 512 --times 200
+
+import argparse
+import os
+import resource
+import shutil
+import sys
+import tempfile
+import time
+
+import numpy as np
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+from surf import CHUNK_ROWS, make_synthetic_ms, read_layout, stream_summary
+
+
+def peak_rss_gb():
+    return resource.getrusage(resource.RUSAGE_SELF).ru_maxrss / 1e6
+
+
+def whole_column_means(ms_name):
+    from casacore.tables import table
+    with table(ms_name, ack=False) as tb:
+        ant1, ant2 = tb.getcol('ANTENNA1'), tb.getcol('ANTENNA2')
+        good = ~tb.getcol('FLAG') & (ant1 != ant2)[:, None, None]
+        amp = np.abs(tb.getcol('DATA')) * good
+        nant = max(ant1.max(), ant2.max()) + 1
+        sums = np.zeros((nant, amp.shape[2]))
+        counts = np.zeros((nant, amp.shape[2]))
+        for ant in (ant1, ant2):
+            np.add.at(sums, ant, amp.sum(axis=1))
+            np.add.at(counts, ant, good.sum(axis=1))
+    return sums / counts
+
+
+def main():
+    parser = argparse.ArgumentParser()
+    parser.add_argument('--nant', type=int, default=30)
+    parser.add_argument('--nchan', type=int, default=512)
+    parser.add_argument('--scans', type=int, default=4)
+    parser.add_argument('--times', type=int, default=50, help="time steps per scan")
+    parser.add_argument('--chunk-rows', type=int, default=CHUNK_ROWS)
+    args = parser.parse_args()
+
+    work_dir = tempfile.mkdtemp(prefix='bench_vis_reader_')
+    try:
+        ms_name = os.path.join(work_dir, 'synthetic.ms')
+        bad = [3, 17 % args.nant]
+        make_synthetic_ms(ms_name, nant=args.nant, nchan=args.nchan, nscan=args.scans, times_per_scan=args.times,
+                          bad_antennas=bad, rfi_channels=range(10, 20), flagged_fraction=0.05)
+        nrow, _, chan_freqs, _ = read_layout(ms_name)
+        nchan = len(chan_freqs)
+
+        rss = peak_rss_gb()
+        start = time.monotonic()
+        summary = stream_summary(ms_name, chunk_rows=args.chunk_rows)
+        streamed = summary.mean('antenna')
+        print(f"streamed      {nrow} rows x {nchan} chans: {time.monotonic() - start:7.2f} s, "
+              f"peak RSS +{peak_rss_gb() - rss:.2f} GB")
+
+        rss = peak_rss_gb()
+        start = time.monotonic()
+        whole = whole_column_means(ms_name)
+        print(f"whole column  {nrow} rows x {nchan} chans: {time.monotonic() - start:7.2f} s, "
+              f"peak RSS +{peak_rss_gb() - rss:.2f} GB")
+
+        assert np.allclose(streamed, whole, rtol=1e-4), "streamed and whole-column means differ"
+        lowest = sorted(np.argsort(streamed[:, 0])[:len(set(bad))].tolist())
+        assert lowest == sorted(set(bad)), f"lowest antennas {lowest}, planted {bad}"
+        print("Means agree, bad antennas found:", lowest)
+        print("Median / MAD of the RFI channels:", summary.median('channel')[10:20, 0].round(2).tolist(),
+              summary.mad('channel')[10:20, 0].round(2).tolist())
+    finally:
+        shutil.rmtree(work_dir)
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,69 @@
+# Per-stage overhead of starting a fresh interpreter for every script against sending the script
+# to a persistent worker from fire_spin.py. Without --casa-dir both sides use plain python, which
+# only shows the dispatch cost; with --casa-dir the fresh side pays the real CASA start-up.
+#
+#   python benchmarks/bench_worker_dispatch.py --payloads 20
+#   python benchmarks/bench_worker_dispatch.py --payloads 5 --casa-dir /home/apal/casa-6.6.4-34-py3.8.el8
+
+import argparse
+import os
+import subprocess
+import sys
+import tempfile
+import time
+
+REPO_DIR = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+sys.path.insert(0, REPO_DIR)
+
+from fire_spin import dispatch, read_address, stop_worker
+
+PAYLOAD = "total = sum(i * i for i in range(100000))\n"
+
+
+def interpreter(casa_dir):
+    if casa_dir:
+        return [f"{casa_dir}/bin/casa", '--nologger', '--nogui', '--nologfile', '-c']
+    return [sys.executable]
+
+
+def main():
+    parser = argparse.ArgumentParser()
+    parser.add_argument('--payloads', type=int, default=20)
+    parser.add_argument('--casa-dir', default=None)
+    args = parser.parse_args()
+
+    work_dir = tempfile.mkdtemp(prefix='bench_worker_dispatch_')
+    script_file = os.path.join(work_dir, 'payload.py')
+    with open(script_file, 'w') as file:
+        file.write(PAYLOAD)
+
+    start = time.monotonic()
+    for _ in range(args.payloads):
+        subprocess.run(interpreter(args.casa_dir) + [script_file], check=True, stdout=subprocess.DEVNULL)
+    fresh = (time.monotonic() - start) / args.payloads
+
+    address_file = os.path.join(work_dir, 'worker.address')
+    env = dict(os.environ, PYTHONPATH=REPO_DIR + os.pathsep + os.environ.get('PYTHONPATH', ''))
+    start = time.monotonic()
+    worker = subprocess.Popen(interpreter(args.casa_dir) + [os.path.join(REPO_DIR, 'fire_spin.py'), 'serve', address_file],
+                              env=env, stdout=subprocess.DEVNULL)
+    while read_address(address_file) is None:
+        time.sleep(0.05)
+    address = read_address(address_file)
+    startup = time.monotonic() - start
+
+    start = time.monotonic()
+    for i in range(args.payloads):
+        reply = dispatch(address, PAYLOAD, f"payload_{i}")
+        if reply['status'] != 'ok':
+            raise RuntimeError(reply['error'])
+    persistent = (time.monotonic() - start) / args.payloads
+    stop_worker(address)
+    worker.wait()
+
+    print(f"fresh interpreter per script: {fresh * 1000:9.1f} ms per script")
+    print(f"persistent worker:            {persistent * 1000:9.1f} ms per script (+ {startup * 1000:.1f} ms once at start-up)")
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,198 @@
+# Stand-in for the PBS qsub/qstat commands so the job handling in dragon_breath can be run and timed
+# on a laptop. Jobs are plain bash scripts started in the background, their state lives in a spool directory.
+#
+# Use it as   python fake_pbs.py qsub [-W depend=afterok:<ids>] [-J 0-N] script.pbs   /   python fake_pbs.py qstat <job ids>
+# (and qdel), or symlink it as qsub, qstat and qdel somewhere on PATH. The spool directory is taken from $FAKE_PBS_SPOOL.
+# $FAKE_PBS_LATENCY makes every qsub take that many seconds, $FAKE_PBS_FAIL_RATE the fraction of qsub calls
+# that time out like a busy server does. $FAKE_PBS_FLAVOR=torque makes qsub --version answer like Torque
+# and take job arrays with -t instead of -J.
+
+import fcntl
+import json
+import os
+import random
+import shutil
+import signal
+import subprocess
+import sys
+import time
+
+SPOOL_DIR = os.environ.get('FAKE_PBS_SPOOL', '/tmp/fake_pbs')
+SERVER = 'fakepbs'
+LATENCY = float(os.environ.get('FAKE_PBS_LATENCY', 0))
+FAIL_RATE = float(os.environ.get('FAKE_PBS_FAIL_RATE', 0))
+FLAVOR = os.environ.get('FAKE_PBS_FLAVOR', 'pro')
+ARRAY_FLAG, ARRAY_INDEX = ('-t', 'PBS_ARRAYID') if FLAVOR == 'torque' else ('-J', 'PBS_ARRAY_INDEX')
+
+
+def next_job_number():
+    """
+    Hand out increasing job numbers, safe against concurrent qsub calls.
+    """
+    counter_file = os.path.join(SPOOL_DIR, 'counter')
+    with open(counter_file, 'a+') as file:
+        fcntl.flock(file, fcntl.LOCK_EX)
+        file.seek(0)
+        content = file.read().strip()
+        number = int(content) + 1 if content else 1
+        file.seek(0)
+        file.truncate()
+        file.write(str(number))
+    return number
+
+
+def read_directives(script_file):
+    """
+    Pick up the job name and the output file from the #PBS lines of a script.
+    """
+    name = os.path.basename(script_file)
+    log_file = None
+    with open(script_file, 'r') as file:
+        for line in file:
+            parts = line.split()
+            if len(parts) > 2 and parts[0] == '#PBS' and parts[1] == '-N':
+                name = parts[2]
+            elif len(parts) > 2 and parts[0] == '#PBS' and parts[1] == '-o':
+                log_file = parts[2]
+    return name, log_file
+
+
+def parse_depend(args):
+    """
+    Job IDs from a -W depend=afterok:id1:id2 option, the only dependency type supported here.
+    """
+    depend = []
+    for i, arg in enumerate(args[:-1]):
+        if arg == '-W' and args[i + 1].startswith('depend=afterok:'):
+            depend = args[i + 1][len('depend=afterok:'):].split(':')
+    return depend
+
+
+def parse_array(args):
+    """
+    Subjob indices from a -J first-last option (-t on Torque), None for a plain job.
+    """
+    for i, arg in enumerate(args[:-1]):
+        if arg == ARRAY_FLAG:
+            first, last = args[i + 1].split('-')
+            return range(int(first), int(last) + 1)
+    return None
+
+
+def start_job(job_id, name, script_file, log_file, depend, env=None):
+    exit_file = os.path.join(SPOOL_DIR, f"{job_id}.exit")
+    # Held jobs wait for their afterok dependencies and are dropped if one of them failed
+    hold = "".join(f"while [ ! -s {SPOOL_DIR}/{dep}.exit ]; do sleep 0.2; done; "
+                   f"[ \"$(cat {SPOOL_DIR}/{dep}.exit)\" = 0 ] || {{ echo 271 > {exit_file}; exit; }}; "
+                   for dep in depend)
+    command = f"{hold}bash {script_file} > {log_file} 2>&1; echo $? > {exit_file}"
+    process = subprocess.Popen(['bash', '-c', command], start_new_session=True, env=dict(os.environ, **(env or {})),
+                               stdin=subprocess.DEVNULL, stdout=subprocess.DEVNULL, stderr=subprocess.DEVNULL)
+
+    with open(os.path.join(SPOOL_DIR, f"{job_id}.job"), 'w') as file:
+        json.dump({'name': name, 'script': script_file, 'submitted': time.time(),
+                   'pid': process.pid, 'depend': depend}, file)
+
+
+def qsub(args):
+    if args == ['--version']:
+        print('Version: 6.1.3' if FLAVOR == 'torque' else 'pbs_version = 2022.1.0')
+        return 0
+    time.sleep(LATENCY)
+    if random.random() < FAIL_RATE:
+        print("qsub: Request timed out, server busy", file=sys.stderr)
+        return 15034
+
+    script_file = args[-1]
+    name, log_file = read_directives(script_file)
+    depend = parse_depend(args)
+    number = next_job_number()
+    # Like qsub, run a copy of the script taken now, the original may change or go away
+    spooled = os.path.join(SPOOL_DIR, f"{number}.script")
+    shutil.copyfile(script_file, spooled)
+    script_file = spooled
+    indices = parse_array(args)
+    if indices is None:
+        job_id = f"{number}.{SERVER}"
+        start_job(job_id, name, script_file, log_file or f"{name}.o{number}", depend)
+        print(job_id)
+        return 0
+
+    for index in indices:
+        subjob_log = f"{name}.o{number}.{index}"
+        if log_file:
+            subjob_log = os.path.join(log_file, subjob_log) if log_file.endswith('/') else f"{log_file}.{index}"
+        start_job(f"{number}[{index}].{SERVER}", name, script_file, subjob_log, depend, {ARRAY_INDEX: str(index)})
+    print(f"{number}[].{SERVER}")
+    return 0
+
+
+def qdel(args):
+    status = 0
+    for job_id in args:
+        job_file = os.path.join(SPOOL_DIR, f"{job_id}.job")
+        exit_file = os.path.join(SPOOL_DIR, f"{job_id}.exit")
+        if not os.path.exists(job_file) or os.path.exists(exit_file):
+            print(f"qdel: Unknown Job Id {job_id}", file=sys.stderr)
+            status = 153
+            continue
+        with open(job_file, 'r') as file:
+            pid = json.load(file)['pid']
+        try:
+            os.killpg(pid, signal.SIGTERM)
+        except ProcessLookupError:
+            pass
+        with open(exit_file, 'w') as file:
+            file.write("271\n")
+    return status
+
+
+def qstat(args):
+    with open(os.path.join(SPOOL_DIR, 'qstat.calls'), 'a') as file:
+        file.write(f"{time.time()}\n")
+
+    if args:
+        job_ids = args
+    else:
+        job_ids = sorted(f[:-len('.job')] for f in os.listdir(SPOOL_DIR) if f.endswith('.job'))
+
+    rows = []
+    status = 0
+    for job_id in job_ids:
+        job_file = os.path.join(SPOOL_DIR, f"{job_id}.job")
+        if not os.path.exists(job_file) or os.path.exists(os.path.join(SPOOL_DIR, f"{job_id}.exit")):
+            if args:
+                print(f"qstat: Unknown Job Id {job_id}", file=sys.stderr)
+                status = 153
+            continue
+        with open(job_file, 'r') as file:
+            job = json.load(file)
+        held = any(not os.path.exists(os.path.join(SPOOL_DIR, f"{dep}.exit")) for dep in job['depend'])
+        state = 'H' if held else 'R'
+        rows.append(f"{job_id:<17} {job['name'][:16]:<16} {'fake':<16} {'00:00:00':>8} {state} workq")
+
+    if rows:
+        print("Job id            Name             User              Time Use S Queue")
+        print("----------------  ---------------- ----------------  -------- - -----")
+        print("\n".join(rows))
+    return status
+
+
+def main(argv):
+    command = os.path.basename(argv[0])
+    args = argv[1:]
+    if command not in ('qsub', 'qstat', 'qdel'):
+        command, args = args[0], args[1:]
+    os.makedirs(SPOOL_DIR, exist_ok=True)
+    if command == 'qsub':
+        return qsub(args)
+    if command == 'qstat':
+        return qstat(args)
+    if command == 'qdel':
+        return qdel(args)
+    print(f"Unknown command {command}", file=sys.stderr)
+    return 2
+
+
+if __name__ == '__main__':
+    sys.exit(main(sys.argv))
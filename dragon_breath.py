@@ -1,8 +1,13 @@
 import logging 
 import os
-import subprocess
 import time
 
+from rock_slide import current_executor
+from growth import size_stage, write_sizing, read_sizing, sizing_file_path, runtime_file_path
+from mind_reader import LogMonitor
+from foresight import instrument_script, profile_file_path, PROFILE_PREAMBLE
+from quick_attack import PendingJob, submission_deferred, submit_jobs
+
 # Function to configure a logger
 def configure_logger(name, log_file, level=logging.DEBUG):
     logger = logging.getLogger(name)
@@ -28,54 +33,356 @@ def configure_logger(name, log_file, level=logging.DEBUG):
     return logger
 
 
-def subbanding(ms_name, subband, spw, output_dir, casa_dir, logger, cal_name, src_name):
+def split_out_function(mms_axis=None, numsubms='auto'):
     """
-    Create a PBS script for the given subband and submit it to the queue.
+    CASA code defining split_out(vis, outputvis, field, spw), which writes a plain MS with split,
+    or a Multi-MS partitioned along mms_axis ('scan', 'baseline' or 'auto') when one is given.
+    The sub-MSs of a Multi-MS are what mpicasa hands out to its ranks in the later stages.
+    """
+    return f"""mms_axis = {mms_axis!r}
+numsubms = {numsubms!r}
+
+def split_out(vis, outputvis, field, spw=''):
+    if mms_axis:
+        mstransform(vis=vis, outputvis=outputvis, field=field, spw=spw, datacolumn='data',
+                    createmms=True, separationaxis=mms_axis, numsubms=numsubms)
+    else:
+        split(vis=vis, outputvis=outputvis, field=field, spw=spw, datacolumn='data')
+"""
+
+def subbanding_script(ms_name, spw, output_dir, cal_name, src_name, mms_axis=None, numsubms='auto'):
+    """
+    CASA script that splits one subband of the parent MS into cal.ms and src.ms.
+    The parent is read once: the calibrator and source fields of the subband go to a
+    temporary MS, and both outputs are split from that much smaller copy.
+    With mms_axis the outputs are Multi-MSs, see split_out_function.
     """
-    python_script_content = f"""ms_name = '{ms_name}'
+    return f"""import shutil
+
+ms_name = '{ms_name}'
 spw = '{spw}'
 output_dir = '{output_dir}'
 cal_name = '{cal_name}'
 src_name = '{src_name}'
+fields_ms = f'{{output_dir}}/fields.ms'
+
+{split_out_function(mms_axis, numsubms)}
+# mstransform will not write over the temporary MS a failed run left behind
+shutil.rmtree(fields_ms, ignore_errors=True)
+
+# Call mstransform function from within CASA, one pass over the parent for both field groups
+mstransform(vis=ms_name, spw=spw, outputvis=fields_ms, field=cal_name+','+src_name, datacolumn='DATA')
+split_out(fields_ms, f'{{output_dir}}/cal.ms', cal_name)
+split_out(fields_ms, f'{{output_dir}}/src.ms', src_name)
+shutil.rmtree(fields_ms)
+"""
+
+def parse_spw_range(spw):
+    """
+    Split a CASA channel selection like '0:124~573' into (spw_id, first_chan, last_chan).
+    """
+    spw_id, chans = spw.split(':')
+    first, last = chans.split('~')
+    return int(spw_id), int(first), int(last)
+
+def split_band_script(ms_name, subbands_dict, cal_name, src_name, band_dir, mms_axis=None, numsubms='auto'):
+    """
+    CASA script that fans the whole band out into spwN/cal.ms and spwN/src.ms in one sweep.
+    The parent is read once by a single mstransform that keeps the calibrator and source fields,
+    drops the band edges and cuts the band into one spw per subband (nspw). The spws are stored
+    as separate rows, so the per-subband splits afterwards only touch their own part of band.ms.
+    Subbands have to be contiguous and of equal width for nspw to reproduce them.
+    With mms_axis the outputs are Multi-MSs, see split_out_function.
+    """
+    ranges = {subband: parse_spw_range(spw) for subband, spw in subbands_dict.items()}
+    spw_ids = {spw_id for spw_id, _, _ in ranges.values()}
+    if len(spw_ids) != 1:
+        raise ValueError(f"All subbands have to come from the same spw, got {sorted(spw_ids)}")
+    ordered = sorted((first, last) for _, first, last in ranges.values())
+    widths = {last - first + 1 for first, last in ordered}
+    if len(widths) != 1 or any(ordered[i][1] + 1 != ordered[i + 1][0] for i in range(len(ordered) - 1)):
+        raise ValueError("Subbands have to be contiguous and of equal width for a single-sweep split")
+
+    parent_spw = spw_ids.pop()
+    channels = {subband: (first, last) for subband, (_, first, last) in ranges.items()}
+    return f"""import shutil
+import numpy as np
+
+ms_name = '{ms_name}'
+cal_name = '{cal_name}'
+src_name = '{src_name}'
+subbands = {channels!r}
+band_ms = '{band_dir}/band.ms'
+
+{split_out_function(mms_axis, numsubms)}
+# mstransform will not write over the temporary MS a failed run left behind
+shutil.rmtree(band_ms, ignore_errors=True)
+
+# One read of the parent for every subband and field group
+mstransform(vis=ms_name, outputvis=band_ms, field=cal_name+','+src_name, spw='{parent_spw}:{ordered[0][0]}~{ordered[-1][1]}',
+            datacolumn='DATA', regridms=True, mode='channel', nspw={len(ordered)})
+
+# Match the output spws to the subbands by frequency, the band may be stored in either direction
+msmd.open(ms_name)
+parent_freqs = msmd.chanfreqs({parent_spw})
+msmd.close()
+msmd.open(band_ms)
+band_centres = np.array([np.mean(msmd.chanfreqs(i)) for i in range(msmd.nspw())])
+msmd.close()
+
+for subband, (first, last) in subbands.items():
+    spw = int(np.argmin(np.abs(band_centres - np.mean(parent_freqs[first:last + 1]))))
+    split_out(band_ms, f'{{subband}}/cal.ms', cal_name, str(spw))
+    split_out(band_ms, f'{{subband}}/src.ms', src_name, str(spw))
+
+shutil.rmtree(band_ms)
+"""
 
-# Call mstransform function from within CASA
-mstransform(vis=ms_name, spw=spw, outputvis=f'{{output_dir}}/cal.ms', field=cal_name, datacolumn='DATA')
-mstransform(vis=ms_name, spw=spw, outputvis=f'{{output_dir}}/src.ms', field=src_name, datacolumn='DATA')
+def casa_command(casa_dir, python_script_file, ranks=1):
+    """
+    Command line that runs a CASA script, under mpicasa with that many processes when ranks > 1.
+    CASA logs to the terminal, so the live log of the job has every message with its level
+    (see mind_reader.py) and, under mpicasa, the servers that did the work (see check_rank_usage).
+    """
+    casa = f"{casa_dir}/bin/casa --nologger --nogui --nologfile --log2term -c {python_script_file}"
+    if ranks > 1:
+        return f"{casa_dir}/bin/mpicasa -n {ranks} {casa}"
+    return casa
+
+# Node-local staging of the subband jobs, see use_staging
+_staging = {'scratch': None, 'headroom': 2.0}
+
+def use_staging(scratch, headroom=2.0):
+    """
+    Run the subband jobs on a copy of their MSs and tables in scratch, a directory on the compute node
+    such as '$TMPDIR' or a local SSD (shell variables are expanded by the job), instead of on the shared
+    filesystem. Only what the job changed goes back (stage_out_function). A job runs in place when
+    scratch is missing or has less free space than headroom x the size of its inputs, room for a
+    new data column. None turns staging off.
+    """
+    _staging['scratch'] = scratch
+    _staging['headroom'] = headroom
+
+def staged_paths(ms_names, others=()):
+    """
+    What a job has to take to scratch: the MSs with their flag backups, and other tables or files.
+    """
+    paths = []
+    for ms_name in ms_names:
+        paths += [ms_name, ms_name + '.flagversions']
+    return paths + list(others)
+
+def stage_out_function(working_dir, paths):
+    """
+    bash code defining stage_out, which the exit trap calls. After a successful job it copies the files
+    the job wrote in scratch (newer than the .staged marker) back to working_dir and checks that every
+    file has the size of its scratch copy; only then are the files the job deleted removed from the
+    staged paths. A failed copy or check fails the job, leaves the shared copies as they were apart from
+    the files already copied, and keeps the scratch copy for a look. After a failed job the shared
+    copies are left as they were.
+    """
+    quoted = ' '.join(f'"{path}"' for path in paths)
+    return f"""stage_dir=""
+staged=({quoted})
+same_sizes() {{
+    # Every file under scratch ($1) has a copy of the same size under $2
+    local file
+    while IFS= read -r -d '' file; do
+        [ "$(stat -c %s "$1/$file")" = "$(stat -c %s "$2/$file" 2>/dev/null)" ] || return 1
+    done < <(cd "$1" && find . -type f ! -name .staged -print0)
+}}
+stage_out() {{
+    cd {working_dir}
+    [ -n "$stage_dir" ] || return 0
+    if [ "$status" != 0 ]; then
+        echo "Staging: the job failed, the shared copies are left as they were"
+        rm -rf "$stage_dir"
+        return 0
+    fi
+    if ! (cd "$stage_dir" && find . -type f -newer .staged -print0 | xargs -0 -r cp -a --parents -t {working_dir}/) ||
+       ! same_sizes "$stage_dir" {working_dir}; then
+        echo "Staging: copying back from $stage_dir failed, it is left there"
+        status=75
+        return 1
+    fi
+    local path entry
+    for path in "${{staged[@]}}"; do
+        [ -e "$stage_dir/$path" ] || continue
+        while IFS= read -r -d '' entry; do
+            [ -e "$stage_dir/$entry" ] || rm -rf "$entry"
+        done < <(find "$path" -depth -print0 2>/dev/null)
+    done
+    echo "Staging: changes copied back from $stage_dir"
+    rm -rf "$stage_dir"
+}}
+"""
+
+def exit_trap(sentinel_file, runtime_file, working_dir=None, paths=None):
+    """
+    bash trap that writes the runtime of the job and then its exit status to the sentinel.
+    The sentinel has to come last, it is what tells the pipeline the job is over.
+    With staging on (use_staging) and the paths the job stages, the changes are copied back
+    from scratch first (stage_out_function), the sentinel only follows once they are there.
+    """
+    if _staging['scratch'] and paths:
+        return (stage_out_function(working_dir, paths) +
+                f"trap 'status=$?; stage_out; echo $SECONDS > {runtime_file}; echo $status > {sentinel_file}' EXIT")
+    return f"trap 'status=$?; echo $SECONDS > {runtime_file}; echo $status > {sentinel_file}' EXIT"
+
+def stage_in(name, paths=None):
+    """
+    bash code that copies the staged paths of the job to scratch, checks the copy and moves the job there.
+    Falls back to running in place when there is no scratch directory, nothing to stage, too little
+    space or the copy fails. Empty without staging; goes with exit_trap, which defines stage_out for
+    the same paths.
+    """
+    if not (_staging['scratch'] and paths):
+        return ""
+    return f"""scratch_root="{_staging['scratch']}"
+existing=()
+for path in "${{staged[@]}}"; do [ -e "$path" ] && existing+=("$path"); done
+if [ -z "$scratch_root" ] || [ ! -d "$scratch_root" ]; then
+    echo "Staging: no scratch directory '$scratch_root', running in place"
+elif [ ${{#existing[@]}} = 0 ]; then
+    echo "Staging: nothing to stage, running in place"
+else
+    needed=$(du -sb "${{existing[@]}}" | awk -v headroom={_staging['headroom']} '{{s += $1}} END {{printf "%.0f", s * headroom}}')
+    free=$(df -PB1 "$scratch_root" | awk 'NR == 2 {{print $4}}')
+    if [ "$needed" -lt "$free" ]; then
+        stage_dir=$(mktemp -d "$scratch_root/{name}.XXXXXX")
+        if cp -a --parents "${{existing[@]}}" "$stage_dir"/ && same_sizes "$stage_dir" .; then
+            touch "$stage_dir/.staged"
+            cd "$stage_dir"
+            echo "Staging: ${{existing[*]}} copied to $stage_dir ($needed of $free bytes)"
+        else
+            echo "Staging: copying to $stage_dir failed, running in place"
+            rm -rf "$stage_dir"
+            stage_dir=""
+        fi
+    else
+        echo "Staging: $scratch_root has $free bytes free and $needed are needed, running in place"
+    fi
+fi
 """
 
+def live_log_file_path(output_dir, subband, prefix):
+    """
+    The job scripts send their output here as it is written. PBS often only copies the -o log
+    back when the job is over, this one can be followed while the job runs.
+    """
+    return os.path.join(output_dir, f"{prefix}_{subband}.live.log")
+
+def profiled_script(script, output_dir, subband, prefix):
+    """
+    Wrap the CASA tasks of a stage script so every call is timed (foresight.py), and drop the
+    profile left by the previous run of the same job.
+    """
+    profile_file = profile_file_path(output_dir, subband, prefix)
+    if os.path.exists(profile_file):
+        os.remove(profile_file)
+    return instrument_script(script, profile_file)
+
+def stage_resources(stage, ms_name, output_dir, subband, logger, resources=None, prefix=None):
+    """
+    Size the job of a stage from its MS (growth.size_stage) unless resources are given, and keep
+    the sizing next to the log so the runtime of the job can be recorded once it is done.
+    prefix is the job prefix when it is not the stage name, see part_prefix.
+    """
+    prefix = prefix or stage
+    if resources is None:
+        resources = size_stage(stage, ms_name)
+    write_sizing(sizing_file_path(output_dir, subband, prefix), resources)
+    logger.info(f"{prefix}_{subband}: {resources['ppn']} cores, {resources['ranks']} CASA processes, "
+                f"{resources['mem_gb']} GB, walltime {resources['walltime']}")
+    return resources
+
+def subbanding(ms_name, subband, spw, output_dir, casa_dir, logger, cal_name, src_name, depend=None, resources=None,
+               mms_axis=None, numsubms='auto'):
+    """
+    Create a PBS script for the given subband and submit it to the queue.
+    depend is an optional list of job IDs this job has to wait for.
+    resources overrides the job size worked out by growth.size_stage.
+    mms_axis and numsubms turn the outputs into Multi-MSs, see split_out_function.
+    """
+    python_script_content = subbanding_script(ms_name, spw, output_dir, cal_name, src_name, mms_axis, numsubms)
+    python_script_content = profiled_script(python_script_content, output_dir, subband, 'mstransform')
+
     python_script_file = f"run_mstransform_{subband}.py"
     with open(python_script_file, "w") as file:
         file.write(python_script_content)
 
     working_dir = os.getcwd()
+    sentinel_file = sentinel_file_path(output_dir, subband, 'mstransform')
+    runtime_file = runtime_file_path(output_dir, subband, 'mstransform')
+    live_log = live_log_file_path(output_dir, subband, 'mstransform')
+    resources = stage_resources('mstransform', ms_name, output_dir, subband, logger, resources)
+    clear_sentinel(sentinel_file, logger)
     pbs_script_content = f"""#!/bin/bash
 #PBS -N mstransform_{subband}
-#PBS -l nodes=1:ppn=1
-#PBS -l walltime=02:00:00
+#PBS -l nodes=1:ppn={resources['ppn']}
+#PBS -l mem={resources['mem_gb']}gb
+#PBS -l walltime={resources['walltime']}
 #PBS -j oe
 #PBS -o {output_dir}/mstransform_{subband}.log
 #PBS -q workq
 
 cd {working_dir}
+{exit_trap(sentinel_file, runtime_file)}
+exec > {live_log} 2>&1
 source ~/.bashrc
 micromamba activate 38data
-{casa_dir}/bin/casa --nologger --nogui --nologfile -c {python_script_file}
+{casa_command(casa_dir, python_script_file, resources['ranks'])}
 """
 
     pbs_script_file = f"mstransform_{subband}.pbs"
     with open(pbs_script_file, "w") as file:
         file.write(pbs_script_content)
 
-    submit_command = f"qsub {pbs_script_file}"
-    logger.info(f"Submitting PBS script for {subband} with command: {submit_command}")
-    try:
-        result = subprocess.run(submit_command, shell=True, stdout=subprocess.PIPE, stderr=subprocess.PIPE, check=True)
-        job_id = result.stdout.decode().strip()  # Job ID is the output from qsub
-        logger.info(f"PBS script for {subband} submitted successfully with job ID: {job_id}")
-        return job_id, subband
-    except subprocess.CalledProcessError as e:
-        logger.error(f"Failed to submit PBS script for {subband}: {e}")
-        return None, subband
+    return submit_pbs_script(pbs_script_file, subband, logger, depend)
+
+def split_band(ms_name, subbands_dict, casa_dir, logger, cal_name, src_name, band_dir='band', depend=None, resources=None,
+               mms_axis=None, numsubms='auto'):
+    """
+    Create a single PBS script that splits every subband and field group in one sweep over the
+    parent MS and submit it to the queue. The job is tracked as subband band_dir with prefix 'split'.
+    resources overrides the job size worked out by growth.size_stage.
+    mms_axis and numsubms turn the outputs into Multi-MSs, see split_out_function.
+    """
+    python_script_content = split_band_script(ms_name, subbands_dict, cal_name, src_name, band_dir, mms_axis, numsubms)
+    python_script_content = profiled_script(python_script_content, band_dir, band_dir, 'split')
+
+    python_script_file = f"run_split_{band_dir}.py"
+    with open(python_script_file, "w") as file:
+        file.write(python_script_content)
+
+    working_dir = os.getcwd()
+    sentinel_file = sentinel_file_path(band_dir, band_dir, 'split')
+    runtime_file = runtime_file_path(band_dir, band_dir, 'split')
+    live_log = live_log_file_path(band_dir, band_dir, 'split')
+    resources = stage_resources('split', ms_name, band_dir, band_dir, logger, resources)
+    clear_sentinel(sentinel_file, logger)
+    pbs_script_content = f"""#!/bin/bash
+#PBS -N split_{band_dir}
+#PBS -l nodes=1:ppn={resources['ppn']}
+#PBS -l mem={resources['mem_gb']}gb
+#PBS -l walltime={resources['walltime']}
+#PBS -j oe
+#PBS -o {band_dir}/split_{band_dir}.log
+#PBS -q workq
+
+cd {working_dir}
+{exit_trap(sentinel_file, runtime_file)}
+exec > {live_log} 2>&1
+source ~/.bashrc
+micromamba activate 38data
+{casa_command(casa_dir, python_script_file, resources['ranks'])}
+"""
+
+    pbs_script_file = f"split_{band_dir}.pbs"
+    with open(pbs_script_file, "w") as file:
+        file.write(pbs_script_content)
+
+    return submit_pbs_script(pbs_script_file, band_dir, logger, depend)
 
 def extract_log_file_path(pbs_file):
     """
@@ -96,55 +403,256 @@ def extract_log_file_path(pbs_file):
         print(f"Error reading {pbs_file}: {e}")
     return log_path
 
-def wait_for_jobs_to_finish(job_info, base_output_dir, logger,prefix):
+def sentinel_file_path(output_dir, subband, prefix):
+    """
+    Path of the completion sentinel a PBS script writes when it exits.
+    The file holds the exit status of the script.
+    """
+    return os.path.join(output_dir, f"{prefix}_{subband}.done")
+
+def clear_sentinel(sentinel_file, logger):
+    """
+    Remove a stale sentinel left behind by a previous run of the same job.
+    """
+    if os.path.exists(sentinel_file):
+        os.remove(sentinel_file)
+        logger.debug(f"Removed stale sentinel {sentinel_file}")
+
+def read_sentinel(sentinel_file):
+    """
+    Return the exit status stored in a sentinel file, or None if the job has not written it yet.
+    """
+    try:
+        with open(sentinel_file, 'r') as file:
+            content = file.read().strip()
+    except OSError:
+        return None
+    try:
+        return int(content)
+    except ValueError:
+        # The trap writes the file in one go, an empty file means it is still being written
+        return None
+
+# Seconds a job that left the queue gets for its sentinel to show up, files written on the node
+# can take a while to appear on the shared filesystem
+SENTINEL_GRACE = 30
+
+def wait_for_sentinel(sentinel_file, grace=None, interval=1):
+    """
+    Exit status in the sentinel file, waiting up to grace seconds (SENTINEL_GRACE by default) for it.
+    None if it never shows up.
+    """
+    deadline = time.monotonic() + (SENTINEL_GRACE if grace is None else grace)
+    while True:
+        exit_status = read_sentinel(sentinel_file)
+        if exit_status is not None or time.monotonic() >= deadline:
+            return exit_status
+        time.sleep(interval)
+
+def query_job_states(job_ids):
+    """
+    Ask the scheduler about all the given jobs in one go (one qstat call on PBS).
+    Returns a dict {job_id: state} for the jobs that are still queued or running.
+    Jobs that are no longer known to the server, or are reported as finished, are left out.
+    """
+    return current_executor().query(job_ids)
+
+def job_log_file(subband, base_output_dir, prefix):
+    """
+    Path of the PBS log (-o) of a job.
+    """
+    # Locate the .pbs file for the subband
+    pbs_file = f"{prefix}_{subband}.pbs"
+    log_file_path = extract_log_file_path(pbs_file)
+
+    # Construct the log file path relative to base_output_dir
+    if log_file_path:
+        return os.path.join(base_output_dir, subband, os.path.basename(log_file_path))
+    return os.path.join(base_output_dir, subband, f"{prefix}_{subband}.log")
+
+def check_job_log(job_id, subband, base_output_dir, logger, prefix, monitor=None):
+    """
+    Check the output of a finished job. Returns True if the job looks successful.
+    A job fails on a non-zero exit status, a CASA SEVERE message or a Python traceback, and when
+    it left no sentinel within SENTINEL_GRACE seconds, as a job killed outright does.
+    The live log is read on from where monitor stopped following it; jobs without a live log
+    are judged by their PBS log.
+    """
+    log_file = job_log_file(subband, base_output_dir, prefix)
+
+    sentinel_file = sentinel_file_path(os.path.join(base_output_dir, subband), subband, prefix)
+    exit_status = read_sentinel(sentinel_file)
+    if exit_status is None and (monitor is None or monitor.fatal is None):
+        # No sentinel means the exit trap never ran: killed with SIGKILL (out of memory, qdel -W force)
+        exit_status = wait_for_sentinel(sentinel_file)
+        if exit_status is None:
+            logger.error(f"Job {job_id} (subband {subband}) left the queue without writing {sentinel_file}, "
+                         f"it was killed before it could finish. Check log file {log_file}.")
+            return False
+    if exit_status not in (None, 0):
+        logger.error(f"Job {job_id} (subband {subband}) exited with status {exit_status}. Check log file {log_file}.")
+        return False
+
+    if monitor is None or not os.path.exists(monitor.log_file):
+        live_log = live_log_file_path(os.path.join(base_output_dir, subband), subband, prefix)
+        monitor = LogMonitor(live_log if os.path.exists(live_log) else log_file)
+    if not os.path.exists(monitor.log_file):
+        logger.error(f"Log file for job {job_id} (subband {subband}) not found or invalid path.")
+        return False
+
+    monitor.poll(final=True)
+    if monitor.fatal is not None:
+        logger.error(f"Job {job_id} (subband {subband}) failed: {monitor.fatal.strip()}. Check log file {monitor.log_file}.")
+        return False
+    logger.info(f"Job {job_id} (subband {subband}) completed successfully "
+                f"({monitor.tasks_done} CASA tasks, {monitor.warnings} warnings).")
+    check_rank_usage(job_id, subband, monitor.servers, os.path.join(base_output_dir, subband), prefix, logger)
+    return True
+
+def check_rank_usage(job_id, subband, servers_seen, output_dir, prefix, logger):
+    """
+    Warn when an mpicasa job left some of its servers idle. The servers tag their log messages
+    with MPIServer-<rank>, a server that never shows up in the log got no sub-MS to work on.
+    servers_seen are the ranks found in the log. Returns the number of servers that did some
+    work, None for a job that ran without mpicasa.
+    """
+    resources = read_sizing(sizing_file_path(output_dir, subband, prefix))
+    if resources is None or resources['ranks'] < 2:
+        return None
+    servers = resources['ranks'] - 1
+    used = len(servers_seen)
+    if used < servers:
+        logger.warning(f"Job {job_id} (subband {subband}) used {used} of its {servers} MPI servers, "
+                       f"the MS needs at least {servers} sub-MSs to keep them all busy.")
+    else:
+        logger.info(f"Job {job_id} (subband {subband}) used all {servers} MPI servers.")
+    return used
+
+def follow_job_log(monitor, label, logger):
+    """
+    Report what a running job did since the last look: CASA tasks starting and finishing,
+    warnings (at debug level) and the SEVERE messages or tracebacks that make it fail.
+    """
+    for kind, task, line in monitor.poll():
+        if kind == 'begin':
+            logger.info(f"{label}: {task} started.")
+        elif kind == 'end':
+            logger.info(f"{label}: {task} finished, {monitor.tasks_done} CASA tasks done.")
+        elif kind == 'warn':
+            logger.debug(f"{label}: {line}")
+        else:
+            logger.error(f"{label}: {line}")
+
+def wait_for_any_job(running, base_output_dir, logger, min_interval=5, max_interval=60, sentinel_interval=1, monitors=None):
+    """
+    Block until at least one of the running jobs has left the queue and return those jobs.
+    running should be a list of tuples (job_id, subband, prefix).
+
+    All outstanding jobs are queried with one qstat call. The qstat interval starts at
+    min_interval and backs off by 1.5x up to max_interval while nothing changes.
+    In between, the completion sentinels written by the PBS scripts are checked every
+    sentinel_interval seconds; a new sentinel brings the next qstat forward straight away.
+
+    The live log of every job is followed at the same pace (mind_reader.LogMonitor). A job that
+    logs a SEVERE message or a traceback is deleted and returned at once, without waiting for it
+    to leave the queue. monitors is a dict {job_id: LogMonitor} kept by the caller between calls,
+    so every log is read only once; pass it on to check_job_log.
+    """
+    if monitors is None:
+        monitors = {}
+    interval = min_interval
+    next_qstat = time.monotonic() + min_interval
+    seen_sentinels = set()
+
+    while True:
+        time.sleep(sentinel_interval)
+
+        for job_id, subband, prefix in running:
+            if job_id in seen_sentinels:
+                continue
+            sentinel_file = sentinel_file_path(os.path.join(base_output_dir, subband), subband, prefix)
+            if read_sentinel(sentinel_file) is not None:
+                logger.debug(f"Sentinel for job {job_id} (subband {subband}) found.")
+                seen_sentinels.add(job_id)
+                next_qstat = time.monotonic()
+                interval = min_interval
+
+        failing = []
+        for job_id, subband, prefix in running:
+            if job_id not in monitors:
+                monitors[job_id] = LogMonitor(live_log_file_path(os.path.join(base_output_dir, subband), subband, prefix))
+            follow_job_log(monitors[job_id], f"{prefix}_{subband}", logger)
+            if monitors[job_id].fatal is not None and job_id not in seen_sentinels:
+                failing.append((job_id, subband, prefix))
+        if failing:
+            # No point in letting them run to the end of their walltime
+            delete_jobs([job_id for job_id, _, _ in failing], logger)
+            return failing
+
+        if time.monotonic() < next_qstat:
+            continue
+
+        try:
+            active = query_job_states([job_id for job_id, _, _ in running])
+        except OSError as e:
+            # Server hiccup, keep every job outstanding and try again later
+            logger.error(f"Failed to check job status: {e}")
+            active = None
+
+        if active is not None:
+            finished = [job for job in running if job[0] not in active]
+            if finished:
+                return finished
+
+        interval = min(interval * 1.5, max_interval)
+        next_qstat = time.monotonic() + interval
+
+def wait_for_jobs_to_finish(job_info, base_output_dir, logger, prefix, min_interval=5, max_interval=60, sentinel_interval=1):
     """
     Wait for all jobs to finish, check their log files, and clean up files.
     job_info should be a list of tuples (job_id, subband).
+    See wait_for_any_job for how the queue is watched.
     """
     all_successful = True
     failed_jobs = []
-
-    while job_info:
-        time.sleep(60)  # Check every minute
-        for job_id, subband in job_info[:]:
-            try:
-                qstat_command = f"qstat {job_id}"
-                result = subprocess.run(qstat_command, shell=True, stdout=subprocess.PIPE, stderr=subprocess.PIPE)
-                if result.returncode != 0:  # If qstat fails, job is probably finished
-                    job_info.remove((job_id, subband))
-
-                    # Locate the .pbs file for the subband
-                    pbs_file = f"{prefix}_{subband}.pbs"
-                    log_file_path = extract_log_file_path(pbs_file)
-                    
-                    # Construct the log file path relative to base_output_dir
-                    if log_file_path:
-                        log_file = os.path.join(base_output_dir,subband, os.path.basename(log_file_path))
-                        print(log_file)
-                    else:
-                        log_file = os.path.join(base_output_dir,subband, f"{prefix}_{subband}.log")
-
-                    if os.path.exists(log_file):
-                        with open(log_file, 'r') as log:
-                            log_content = log.read()
-                            if "error" in log_content.lower():
-                                logger.error(f"Job {job_id} (subband {subband}) failed. Check log file {log_file}.")
-                                all_successful = False
-                                failed_jobs.append(subband)
-                            else:
-                                logger.info(f"Job {job_id} (subband {subband}) completed successfully.")
-                    else:
-                        logger.error(f"Log file for job {job_id} (subband {subband}) not found or invalid path.")
-                        all_successful = False
-                        failed_jobs.append(subband)
-
-            except subprocess.CalledProcessError as e:
-                logger.error(f"Failed to check job status for {job_id}: {e}")
+    monitors = {}
+
+    running = [(job_id, subband, prefix) for job_id, subband in job_info]
+    while running:
+        for job_id, subband, _ in wait_for_any_job(running, base_output_dir, logger, min_interval, max_interval, sentinel_interval, monitors):
+            running.remove((job_id, subband, prefix))
+            job_info.remove((job_id, subband))
+            if not check_job_log(job_id, subband, base_output_dir, logger, prefix, monitors.pop(job_id, None)):
                 all_successful = False
                 failed_jobs.append(subband)
 
     return all_successful, failed_jobs
 
+def submit_pbs_script(pbs_script_file, subband, logger, depend=None):
+    """
+    Submit a PBS script to the queue and return (job_id, subband). job_id is None if the submission failed.
+    depend is an optional list of job IDs that have to finish successfully before this one starts.
+    The script goes to the executor chosen with rock_slide.use_executor, PBS by default; transient
+    failures are retried with backoff (quick_attack.py). Within quick_attack.deferred_submission the job
+    is only recorded and a quick_attack.PendingJob comes back in place of the job ID.
+    """
+    job = PendingJob(pbs_script_file, subband, depend)
+    if submission_deferred():
+        return job, subband
+    job_id, = submit_jobs([job], logger, use_arrays=False)
+    return job_id, subband
+
+def delete_jobs(job_ids, logger):
+    """
+    Remove queued jobs, e.g. dependants of a failed job that PBS would otherwise hold forever.
+    """
+    if not job_ids:
+        return
+    logger.info(f"Deleting jobs {', '.join(job_ids)}")
+    complaint = current_executor().delete(job_ids)
+    if complaint:
+        logger.warning(f"Deleting jobs reported: {complaint}")
+
 def cleanup_files(subband, logger,prefix):
     """
     Delete .py and .pbs files for the given subband.
@@ -169,22 +677,118 @@ def cleanup_files(subband, logger,prefix):
 
 
 
-def flag_cal(ms_name, subband, output_prefix, casa_dir, logger, amp_cal, phase_cal):
+def task_graph_function():
     """
-    Create a PBS script for the given subband and submit it to the queue.
+    CASA code defining run_steps(steps), which runs a list of (name, task, params, deps) as a task graph.
+    Steps that become ready together run side by side on the cores of the job: the first one in this
+    CASA session, the others each in a separate Python with the modular casatasks, profiled like the
+    session (foresight.py) when it is. A step fails when its task returns False or raises. Under mpicasa
+    the steps run one at a time in the session, a separate Python would be outside the MPI servers.
     """
-    python_script_content = f"""ms_name = '{ms_name}'
+    return """import json
+import os
+import subprocess
+import sys
+import traceback
+
+try:
+    from casampi.MPIEnvironment import MPIEnvironment
+    in_mpi = MPIEnvironment.is_mpi_enabled
+except ImportError:
+    in_mpi = False
+
+STEP_SETUP = '''import json, os, sys
+import casatasks
+from casatasks import casalog
+casalog.setlogfile(os.devnull)
+casalog.showconsole(True)
+task, params = sys.argv[1], json.loads(sys.argv[2])
+globals()[task] = getattr(casatasks, task)
+'''
+
+STEP_RUN = '''
+result = globals()[task](**params)
+sys.exit(1 if result is False else 0)
+'''
+
+STEP_PREAMBLE = """ + repr(PROFILE_PREAMBLE) + """
+
+def step_profile_file(name):
+    # The profile of a side step goes to a file of its own, merged into the one of this job afterwards
+    if '_profile_file' not in globals():
+        return None
+    return f"{_profile_file}.{name.replace(' ', '_')}"
+
+def start_step(name, task, params):
+    profile_file = step_profile_file(name)
+    code = STEP_SETUP
+    if profile_file:
+        code += STEP_PREAMBLE.format(profile_file=profile_file, tasks=(task,))
+    return subprocess.Popen([sys.executable, '-c', code + STEP_RUN, task, json.dumps(params)])
+
+def merge_step_profile(name):
+    profile_file = step_profile_file(name)
+    if profile_file is None:
+        return
+    try:
+        with open(profile_file, 'r') as file:
+            _profile.extend(json.load(file))
+        os.remove(profile_file)
+    except (OSError, ValueError):
+        return
+    with open(_profile_file + '.tmp', 'w') as file:
+        json.dump(_profile, file, indent=1)
+    os.replace(_profile_file + '.tmp', _profile_file)
+
+def run_step(task, params):
+    default(globals()[task])
+    try:
+        return globals()[task](**params) is not False
+    except Exception:
+        traceback.print_exc()
+        return False
+
+def run_steps(steps, max_parallel=None):
+    max_parallel = 1 if in_mpi else max_parallel or len(os.sched_getaffinity(0))
+    done = set()
+    pending = list(steps)
+    while pending:
+        ready = [step for step in pending if all(dep in done for dep in step[3])]
+        if not ready:
+            raise RuntimeError(f"Steps {[step[0] for step in pending]} need steps that do not exist")
+        ready = ready[:max(1, max_parallel)]
+        children = []
+        for name, task, params, _ in ready[1:]:
+            print(f"Starting {name} ({task}) next to {ready[0][0]}", flush=True)
+            children.append((name, start_step(name, task, params)))
+        name, task, params, _ = ready[0]
+        failed = [] if run_step(task, params) else [name]
+        for name, child in children:
+            if child.wait() != 0:
+                failed.append(name)
+            merge_step_profile(name)
+        if failed:
+            raise RuntimeError(f"Steps {failed} failed")
+        for step in ready:
+            done.add(step[0])
+            pending.remove(step)
+"""
+
+def flag_cal_script(ms_name, output_prefix, amp_cal, phase_cal):
+    """
+    CASA script that flags the calibrators and solves for the G0, K1, B1, AP.G and fluxscale tables.
+    The solves run as a task graph (task_graph_function): the AP.G solutions of the flux and the
+    phase calibrator only share K1 and B1, so they are solved side by side into separate tables
+    and merged for fluxscale. Both calibrators stay in one tfcrop pass, two flagdata runs on the
+    same MS would only queue up behind each other's table lock.
+    """
+    return f"""import shutil
+
+ms_name = '{ms_name}'
 output_pref = '{output_prefix}'
 amp_cal = '{amp_cal}'
 phase_cal = '{phase_cal}'
 
-# Flag the calibrators
-
-default(flagdata)
-flagdata(vis=ms_name,mode="tfcrop",datacolumn="data",field=amp_cal+','+phase_cal,ntime='2min',timecutoff=5.0,freqcutoff=5.0,timefit='line',freqfit='poly',flagdimension='freqtime',extendflags=False,timedevscale=5.0,
-freqdevscale=5.0,extendpols=False,growaround=False,action='apply',flagbackup=True,overwrite=True,writeflags=True)
-
-
 # Define calibration file names
 initial_ap = '{output_prefix}.G0'
 bp_file = '{output_prefix}.B1'
@@ -192,134 +796,353 @@ delay_file = '{output_prefix}.K1'
 fluxtable = '{output_prefix}.fluxscale'
 gainsol = '{output_prefix}.AP.G'
 
-# Set the Jy source for calibration
-setjy(vis=ms_name, field=amp_cal)
-
-# Perform gain calibration for amplitude
-default(gaincal)
-gaincal(vis=ms_name, caltable=initial_ap, field=amp_cal, refant='C02', gaintype="G", solmode="L1R", calmode='ap', 
-        solint='int', minsnr=3, interp=['nearest,nearestflag', 'nearest,nearestflag'], parang=True)
-
-# Perform gain calibration for delay
-default(gaincal)
-gaincal(vis=ms_name, caltable=delay_file, field=amp_cal, solint='120s', refant='C02', gaintype='K', 
-        gaintable=[initial_ap], parang=True)
-
-# Perform bandpass calibration
-default(bandpass)
-bandpass(vis=ms_name, caltable=bp_file, field=amp_cal, solint='inf', refant='C02', solnorm=True, minsnr=2.0, 
-         fillgaps=8, parang=True, gaintable=[delay_file, initial_ap], interp=['nearest,nearestflag', 'nearest,nearestflag'])
-
-# Perform final gain calibration with the bandpass and delay corrections
-default(gaincal)
-gaincal(vis=ms_name, caltable=gainsol, solnorm=False, append=False, field=amp_cal, solint='120s', refant='C02', 
-        minsnr=2.0, solmode='L1R', gaintype='G', calmode='ap', gaintable=[delay_file, bp_file], interp=['nearest,nearestflag', 'nearest,nearestflag'], parang=True)
-
-default(gaincal)
-gaincal(vis=ms_name, caltable=gainsol, solnorm=False, append=True, field=phase_cal, solint='120s', refant='C02', 
-        minsnr=2.0, solmode='L1R', gaintype='G', calmode='ap', gaintable=[delay_file, bp_file], interp=['nearest,nearestflag', 'nearest,nearestflag'], parang=True)
+{task_graph_function()}
+def merge_caltables(tables, merged):
+    shutil.rmtree(merged, ignore_errors=True)
+    tb.open(tables[0])
+    tb.copy(merged, deep=True, valuecopy=True)
+    tb.close()
+    for table in tables[1:]:
+        tb.open(table)
+        tb.copyrows(merged)
+        tb.close()
+    for table in tables:
+        shutil.rmtree(table)
+
+interp = ['nearest,nearestflag', 'nearest,nearestflag']
+final_gain = dict(vis=ms_name, solnorm=False, append=False, solint='120s', refant='C02', minsnr=2.0, solmode='L1R',
+                  gaintype='G', calmode='ap', gaintable=[delay_file, bp_file], interp=interp, parang=True)
+
+# (name, task, parameters, steps it needs)
+steps = [
+    # Flag the calibrators
+    ('tfcrop', 'flagdata', dict(vis=ms_name, mode="tfcrop", datacolumn="data", field=amp_cal+','+phase_cal, ntime='2min',
+                                timecutoff=5.0, freqcutoff=5.0, timefit='line', freqfit='poly', flagdimension='freqtime',
+                                extendflags=False, timedevscale=5.0, freqdevscale=5.0, extendpols=False, growaround=False,
+                                action='apply', flagbackup=True, overwrite=True, writeflags=True), []),
+    # Set the Jy source for calibration
+    ('setjy', 'setjy', dict(vis=ms_name, field=amp_cal), ['tfcrop']),
+    # Perform gain calibration for amplitude
+    ('G0', 'gaincal', dict(vis=ms_name, caltable=initial_ap, field=amp_cal, refant='C02', gaintype="G", solmode="L1R",
+                           calmode='ap', solint='int', minsnr=3, interp=interp, parang=True), ['setjy']),
+    # Perform gain calibration for delay
+    ('K1', 'gaincal', dict(vis=ms_name, caltable=delay_file, field=amp_cal, solint='120s', refant='C02', gaintype='K',
+                           gaintable=[initial_ap], parang=True), ['G0']),
+    # Perform bandpass calibration
+    ('B1', 'bandpass', dict(vis=ms_name, caltable=bp_file, field=amp_cal, solint='inf', refant='C02', solnorm=True,
+                            minsnr=2.0, fillgaps=8, parang=True, gaintable=[delay_file, initial_ap], interp=interp), ['K1']),
+    # Final gain calibration with the bandpass and delay corrections, one table per calibrator
+    ('AP.G amp', 'gaincal', dict(final_gain, caltable=gainsol+'.amp', field=amp_cal), ['K1', 'B1']),
+    ('AP.G phase', 'gaincal', dict(final_gain, caltable=gainsol+'.phase', field=phase_cal), ['K1', 'B1']),
+]
+run_steps(steps)
+merge_caltables([gainsol+'.amp', gainsol+'.phase'], gainsol)
 
 # Perform flux scaling
 scale = fluxscale(vis=ms_name, caltable=gainsol, fluxtable=fluxtable, reference=amp_cal, transfer=phase_cal, incremental=False, display=True)
 
 """
 
+def flag_cal(ms_name, subband, output_prefix, casa_dir, logger, amp_cal, phase_cal, depend=None, resources=None):
+    """
+    Create a PBS script for the given subband and submit it to the queue.
+    depend is an optional list of job IDs this job has to wait for.
+    resources overrides the job size worked out by growth.size_stage.
+    """
+    python_script_content = flag_cal_script(ms_name, output_prefix, amp_cal, phase_cal)
+    python_script_content = profiled_script(python_script_content, subband, subband, 'flag_cal')
+
     python_script_file = f"run_flag_cal_{subband}.py"
     with open(python_script_file, "w") as file:
         file.write(python_script_content)
 
     working_dir = os.getcwd()
+    sentinel_file = sentinel_file_path(subband, subband, 'flag_cal')
+    runtime_file = runtime_file_path(subband, subband, 'flag_cal')
+    live_log = live_log_file_path(subband, subband, 'flag_cal')
+    resources = stage_resources('flag_cal', ms_name, subband, subband, logger, resources)
+    staged = staged_paths([ms_name], [os.path.dirname(output_prefix), python_script_file])
+    clear_sentinel(sentinel_file, logger)
     pbs_script_content = f"""#!/bin/bash
 #PBS -N flag_cal_{subband}
-#PBS -l nodes=1:ppn=6
-#PBS -l walltime=10:00:00
+#PBS -l nodes=1:ppn={resources['ppn']}
+#PBS -l mem={resources['mem_gb']}gb
+#PBS -l walltime={resources['walltime']}
 #PBS -j oe
 #PBS -o {subband}/flag_cal_{subband}.log
 #PBS -q workq
 
 cd {working_dir}
+{exit_trap(sentinel_file, runtime_file, working_dir, staged)}
+exec > {live_log} 2>&1
 source ~/.bashrc
 micromamba activate 38data
-{casa_dir}/bin/casa -n 6 {casa_dir}/bin/casa --nologger --nogui --nologfile -c {python_script_file}
+{stage_in(f'flag_cal_{subband}', staged)}{casa_command(casa_dir, python_script_file, resources['ranks'])}
 """
 
     pbs_script_file = f"flag_cal_{subband}.pbs"
     with open(pbs_script_file, "w") as file:
         file.write(pbs_script_content)
 
-    submit_command = f"qsub {pbs_script_file}"
-    logger.info(f"Submitting PBS script for {subband} with command: {submit_command}")
-    try:
-        result = subprocess.run(submit_command, shell=True, stdout=subprocess.PIPE, stderr=subprocess.PIPE, check=True)
-        job_id = result.stdout.decode().strip()  # Job ID is the output from qsub
-        logger.info(f"PBS flagcal script for {subband} submitted successfully with job ID: {job_id}")
-        return job_id, subband
-    except subprocess.CalledProcessError as e:
-        logger.error(f"Failed to submit PBS script for {subband}: {e}")
-        return None, subband
+    return submit_pbs_script(pbs_script_file, subband, logger, depend)
     
 
 
 
 
-def flag_src(ms_name, subband,casa_dir, logger, src):
+# Polarization model of the flux calibrators for the Xf solve: Stokes I from the Perley-Butler 2017
+# polynomial (log10 S in Jy against log10 of the frequency in GHz), fractional polarization and position
+# angle from Perley & Butler 2013, taken as constant over the band.
+POL_MODELS = {
+    '3C286': {'coeffs': (1.2481, -0.4507, -0.1798, 0.0357), 'polfrac': 0.086, 'polangle_deg': 33.0},
+}
+
+def pol_tables_of(output_prefix):
     """
-    Create a PBS script for the given subband and submit it to the queue.
+    The tables of pol_cal_script, in the order they are solved and applied.
+    """
+    return [f'{output_prefix}.Kcross', f'{output_prefix}.Df', f'{output_prefix}.Xf']
+
+def pol_cal_script(ms_name, output_prefix, pol_cal, leak_cal, refant='C02', leak_poltype='Df'):
+    """
+    CASA script that solves the polarization tables on top of the tables of flag_cal: the cross-hand
+    delay (Kcross) and phase (Xf) on pol_cal, a source of POL_MODELS, and the leakage (Df) on leak_cal.
+    leak_poltype is 'Df' for an unpolarized leak_cal, 'Df+QU' for a polarized one with enough
+    parallactic angle coverage, which has its Q and U solved at the same time.
+    """
+    if pol_cal not in POL_MODELS:
+        raise ValueError(f"No polarization model for {pol_cal}, known are {sorted(POL_MODELS)}")
+    if leak_poltype not in ('Df', 'Df+QU'):
+        raise ValueError(f"Unknown leak_poltype: {leak_poltype}")
+    kcross, leakage, xf = pol_tables_of(output_prefix)
+    return f"""import math
+import shutil
+import numpy as np
+
+ms_name = '{ms_name}'
+pol_cal = '{pol_cal}'
+leak_cal = '{leak_cal}'
+refant = '{refant}'
+model = {POL_MODELS[pol_cal]!r}
+
+# Define calibration file names
+bp_file = '{output_prefix}.B1'
+delay_file = '{output_prefix}.K1'
+fluxtable = '{output_prefix}.fluxscale'
+kcross = '{kcross}'
+leakage = '{leakage}'
+xf = '{xf}'
+
+for table in (kcross, leakage, xf):
+    shutil.rmtree(table, ignore_errors=True)
+
+# Full-Stokes model of the polarization calibrator at the centre of the subband
+msmd.open(ms_name)
+reffreq = float(np.mean(msmd.chanfreqs(0)))
+msmd.close()
+x = math.log10(reffreq / 1e9)
+a = model['coeffs']
+flux = 10 ** (a[0] + a[1] * x + a[2] * x**2 + a[3] * x**3)
+spix = a[1] + 2 * a[2] * x + 3 * a[3] * x**2
+setjy(vis=ms_name, field=pol_cal, standard='manual', fluxdensity=[flux, 0, 0, 0], spix=[spix], reffreq=f'{{reffreq}}Hz',
+      polindex=[model['polfrac']], polangle=[math.radians(model['polangle_deg'])], usescratch=True)
+
+def pre_apply(field, tables=()):
+    return dict(gaintable=[fluxtable, delay_file, bp_file] + list(tables), gainfield=[field, '', ''] + [''] * len(tables))
+
+# Cross-hand delay on the polarized calibrator
+gaincal(vis=ms_name, caltable=kcross, field=pol_cal, gaintype='KCROSS', solint='inf', combine='scan', refant=refant,
+        parang=True, **pre_apply(pol_cal))
+
+# Leakage, per channel
+polcal(vis=ms_name, caltable=leakage, field=leak_cal, poltype='{leak_poltype}', solint='inf', combine='scan', refant=refant,
+       **pre_apply(leak_cal, [kcross]))
+
+# Cross-hand phase, per channel, against the position angle of the model
+polcal(vis=ms_name, caltable=xf, field=pol_cal, poltype='Xf', solint='inf', combine='scan', refant=refant,
+       **pre_apply(pol_cal, [kcross, leakage]))
+"""
+
+def pol_cal(ms_name, subband, output_prefix, casa_dir, logger, pol_cal, leak_cal, depend=None, resources=None,
+            refant='C02', leak_poltype='Df'):
+    """
+    Create a PBS script that solves the polarization tables of the given subband (see pol_cal_script)
+    and submit it to the queue. It only needs the tables of flag_cal, so it runs next to flag_src.
+    depend is an optional list of job IDs this job has to wait for.
+    resources overrides the job size worked out by growth.size_stage.
+    """
+    python_script_content = pol_cal_script(ms_name, output_prefix, pol_cal, leak_cal, refant, leak_poltype)
+    python_script_content = profiled_script(python_script_content, subband, subband, 'pol_cal')
+
+    python_script_file = f"run_pol_cal_{subband}.py"
+    with open(python_script_file, "w") as file:
+        file.write(python_script_content)
+
+    working_dir = os.getcwd()
+    sentinel_file = sentinel_file_path(subband, subband, 'pol_cal')
+    runtime_file = runtime_file_path(subband, subband, 'pol_cal')
+    live_log = live_log_file_path(subband, subband, 'pol_cal')
+    resources = stage_resources('pol_cal', ms_name, subband, subband, logger, resources)
+    staged = staged_paths([ms_name], [os.path.dirname(output_prefix), python_script_file])
+    clear_sentinel(sentinel_file, logger)
+    pbs_script_content = f"""#!/bin/bash
+#PBS -N pol_cal_{subband}
+#PBS -l nodes=1:ppn={resources['ppn']}
+#PBS -l mem={resources['mem_gb']}gb
+#PBS -l walltime={resources['walltime']}
+#PBS -j oe
+#PBS -o {subband}/pol_cal_{subband}.log
+#PBS -q workq
+
+cd {working_dir}
+{exit_trap(sentinel_file, runtime_file, working_dir, staged)}
+exec > {live_log} 2>&1
+source ~/.bashrc
+micromamba activate 38data
+{stage_in(f'pol_cal_{subband}', staged)}{casa_command(casa_dir, python_script_file, resources['ranks'])}
+"""
+
+    pbs_script_file = f"pol_cal_{subband}.pbs"
+    with open(pbs_script_file, "w") as file:
+        file.write(pbs_script_content)
+
+    return submit_pbs_script(pbs_script_file, subband, logger, depend)
+
+
+
+# The tfcrop run of flag_src; flag_cal runs the same one on the calibrators
+TFCROP = {
+    'mode': 'tfcrop', 'datacolumn': 'data', 'ntime': '2min', 'timecutoff': 5.0, 'freqcutoff': 5.0,
+    'timefit': 'line', 'freqfit': 'poly', 'flagdimension': 'freqtime', 'extendflags': False,
+    'timedevscale': 5.0, 'freqdevscale': 5.0, 'extendpols': False, 'growaround': False,
+}
+
+# Where this file is, so scripts run by CASA can import the native flagger (slash.py)
+PIPELINE_DIR = os.path.dirname(os.path.abspath(__file__))
+
+FLAGGERS = ('casa', 'native')
+
+def native_flag_script(flag_passes):
     """
-    python_script_content = f"""ms_name = '{ms_name}'
+    Script that runs flag passes, a list of (vis, [flagdata parameter dicts]), with the native flagger
+    (slash.flag_ms) instead of flagdata. It runs in a single process that spreads over the cores of the job.
+    The flags of every MS are saved with flagmanager first, as flagdata does with flagbackup=True.
+    """
+    return f"""import logging
+import sys
+import time
+sys.path.insert(0, '{PIPELINE_DIR}')
+from slash import flag_ms
+
+logging.basicConfig(level=logging.INFO, format='%(asctime)s %(levelname)s %(message)s')
+
+flag_passes = {flag_passes!r}
+
+for vis, passes in flag_passes:
+    flagmanager(vis=vis, mode='save', versionname=time.strftime('native_flagger_%Y%m%d_%H%M%S'),
+                comment='Flags before the native flagger')
+    flag_ms(vis, passes)
+"""
+
+def flag_src_script(ms_name, src, flagger='casa'):
+    """
+    CASA script that runs tfcrop on the source, with flagdata or with the native flagger
+    (flagger='native'). src.ms only has the source, so the native flagger needs no field selection.
+    """
+    if flagger not in FLAGGERS:
+        raise ValueError(f"Unknown flagger: {flagger}")
+    if flagger == 'native':
+        return native_flag_script([(ms_name, [TFCROP])])
+    return f"""ms_name = '{ms_name}'
 
 src = '{src}'
 
-# Flag the calibrators
+# Flag the source
 
 default(flagdata)
-flagdata(vis=ms_name,mode="tfcrop",datacolumn="data",field=src,ntime='2min',timecutoff=5.0,freqcutoff=5.0,timefit='line',freqfit='poly',flagdimension='freqtime',extendflags=False,timedevscale=5.0,
-freqdevscale=5.0,extendpols=False,growaround=False,action='apply',flagbackup=True,overwrite=True,writeflags=True)
+flagdata(vis=ms_name,field=src,action='apply',flagbackup=True,overwrite=True,writeflags=True,**{TFCROP!r})
 
 """
 
+def job_ranks(resources, flagger='casa'):
+    """
+    CASA processes of a job: the native flagger runs in one process whatever the job was sized for.
+    """
+    return 1 if flagger == 'native' else resources['ranks']
+
+def flag_src(ms_name, subband,casa_dir, logger, src, depend=None, resources=None, flagger='casa'):
+    """
+    Create a PBS script for the given subband and submit it to the queue.
+    depend is an optional list of job IDs this job has to wait for.
+    resources overrides the job size worked out by growth.size_stage.
+    flagger picks flagdata ('casa') or the native flagger ('native') for the tfcrop run.
+    """
+    python_script_content = flag_src_script(ms_name, src, flagger)
+    python_script_content = profiled_script(python_script_content, subband, subband, 'flag_src')
+
     python_script_file = f"run_flag_src_{subband}.py"
     with open(python_script_file, "w") as file:
         file.write(python_script_content)
 
     working_dir = os.getcwd()
+    sentinel_file = sentinel_file_path(subband, subband, 'flag_src')
+    runtime_file = runtime_file_path(subband, subband, 'flag_src')
+    live_log = live_log_file_path(subband, subband, 'flag_src')
+    resources = stage_resources('flag_src', ms_name, subband, subband, logger, resources)
+    staged = staged_paths([ms_name], [python_script_file])
+    clear_sentinel(sentinel_file, logger)
     pbs_script_content = f"""#!/bin/bash
 #PBS -N flag_src_{subband}
-#PBS -l nodes=1:ppn=6
-#PBS -l walltime=10:00:00
+#PBS -l nodes=1:ppn={resources['ppn']}
+#PBS -l mem={resources['mem_gb']}gb
+#PBS -l walltime={resources['walltime']}
 #PBS -j oe
 #PBS -o {subband}/flag_src_{subband}.log
 #PBS -q workq
 
 cd {working_dir}
+{exit_trap(sentinel_file, runtime_file, working_dir, staged)}
+exec > {live_log} 2>&1
 source ~/.bashrc
 micromamba activate 38data
-{casa_dir}/bin/casa -n 6 {casa_dir}/bin/casa --nologger --nogui --nologfile -c {python_script_file}
+{stage_in(f'flag_src_{subband}', staged)}{casa_command(casa_dir, python_script_file, job_ranks(resources, flagger))}
 """
 
     pbs_script_file = f"flag_src_{subband}.pbs"
     with open(pbs_script_file, "w") as file:
         file.write(pbs_script_content)
 
-    submit_command = f"qsub {pbs_script_file}"
-    logger.info(f"Submitting PBS script for {subband} with command: {submit_command}")
-    try:
-        result = subprocess.run(submit_command, shell=True, stdout=subprocess.PIPE, stderr=subprocess.PIPE, check=True)
-        job_id = result.stdout.decode().strip()  # Job ID is the output from qsub
-        logger.info(f"PBS flag_src script for {subband} submitted successfully with job ID: {job_id}")
-        return job_id, subband
-    except subprocess.CalledProcessError as e:
-        logger.error(f"Failed to submit PBS script for {subband}: {e}")
-        return None, subband
+    return submit_pbs_script(pbs_script_file, subband, logger, depend)
 
 
 
 
-def apply_cal(ms_name1,ms_name2, subband, output_prefix, casa_dir, logger, amp_cal, phase_cal,src):
+def part_prefix(stage, targets):
     """
-    Create a PBS script for the given subband and submit it to the queue.
+    Job prefix of a stage that only works on some of the MSs of a subband: apply_cal for both,
+    apply_cal_cal for the calibrators only, apply_cal_src for the source only.
+    """
+    if set(targets) == {'cal', 'src'}:
+        return stage
+    return f"{stage}_{'_'.join(targets)}"
+
+def target_ms_names(ms_name1, ms_name2, targets):
+    """
+    The MSs a job with these targets works on, what it has to stage (see use_staging).
     """
-    python_script_content = f"""ms_name1 = '{ms_name1}'
+    return [ms_name for ms, ms_name in (('cal', ms_name1), ('src', ms_name2)) if ms in targets]
+
+def apply_cal_script(ms_name1, ms_name2, output_prefix, amp_cal, phase_cal, src, targets=('cal', 'src'), polcal=False):
+    """
+    CASA script that applies the calibration tables to the calibrators ('cal' in targets) and the
+    source ('src' in targets). The two only need the same tables, so they can run as separate jobs.
+    With polcal the Kcross, Df and Xf tables of pol_cal_script go on top of the others.
+    """
+    # The polarization tables hold one solution for the whole run, they apply to every field as they are
+    pol_tables = f"+{pol_tables_of(output_prefix)!r}" if polcal else ""
+    pol_fields = "+['', '', '']" if polcal else ""
+    pol_interp = "+['', 'nearest', 'nearest', 'nearest']" if polcal else ""
+    script = f"""ms_name1 = '{ms_name1}'
 ms_name2 = '{ms_name2}'
 output_pref = '{output_prefix}'
 amp_cal = '{amp_cal}'
@@ -333,141 +1156,646 @@ bp_file = '{output_prefix}.B1'
 delay_file = '{output_prefix}.K1'
 fluxtable = '{output_prefix}.fluxscale'
 gainsol = '{output_prefix}.AP.G'
-
+"""
+    if 'cal' in targets:
+        script += f"""
 default(applycal)
-applycal(vis=ms_name1,field=amp_cal,gaintable=[fluxtable,delay_file,bp_file],
-gainfield=[amp_cal,amp_cal,amp_cal],interp=['nearest',","],calwt=False,parang=True)
+applycal(vis=ms_name1,field=amp_cal,gaintable=[fluxtable,delay_file,bp_file]{pol_tables},
+gainfield=[amp_cal,amp_cal,amp_cal]{pol_fields},interp=['nearest',","]{pol_interp},calwt=False,parang=True)
 
 default(applycal)
-applycal(vis=ms_name1,field=phase_cal,gaintable=[fluxtable,delay_file,bp_file],
-gainfield=[phase_cal,amp_cal,amp_cal],interp=['nearest','nearest'],calwt=False,parang=True)
+applycal(vis=ms_name1,field=phase_cal,gaintable=[fluxtable,delay_file,bp_file]{pol_tables},
+gainfield=[phase_cal,amp_cal,amp_cal]{pol_fields},interp=['nearest','nearest']{pol_interp},calwt=False,parang=True)
+"""
+    if 'src' in targets:
+        script += f"""
 default(applycal)
-applycal(vis=ms_name2,field=src,gaintable=[fluxtable,delay_file,bp_file],
-gainfield=[phase_cal,amp_cal,amp_cal],interp=['nearest','linear'],calwt=False,parang=True)
+applycal(vis=ms_name2,field=src,gaintable=[fluxtable,delay_file,bp_file]{pol_tables},
+gainfield=[phase_cal,amp_cal,amp_cal]{pol_fields},interp=['nearest','linear']{pol_interp},calwt=False,parang=True)
 """
+    return script
+
+def apply_cal(ms_name1,ms_name2, subband, output_prefix, casa_dir, logger, amp_cal, phase_cal,src, depend=None, resources=None,
+              targets=('cal', 'src'), polcal=False):
+    """
+    Create a PBS script for the given subband and submit it to the queue.
+    depend is an optional list of job IDs this job has to wait for.
+    resources overrides the job size worked out by growth.size_stage.
+    targets picks the MSs to calibrate, see apply_cal_script; the job prefix follows part_prefix.
+    polcal adds the polarization tables of pol_cal.
+    """
+    prefix = part_prefix('apply_cal', targets)
+    python_script_content = apply_cal_script(ms_name1, ms_name2, output_prefix, amp_cal, phase_cal, src, targets, polcal)
+    python_script_content = profiled_script(python_script_content, subband, subband, prefix)
 
-    python_script_file = f"run_apply_cal_{subband}.py"
+    python_script_file = f"run_{prefix}_{subband}.py"
     with open(python_script_file, "w") as file:
         file.write(python_script_content)
 
     working_dir = os.getcwd()
+    sentinel_file = sentinel_file_path(subband, subband, prefix)
+    runtime_file = runtime_file_path(subband, subband, prefix)
+    live_log = live_log_file_path(subband, subband, prefix)
+    sizing_ms = ms_name2 if 'src' in targets else ms_name1
+    resources = stage_resources('apply_cal', sizing_ms, subband, subband, logger, resources, prefix)
+    staged = staged_paths(target_ms_names(ms_name1, ms_name2, targets), [os.path.dirname(output_prefix), python_script_file])
+    clear_sentinel(sentinel_file, logger)
     pbs_script_content = f"""#!/bin/bash
-#PBS -N apply_cal_{subband}
-#PBS -l nodes=1:ppn=6
-#PBS -l walltime=10:00:00
+#PBS -N {prefix}_{subband}
+#PBS -l nodes=1:ppn={resources['ppn']}
+#PBS -l mem={resources['mem_gb']}gb
+#PBS -l walltime={resources['walltime']}
 #PBS -j oe
-#PBS -o {subband}/apply_{subband}.log
+#PBS -o {subband}/{prefix.replace('apply_cal', 'apply')}_{subband}.log
 #PBS -q workq
 
 cd {working_dir}
+{exit_trap(sentinel_file, runtime_file, working_dir, staged)}
+exec > {live_log} 2>&1
 source ~/.bashrc
 micromamba activate 38data
-{casa_dir}/bin/casa -n 6 {casa_dir}/bin/casa --nologger --nogui --nologfile -c {python_script_file}
+{stage_in(f'{prefix}_{subband}', staged)}{casa_command(casa_dir, python_script_file, resources['ranks'])}
 """
 
-    pbs_script_file = f"apply_cal_{subband}.pbs"
+    pbs_script_file = f"{prefix}_{subband}.pbs"
     with open(pbs_script_file, "w") as file:
         file.write(pbs_script_content)
 
-    submit_command = f"qsub {pbs_script_file}"
-    logger.info(f"Submitting PBS script for {subband} with command: {submit_command}")
-    try:
-        result = subprocess.run(submit_command, shell=True, stdout=subprocess.PIPE, stderr=subprocess.PIPE, check=True)
-        job_id = result.stdout.decode().strip()  # Job ID is the output from qsub
-        logger.info(f"PBS apply_cal script for {subband} submitted successfully with job ID: {job_id}")
-        return job_id, subband
-    except subprocess.CalledProcessError as e:
-        logger.error(f"Failed to submit PBS script for {subband}: {e}")
-        return None, subband
+    return submit_pbs_script(pbs_script_file, subband, logger, depend)
     
 
 
-def flag_after_cal(ms_name1, ms_name2, subband,casa_dir, logger):
+# rflag settings shared by every pass in flag_after_cal
+RFLAG_AFTER_CAL = {
+    'mode': 'rflag', 'datacolumn': 'corrected', 'timecutoff': 5.0, 'freqcutoff': 5.0,
+    'timefit': 'line', 'freqfit': 'poly', 'flagdimension': 'freqtime', 'extendflags': False,
+    'timedevscale': 4.0, 'freqdevscale': 4.0, 'extendpols': False, 'growaround': False,
+}
+
+# The rflag passes of flag_after_cal as (ms, ntime, uvrange), ms is 'cal' or 'src'
+RFLAG_AFTER_CAL_PASSES = [
+    ('cal', '2min', ''),
+    ('cal', '1min', ''),
+    ('src', '2min', '0~1klambda'),
+    ('src', '2min', '1~3klambda'),
+    ('src', '2min', '3~5klambda'),
+    ('src', '2min', '>5klambda'),
+    ('src', '1min', '0~1klambda'),
+    ('src', '1min', '1~3klambda'),
+    ('src', '1min', '3~5klambda'),
+    ('src', '1min', '>5klambda'),
+]
+
+def flag_command(params):
     """
-    Create a PBS script for the given subband and submit it to the queue.
+    Turn a dict of flagdata parameters into a command line for flagdata(mode='list').
     """
-    python_script_content = f"""ms_name1 = '{ms_name1}'
+    return " ".join(f"{key}={value!r}" for key, value in params.items())
+
+def group_flag_commands(ms_names, passes, params):
+    """
+    Collect the flag passes into one list of commands per MS and ntime, keeping the order of passes.
+    Commands in one flagdata(mode='list') call share the data iteration, so all uvrange bins of a
+    time scale are flagged in one pass over the data. ms_names maps the ms key of a pass to a path.
+    Returns a list of (vis, [commands]).
+    """
+    groups = {}
+    for ms, ntime, uvrange in passes:
+        command = dict(params, ntime=ntime)
+        if uvrange:
+            command['uvrange'] = uvrange
+        groups.setdefault((ms_names[ms], ntime), []).append(flag_command(command))
+    return [(vis, commands) for (vis, _), commands in groups.items()]
+
+def flag_after_cal_script(ms_name1, ms_name2, targets=('cal', 'src'), flagger='casa'):
+    """
+    CASA script that runs the rflag passes on the calibrated data of the MSs in targets,
+    with flagdata or with the native flagger (flagger='native').
+    """
+    if flagger not in FLAGGERS:
+        raise ValueError(f"Unknown flagger: {flagger}")
+    passes = [flag_pass for flag_pass in RFLAG_AFTER_CAL_PASSES if flag_pass[0] in targets]
+    if flagger == 'native':
+        ms_names = {'cal': ms_name1, 'src': ms_name2}
+        flag_passes = [(ms_names[ms], [dict(RFLAG_AFTER_CAL, ntime=ntime, uvrange=uvrange)
+                                       for pass_ms, ntime, uvrange in passes if pass_ms == ms])
+                       for ms in ('cal', 'src') if ms in targets]
+        return native_flag_script(flag_passes)
+    flag_groups = group_flag_commands({'cal': ms_name1, 'src': ms_name2}, passes, RFLAG_AFTER_CAL)
+    return f"""ms_name1 = '{ms_name1}'
 
 ms_name2 = '{ms_name2}'
 
-# Flag the calibrators
-default(flagdata)
-flagdata(vis=ms_name1,mode="rflag",datacolumn="corrected",ntime='2min',timecutoff=5.0,freqcutoff=5.0,timefit='line',freqfit='poly',flagdimension='freqtime',extendflags=False,timedevscale=4.0,
-freqdevscale=4.0,extendpols=False,growaround=False,action='apply',flagbackup=True,overwrite=True,writeflags=True)
+# One list-mode flagdata call per MS and time scale, all uvrange bins go in the same pass.
+# Only the first call on each MS backs up the flags.
+flag_groups = {flag_groups!r}
 
-default(flagdata)
-flagdata(vis=ms_name1,mode="rflag",datacolumn="corrected",ntime='1min',timecutoff=5.0,freqcutoff=5.0,timefit='line',freqfit='poly',flagdimension='freqtime',extendflags=False,timedevscale=4.0,
-freqdevscale=4.0,extendpols=False,growaround=False,action='apply',flagbackup=True,overwrite=True,writeflags=True)
+backed_up = set()
+for vis, commands in flag_groups:
+    default(flagdata)
+    flagdata(vis=vis, mode='list', inpfile=commands, action='apply', flagbackup=vis not in backed_up)
+    backed_up.add(vis)
+"""
 
-#Flag the source
+def flag_after_cal(ms_name1, ms_name2, subband,casa_dir, logger, depend=None, resources=None, targets=('cal', 'src'),
+                   flagger='casa'):
+    """
+    Create a PBS script for the given subband and submit it to the queue.
+    depend is an optional list of job IDs this job has to wait for.
+    resources overrides the job size worked out by growth.size_stage.
+    targets picks the MSs to flag, the job prefix follows part_prefix.
+    flagger picks flagdata ('casa') or the native flagger ('native') for the rflag passes.
+    """
+    prefix = part_prefix('flag_after_cal', targets)
+    python_script_content = flag_after_cal_script(ms_name1, ms_name2, targets, flagger)
+    python_script_content = profiled_script(python_script_content, subband, subband, prefix)
 
-default(flagdata)
-flagdata(vis=ms_name2,mode="rflag",datacolumn="corrected",ntime='2min',timecutoff=5.0,freqcutoff=5.0,timefit='line',freqfit='poly',flagdimension='freqtime',extendflags=False,timedevscale=4.0, uvrange='0~1klambda',
-freqdevscale=4.0,extendpols=False,growaround=False,action='apply',flagbackup=True,overwrite=True,writeflags=True)
+    python_script_file = f"run_{prefix}_{subband}.py"
+    with open(python_script_file, "w") as file:
+        file.write(python_script_content)
 
-default(flagdata)
-flagdata(vis=ms_name2,mode="rflag",datacolumn="corrected",ntime='2min',timecutoff=5.0,freqcutoff=5.0,timefit='line',freqfit='poly',flagdimension='freqtime',extendflags=False,timedevscale=4.0, uvrange='1~3klambda',
-freqdevscale=4.0,extendpols=False,growaround=False,action='apply',flagbackup=True,overwrite=True,writeflags=True)
+    working_dir = os.getcwd()
+    sentinel_file = sentinel_file_path(subband, subband, prefix)
+    runtime_file = runtime_file_path(subband, subband, prefix)
+    live_log = live_log_file_path(subband, subband, prefix)
+    sizing_ms = ms_name2 if 'src' in targets else ms_name1
+    resources = stage_resources('flag_after_cal', sizing_ms, subband, subband, logger, resources, prefix)
+    staged = staged_paths(target_ms_names(ms_name1, ms_name2, targets), [python_script_file])
+    clear_sentinel(sentinel_file, logger)
+    pbs_script_content = f"""#!/bin/bash
+#PBS -N {prefix}_{subband}
+#PBS -l nodes=1:ppn={resources['ppn']}
+#PBS -l mem={resources['mem_gb']}gb
+#PBS -l walltime={resources['walltime']}
+#PBS -j oe
+#PBS -o {subband}/{prefix}_{subband}.log
+#PBS -q workq
 
-default(flagdata)
-flagdata(vis=ms_name2,mode="rflag",datacolumn="corrected",ntime='2min',timecutoff=5.0,freqcutoff=5.0,timefit='line',freqfit='poly',flagdimension='freqtime',extendflags=False,timedevscale=4.0, uvrange='3~5klambda',
-freqdevscale=4.0,extendpols=False,growaround=False,action='apply',flagbackup=True,overwrite=True,writeflags=True)
+cd {working_dir}
+{exit_trap(sentinel_file, runtime_file, working_dir, staged)}
+exec > {live_log} 2>&1
+source ~/.bashrc
+micromamba activate 38data
+{stage_in(f'{prefix}_{subband}', staged)}{casa_command(casa_dir, python_script_file, job_ranks(resources, flagger))}
+"""
 
-default(flagdata)
-flagdata(vis=ms_name2,mode="rflag",datacolumn="corrected",ntime='2min',timecutoff=5.0,freqcutoff=5.0,timefit='line',freqfit='poly',flagdimension='freqtime',extendflags=False,timedevscale=4.0, uvrange='>5klambda',
-freqdevscale=4.0,extendpols=False,growaround=False,action='apply',flagbackup=True,overwrite=True,writeflags=True)
+    pbs_script_file = f"{prefix}_{subband}.pbs"
+    with open(pbs_script_file, "w") as file:
+        file.write(pbs_script_content)
 
-# ntime = 1min .....
+    return submit_pbs_script(pbs_script_file, subband, logger, depend)
 
-default(flagdata)
-flagdata(vis=ms_name2,mode="rflag",datacolumn="corrected",ntime='1min',timecutoff=5.0,freqcutoff=5.0,timefit='line',freqfit='poly',flagdimension='freqtime',extendflags=False,timedevscale=4.0, uvrange='0~1klambda',
-freqdevscale=4.0,extendpols=False,growaround=False,action='apply',flagbackup=True,overwrite=True,writeflags=True)
 
-default(flagdata)
-flagdata(vis=ms_name2,mode="rflag",datacolumn="corrected",ntime='1min',timecutoff=5.0,freqcutoff=5.0,timefit='line',freqfit='poly',flagdimension='freqtime',extendflags=False,timedevscale=4.0, uvrange='1~3klambda',
-freqdevscale=4.0,extendpols=False,growaround=False,action='apply',flagbackup=True,overwrite=True,writeflags=True)
 
-default(flagdata)
-flagdata(vis=ms_name2,mode="rflag",datacolumn="corrected",ntime='1min',timecutoff=5.0,freqcutoff=5.0,timefit='line',freqfit='poly',flagdimension='freqtime',extendflags=False,timedevscale=4.0, uvrange='3~5klambda',
-freqdevscale=4.0,extendpols=False,growaround=False,action='apply',flagbackup=True,overwrite=True,writeflags=True)
+# tclean settings of the per-subband images. uGMRT fields are wide enough for the w-term to matter, so the
+# default gridder is wproject with the number of w-planes worked out by tclean; facets > 1 switches to the
+# widefield gridder (facets plus w-projection). mtmfs with two terms absorbs the spectral index across a subband.
+IMAGING = {
+    'imsize': 4096, 'cell': '1.0arcsec', 'specmode': 'mfs', 'deconvolver': 'mtmfs', 'nterms': 2,
+    'scales': [0, 5, 15], 'gridder': 'wproject', 'wprojplanes': -1, 'facets': 1, 'pblimit': -1,
+    'weighting': 'briggs', 'robust': 0.0, 'niter': 20000, 'threshold': '0.1mJy', 'cyclefactor': 1.5,
+    'stokes': 'I',
+}
 
-default(flagdata)
-flagdata(vis=ms_name2,mode="rflag",datacolumn="corrected",ntime='1min',timecutoff=5.0,freqcutoff=5.0,timefit='line',freqfit='poly',flagdimension='freqtime',extendflags=False,timedevscale=4.0, uvrange='>5klambda',
-freqdevscale=4.0,extendpols=False,growaround=False,action='apply',flagbackup=True,overwrite=True,writeflags=True)
+IMAGERS = ('tclean', 'wsclean')
+
+def imaging_params(params=None):
+    """
+    The IMAGING settings with params on top, as tclean parameters.
+    """
+    params = dict(IMAGING, **(params or {}))
+    if params['facets'] > 1 and params['gridder'] in ('standard', 'wproject'):
+        params['gridder'] = 'widefield'
+    return params
+
+def image_product(imagename, imager='tclean', params=None):
+    """
+    The restored image a subband job leaves behind, the input of the wideband combination.
+    """
+    params = imaging_params(params)
+    if imager == 'wsclean':
+        return f"{imagename}-MFS-image.fits" if wsclean_channels(params) > 1 else f"{imagename}-image.fits"
+    if params['deconvolver'] == 'mtmfs':
+        return f"{imagename}.image.tt0"
+    return f"{imagename}.image"
+
+def wsclean_channels(params):
+    # Output channels for wsclean to fit the spectral polynomial across, the counterpart of mtmfs nterms
+    if params['deconvolver'] == 'mtmfs' and params['nterms'] > 1:
+        return 2 * params['nterms']
+    return 1
+
+def quantity_value(quantity, units):
+    """
+    Split a CASA quantity like '1.5arcsec' or '0.1mJy' and scale it with units, a dict of unit to factor.
+    """
+    for unit, factor in sorted(units.items(), key=lambda item: -len(item[0])):
+        if quantity.endswith(unit):
+            return float(quantity[:-len(unit)]) * factor
+    raise ValueError(f"Cannot read {quantity!r}, expected one of the units {sorted(units)}")
+
+def wsclean_command(ms_name, imagename, params=None, threads=1):
+    """
+    wsclean command line with the same image as tclean would make from the IMAGING settings. wsclean grids
+    with the w-gridder on all threads of the job and deconvolves sub-images side by side.
+    """
+    params = imaging_params(params)
+    cell = quantity_value(params['cell'], {'arcsec': 1.0, 'arcmin': 60.0, 'deg': 3600.0})
+    threshold = quantity_value(params['threshold'], {'Jy': 1.0, 'mJy': 1e-3, 'uJy': 1e-6})
+    command = [
+        'wsclean', '-name', imagename, '-j', str(threads), '-parallel-gridding', str(threads),
+        '-parallel-deconvolution', str(max(256, params['imsize'] // 4)), '-use-wgridder',
+        '-size', str(params['imsize']), str(params['imsize']), '-scale', f"{cell}asec",
+        '-niter', str(params['niter']), '-threshold', str(threshold), '-mgain', '0.8',
+        '-data-column', 'CORRECTED_DATA', '-pol', params['stokes'].lower(),
+    ]
+    if params['weighting'] == 'briggs':
+        command += ['-weight', 'briggs', str(params['robust'])]
+    else:
+        command += ['-weight', params['weighting']]
+    if params['deconvolver'] in ('multiscale', 'mtmfs') and len(params['scales']) > 1:
+        command += ['-multiscale', '-multiscale-scales', ','.join(str(scale) for scale in params['scales'])]
+    channels = wsclean_channels(params)
+    if channels > 1:
+        command += ['-channels-out', str(channels), '-join-channels', '-fit-spectral-pol', str(params['nterms'])]
+    return ' '.join(command + [ms_name])
+
+def image_script(ms_name, imagename, params=None):
+    """
+    CASA script that images the corrected source data of one subband with tclean. Under mpicasa the
+    major cycles run in parallel over the sub-MSs (parallel=True), in a single CASA process they run serially.
+    """
+    params = imaging_params(params)
+    return f"""import glob
+import os
+import shutil
+
+ms_name = '{ms_name}'
+imagename = '{imagename}'
+params = {params!r}
 
+try:
+    from casampi.MPIEnvironment import MPIEnvironment
+    parallel = MPIEnvironment.is_mpi_enabled
+except ImportError:
+    parallel = False
 
+# tclean carries on from the products of an earlier run, start from scratch
+os.makedirs(os.path.dirname(imagename) or '.', exist_ok=True)
+for product in glob.glob(imagename + '.*'):
+    shutil.rmtree(product, ignore_errors=True)
+
+default(tclean)
+tclean(vis=ms_name, imagename=imagename, datacolumn='corrected', parallel=parallel, **params)
 """
 
-    python_script_file = f"run_flag_after_cal_{subband}.py"
+def image(ms_name, subband, imagename, casa_dir, logger, depend=None, resources=None, imager='tclean', params=None):
+    """
+    Create a PBS script that images the source of the given subband and submit it to the queue.
+    depend is an optional list of job IDs this job has to wait for.
+    resources overrides the job size worked out by growth.size_stage.
+    imager picks tclean (under mpicasa when the job has more than one rank) or wsclean (on all cores of the job).
+    """
+    if imager not in IMAGERS:
+        raise ValueError(f"Unknown imager: {imager}")
+    working_dir = os.getcwd()
+    sentinel_file = sentinel_file_path(subband, subband, 'image')
+    runtime_file = runtime_file_path(subband, subband, 'image')
+    live_log = live_log_file_path(subband, subband, 'image')
+    resources = stage_resources('image', ms_name, subband, subband, logger, resources)
+    staged = staged_paths([ms_name], [os.path.dirname(imagename)] + ([] if imager == 'wsclean' else [f"run_image_{subband}.py"]))
+    clear_sentinel(sentinel_file, logger)
+
+    if imager == 'wsclean':
+        command = f"mkdir -p {os.path.dirname(imagename) or '.'}\n{wsclean_command(ms_name, imagename, params, resources['ppn'])}"
+    else:
+        python_script_content = profiled_script(image_script(ms_name, imagename, params), subband, subband, 'image')
+        python_script_file = f"run_image_{subband}.py"
+        with open(python_script_file, "w") as file:
+            file.write(python_script_content)
+        command = casa_command(casa_dir, python_script_file, resources['ranks'])
+
+    pbs_script_content = f"""#!/bin/bash
+#PBS -N image_{subband}
+#PBS -l nodes=1:ppn={resources['ppn']}
+#PBS -l mem={resources['mem_gb']}gb
+#PBS -l walltime={resources['walltime']}
+#PBS -j oe
+#PBS -o {subband}/image_{subband}.log
+#PBS -q workq
+
+cd {working_dir}
+{exit_trap(sentinel_file, runtime_file, working_dir, staged)}
+exec > {live_log} 2>&1
+source ~/.bashrc
+micromamba activate 38data
+{stage_in(f'image_{subband}', staged)}{command}
+"""
+
+    pbs_script_file = f"image_{subband}.pbs"
+    with open(pbs_script_file, "w") as file:
+        file.write(pbs_script_content)
+
+    return submit_pbs_script(pbs_script_file, subband, logger, depend)
+
+def combine_images_script(images, output):
+    """
+    CASA script that combines the subband images into one wideband image. Every image is convolved to a
+    common beam and put on the grid of the first, and the combination is their mean weighted by the
+    inverse variance of the noise (robust rms of each image). The reference frequency is the weighted
+    mean of the subband frequencies. The rms and weight of each image go to output + '.json'.
+    """
+    return f"""import json
+import os
+import shutil
+import numpy as np
+
+images = {list(images)!r}
+output = '{output}'
+work_dir = output + '.work'
+
+def robust_rms(pixels):
+    pixels = pixels[np.isfinite(pixels) & (pixels != 0)]
+    return 1.4826 * np.median(np.abs(pixels - np.median(pixels)))
+
+def arcsec(quantity):
+    return qa.convert(quantity, 'arcsec')['value']
+
+shutil.rmtree(work_dir, ignore_errors=True)
+os.makedirs(work_dir)
+
+# The beam of the combination has to enclose every subband beam: the largest axes, with some room
+beams = []
+for image in images:
+    ia.open(image)
+    beam = ia.commonbeam()
+    ia.close()
+    beams.append((arcsec(beam['major']), arcsec(beam['minor']), qa.convert(beam['pa'], 'deg')['value']))
+widest = max(beams)
+target = dict(major=f'{{1.02 * widest[0]}}arcsec', minor=f'{{1.02 * max(beam[1] for beam in beams)}}arcsec', pa=f'{{widest[2]}}deg')
+
+def smooth_all(target):
+    smoothed = []
+    for i, image in enumerate(images):
+        outfile = f'{{work_dir}}/{{i}}.smooth'
+        imsmooth(imagename=image, kind='gauss', targetres=True, outfile=outfile, overwrite=True, **target)
+        smoothed.append(outfile)
+    return smoothed
+
+try:
+    smoothed = smooth_all(target)
+except Exception as e:
+    # Beams with very different position angles, a circular beam encloses them all
+    print(f'Cannot convolve every image to {{target}} ({{e}}), falling back to a circular beam', flush=True)
+    target = dict(major=target['major'], minor=target['major'], pa='0deg')
+    smoothed = smooth_all(target)
+
+ia.open(smoothed[0])
+shape = list(ia.shape())
+csys = ia.coordsys()
+ia.close()
+
+numerator = None
+stats = []
+for image in smoothed:
+    ia.open(image)
+    if list(ia.shape()) != shape:
+        ia.close()
+        imregrid(imagename=image, template=smoothed[0], output=image + '.regrid', axes=[0, 1], overwrite=True)
+        image = image + '.regrid'
+        ia.open(image)
+    pixels = ia.getchunk().astype(np.float64)
+    pixels[~ia.getchunk(getmask=True)] = np.nan
+    freq = ia.coordsys().referencevalue(type='spectral')['numeric'][0]
+    ia.close()
+    rms = robust_rms(pixels)
+    weight = 1.0 / rms**2
+    good = np.isfinite(pixels)
+    if numerator is None:
+        numerator, denominator = np.zeros(pixels.shape), np.zeros(pixels.shape)
+    numerator[good] += weight * pixels[good]
+    denominator[good] += weight
+    stats.append({{'rms': float(rms), 'weight': float(weight), 'freq': float(freq)}})
+
+combined = np.divide(numerator, denominator, out=np.zeros_like(numerator), where=denominator > 0)
+weights = np.array([entry['weight'] for entry in stats])
+freq = float(np.sum(weights * [entry['freq'] for entry in stats]) / np.sum(weights))
+csys.setreferencevalue(type='spectral', value=f'{{freq}}Hz')
+
+shutil.rmtree(output, ignore_errors=True)
+ia.fromarray(outfile=output, pixels=combined.astype(np.float32), csys=csys.torecord(), overwrite=True)
+ia.setrestoringbeam(major=target['major'], minor=target['minor'], pa=target['pa'])
+ia.setbrightnessunit('Jy/beam')
+ia.close()
+shutil.rmtree(work_dir)
+
+summary = {{'images': dict(zip(images, stats)), 'freq': freq, 'beam': target, 'rms': float(robust_rms(combined))}}
+with open(output + '.json', 'w') as file:
+    json.dump(summary, file, indent=1)
+print(f"Combined {{len(images)}} images at {{freq / 1e6:.1f}} MHz, rms {{summary['rms']:.3g}} Jy/beam", flush=True)
+"""
+
+def combine_images(images, output, casa_dir, logger, band_dir='band', depend=None, resources=None):
+    """
+    Create a single PBS script that combines the subband images into one wideband image (see
+    combine_images_script) and submit it to the queue. The job is tracked as subband band_dir with
+    prefix 'combine_images'. resources overrides the job size worked out by growth.size_stage.
+    """
+    python_script_content = combine_images_script(images, output)
+    python_script_content = profiled_script(python_script_content, band_dir, band_dir, 'combine_images')
+
+    python_script_file = f"run_combine_images_{band_dir}.py"
     with open(python_script_file, "w") as file:
         file.write(python_script_content)
 
     working_dir = os.getcwd()
+    sentinel_file = sentinel_file_path(band_dir, band_dir, 'combine_images')
+    runtime_file = runtime_file_path(band_dir, band_dir, 'combine_images')
+    live_log = live_log_file_path(band_dir, band_dir, 'combine_images')
+    resources = stage_resources('combine_images', images[0], band_dir, band_dir, logger, resources)
+    clear_sentinel(sentinel_file, logger)
     pbs_script_content = f"""#!/bin/bash
-#PBS -N flag_after_cal_{subband}
-#PBS -l nodes=1:ppn=6
-#PBS -l walltime=10:00:00
+#PBS -N combine_images_{band_dir}
+#PBS -l nodes=1:ppn={resources['ppn']}
+#PBS -l mem={resources['mem_gb']}gb
+#PBS -l walltime={resources['walltime']}
 #PBS -j oe
-#PBS -o {subband}/flag_after_cal_{subband}.log
+#PBS -o {band_dir}/combine_images_{band_dir}.log
 #PBS -q workq
 
 cd {working_dir}
+{exit_trap(sentinel_file, runtime_file)}
+exec > {live_log} 2>&1
 source ~/.bashrc
 micromamba activate 38data
-{casa_dir}/bin/casa -n 6 {casa_dir}/bin/casa --nologger --nogui --nologfile -c {python_script_file}
+{casa_command(casa_dir, python_script_file, 1)}
 """
 
-    pbs_script_file = f"flag_after_cal_{subband}.pbs"
+    pbs_script_file = f"combine_images_{band_dir}.pbs"
     with open(pbs_script_file, "w") as file:
         file.write(pbs_script_content)
 
-    submit_command = f"qsub {pbs_script_file}"
-    logger.info(f"Submitting PBS script for {subband} with command: {submit_command}")
-    try:
-        result = subprocess.run(submit_command, shell=True, stdout=subprocess.PIPE, stderr=subprocess.PIPE, check=True)
-        job_id = result.stdout.decode().strip()  # Job ID is the output from qsub
-        logger.info(f"PBS flag_after_cal script for {subband} submitted successfully with job ID: {job_id}")
-        return job_id, subband
-    except subprocess.CalledProcessError as e:
-        logger.error(f"Failed to submit PBS script for {subband}: {e}")
-        return None, subband
+    return submit_pbs_script(pbs_script_file, band_dir, logger, depend)
+
+
+
+# Self-cal rounds as (calmode, solint): phase-only with shrinking solints, then amplitude and phase on top
+# of the last phase solutions. A subband stops at the first round that does not raise the dynamic range
+# of its image by at least min_gain and keeps the solutions of the round before.
+SELFCAL_ROUNDS = [('p', '10min'), ('p', '5min'), ('p', '2min'), ('p', '1min'), ('ap', '10min'), ('ap', '5min')]
+
+SELFCAL = {'refant': 'C02', 'minsnr': 3.0, 'min_gain': 0.05}
+
+# On top of the imaging settings for the self-cal rounds: shallower, with a mask that follows the sources
+SELFCAL_IMAGING = {'niter': 5000, 'usemask': 'auto-multithresh'}
+
+def selfcal_script(ms_name, selfcal_ms, imagename, params=None, rounds=SELFCAL_ROUNDS, settings=None):
+    """
+    CASA script that self-calibrates the source of one subband in a single CASA session. The corrected
+    data are split to selfcal_ms once; every round then solves against the model tclean left in the
+    MODEL_DATA column (savemodel) and images again. The weights do not change (calwt=False), so the later
+    rounds take the PSF of the first and carry on from the model of the round before instead of starting
+    over. The best image of each round, its rms and dynamic range go to imagename + '.selfcal.json'.
+    """
+    params = imaging_params(dict(SELFCAL_IMAGING, **(params or {})))
+    settings = dict(SELFCAL, **(settings or {}))
+    return f"""import glob
+import json
+import os
+import shutil
+import numpy as np
+
+ms_name = '{ms_name}'
+selfcal_ms = '{selfcal_ms}'
+imagename = '{imagename}'
+params = {params!r}
+rounds = {list(rounds)!r}
+refant = {settings['refant']!r}
+minsnr = {settings['minsnr']!r}
+min_gain = {settings['min_gain']!r}
+ext = '.tt0' if params['deconvolver'] == 'mtmfs' else ''
+
+try:
+    from casampi.MPIEnvironment import MPIEnvironment
+    parallel = MPIEnvironment.is_mpi_enabled
+except ImportError:
+    parallel = False
+
+def remove(path):
+    if os.path.isdir(path):
+        shutil.rmtree(path)
+    elif os.path.exists(path):
+        os.remove(path)
+
+def round_name(i):
+    return f'{{imagename}}.r{{i}}'
+
+def robust_rms(pixels):
+    pixels = pixels[np.isfinite(pixels) & (pixels != 0)]
+    return 1.4826 * np.median(np.abs(pixels - np.median(pixels)))
+
+def image_round(i):
+    name = round_name(i)
+    if i > 0:
+        previous = round_name(i - 1)
+        for product in glob.glob(previous + '.*'):
+            if product[len(previous):].startswith(('.psf', '.sumwt', '.weight', '.model')):
+                shutil.copytree(product, name + product[len(previous):])
+    tclean(vis=selfcal_ms, imagename=name, datacolumn='corrected' if i > 0 else 'data', savemodel='modelcolumn',
+           calcpsf=i == 0, parallel=parallel, **params)
+    ia.open(name + '.residual' + ext)
+    rms = robust_rms(ia.getchunk())
+    ia.close()
+    ia.open(name + '.image' + ext)
+    peak = float(ia.statistics()['max'][0])
+    ia.close()
+    print(f'Round {{i}}: rms {{rms:.3g}} Jy/beam, peak {{peak:.3g}} Jy/beam, dynamic range {{peak / rms:.1f}}', flush=True)
+    return {{'rms': float(rms), 'peak': peak, 'dynamic_range': peak / rms}}
+
+os.makedirs(os.path.dirname(imagename) or '.', exist_ok=True)
+for product in glob.glob(imagename + '.*'):
+    remove(product)
+
+# The rounds work on a copy of the calibrated source, its DATA column has the calibrator solutions applied
+remove(selfcal_ms)
+split(vis=ms_name, outputvis=selfcal_ms, datacolumn='corrected')
+
+history = [dict(image_round(0), calmode=None, solint=None, tables=[])]
+best = 0
+for i, (calmode, solint) in enumerate(rounds, start=1):
+    # Phase rounds solve from scratch against the better model, amplitude rounds on top of the last phase solutions
+    phase_tables = [table for table in history[best]['tables'] if table.endswith('.p.G')]
+    pre_apply = phase_tables[-1:] if calmode == 'ap' else []
+    caltable = f'{{round_name(i)}}.{{calmode}}.G'
+    gaincal(vis=selfcal_ms, caltable=caltable, solint=solint, refant=refant, calmode=calmode, gaintype='G',
+            minsnr=minsnr, solnorm=calmode == 'ap', gaintable=pre_apply)
+    applycal(vis=selfcal_ms, gaintable=pre_apply + [caltable], interp=['linear'] * (len(pre_apply) + 1),
+             calwt=False, applymode='calonly')
+    history.append(dict(image_round(i), calmode=calmode, solint=solint, tables=pre_apply + [caltable]))
+    if history[i]['dynamic_range'] < history[best]['dynamic_range'] * (1 + min_gain):
+        print(f'Round {{i}} ({{calmode}}, {{solint}}) did not improve on round {{best}}, stopping', flush=True)
+        break
+    best = i
+
+# Go back to the solutions of the best round if the last one was not kept
+if best != len(history) - 1:
+    if history[best]['tables']:
+        applycal(vis=selfcal_ms, gaintable=history[best]['tables'], interp=['linear'] * len(history[best]['tables']),
+                 calwt=False, applymode='calonly')
+    else:
+        clearcal(vis=selfcal_ms)
+
+# Only the images of the best round are kept
+for i in range(len(history)):
+    if i != best:
+        for product in glob.glob(round_name(i) + '.*'):
+            if not product.endswith('.G'):
+                remove(product)
+
+with open(imagename + '.selfcal.json', 'w') as file:
+    json.dump({{'rounds': history, 'best': best, 'image': round_name(best) + '.image' + ext}}, file, indent=1)
+"""
+
+def selfcal(ms_name, selfcal_ms, subband, imagename, casa_dir, logger, depend=None, resources=None, params=None,
+            rounds=SELFCAL_ROUNDS, settings=None):
+    """
+    Create a PBS script that self-calibrates the source of the given subband (see selfcal_script) and
+    submit it to the queue. depend is an optional list of job IDs this job has to wait for.
+    resources overrides the job size worked out by growth.size_stage.
+    """
+    python_script_content = selfcal_script(ms_name, selfcal_ms, imagename, params, rounds, settings)
+    python_script_content = profiled_script(python_script_content, subband, subband, 'selfcal')
+
+    python_script_file = f"run_selfcal_{subband}.py"
+    with open(python_script_file, "w") as file:
+        file.write(python_script_content)
+
+    working_dir = os.getcwd()
+    sentinel_file = sentinel_file_path(subband, subband, 'selfcal')
+    runtime_file = runtime_file_path(subband, subband, 'selfcal')
+    live_log = live_log_file_path(subband, subband, 'selfcal')
+    resources = stage_resources('selfcal', ms_name, subband, subband, logger, resources)
+    staged = staged_paths([ms_name, selfcal_ms], [os.path.dirname(imagename), python_script_file])
+    clear_sentinel(sentinel_file, logger)
+    pbs_script_content = f"""#!/bin/bash
+#PBS -N selfcal_{subband}
+#PBS -l nodes=1:ppn={resources['ppn']}
+#PBS -l mem={resources['mem_gb']}gb
+#PBS -l walltime={resources['walltime']}
+#PBS -j oe
+#PBS -o {subband}/selfcal_{subband}.log
+#PBS -q workq
+
+cd {working_dir}
+{exit_trap(sentinel_file, runtime_file, working_dir, staged)}
+exec > {live_log} 2>&1
+source ~/.bashrc
+micromamba activate 38data
+{stage_in(f'selfcal_{subband}', staged)}{casa_command(casa_dir, python_script_file, resources['ranks'])}
+"""
+
+    pbs_script_file = f"selfcal_{subband}.pbs"
+    with open(pbs_script_file, "w") as file:
+        file.write(pbs_script_content)
+
+    return submit_pbs_script(pbs_script_file, subband, logger, depend)
@@ -0,0 +1,204 @@
+# Per-subband scheduling of the pipeline stages. Every subband moves through its own chain of jobs
+# and a stage is submitted as soon as the stages it needs for that subband are done, instead of
+# waiting for the slowest subband of the whole band at every step.
+
+import os
+
+from dragon_breath import wait_for_any_job, check_job_log, cleanup_files, delete_jobs
+from rest import stage_key, manifest_file_path, is_cached, write_manifest, invalidate
+from growth import record_runtime
+from quick_attack import PendingJob, deferred_submission, submit_jobs, SUBMIT_CONCURRENCY
+
+
+def add_task(dag, name, subband, prefix, submit, deps=(), cache=None):
+    """
+    Add a job to the DAG and return its name.
+    submit is called as submit(depend=[job IDs]) and must return (job_id, subband), like the
+    functions in dragon_breath. prefix is the PBS script prefix used to find the log and sentinel.
+    cache is an optional rest.cache_entry that lets a rerun skip the task when nothing changed.
+    """
+    for dep in deps:
+        if dep not in dag:
+            raise ValueError(f"Task {name} depends on unknown task {dep}")
+    dag[name] = {
+        'subband': subband,
+        'prefix': prefix,
+        'submit': submit,
+        'deps': list(deps),
+        'cache': cache,
+        'key': None if cache is None else stage_key(cache, [dag[dep]['key'] for dep in deps]),
+        'cached': False,
+        'job_id': None,
+        'state': 'waiting',  # waiting -> running -> done / failed, or skipped if a dependency failed
+    }
+    return name
+
+
+def dependants(dag, name):
+    """
+    All tasks that need the given task, directly or further down the chain.
+    """
+    found = []
+    stack = [name]
+    while stack:
+        current = stack.pop()
+        for other, task in dag.items():
+            if current in task['deps'] and other not in found:
+                found.append(other)
+                stack.append(other)
+    return found
+
+
+def siblings(dag, name):
+    """
+    Running tasks that only feed tasks which can no longer run after name failed, e.g. flag_src
+    of a subband whose flag_cal broke. Whatever they produce would not be used.
+    """
+    found = []
+    for other, task in dag.items():
+        if other == name or task['state'] != 'running':
+            continue
+        downstream = dependants(dag, other)
+        if downstream and all(dag[d]['state'] in ('failed', 'skipped') for d in downstream):
+            found.append(other)
+    return found
+
+
+def skip_downstream(dag, logger):
+    """
+    Mark the waiting tasks downstream of a failure as skipped, they will never run.
+    """
+    for name, task in dag.items():
+        if task['state'] == 'waiting' and any(dag[dep]['state'] in ('failed', 'skipped') for dep in task['deps']):
+            task['state'] = 'skipped'
+            logger.warning(f"Skipping {name} because one of {task['deps']} did not succeed.")
+
+
+def submit_ready(dag, base_output_dir, logger, pbs_depend, use_cache, use_arrays, concurrency):
+    """
+    Submit every task that is ready, all in one go (quick_attack.submit_jobs): the scripts are written
+    one after the other, the submissions then run side by side, and tasks of the same stage that wait
+    for nothing in the queue share one job array. Tasks found in the cache are marked done instead.
+    Returns the number of tasks that went to the queue.
+    """
+    pending = {}
+    for name, task in dag.items():
+        if task['state'] != 'waiting':
+            continue
+        dep_states = [dag[dep]['state'] for dep in task['deps']]
+        if pbs_depend:
+            ready = all(state in ('running', 'done') for state in dep_states)
+        else:
+            ready = all(state == 'done' for state in dep_states)
+        if not ready:
+            continue
+
+        manifest_file = manifest_file_path(os.path.join(base_output_dir, task['subband']), task['subband'], task['prefix'])
+        if task['cache'] is not None:
+            upstream_cached = all(dag[dep]['cached'] for dep in task['deps'])
+            if use_cache and upstream_cached and is_cached(manifest_file, task['key']):
+                task['state'] = 'done'
+                task['cached'] = True
+                logger.info(f"{name} is up to date, skipping it.")
+                continue
+            invalidate(manifest_file, task['cache'], logger)
+
+        # Jobs that already left the queue cannot be named in afterok
+        depend = [dag[dep]['job_id'] for dep in task['deps'] if dag[dep]['state'] == 'running']
+        with deferred_submission():
+            job, _ = task['submit'](depend=depend)
+        if isinstance(job, PendingJob):
+            job.group = task['prefix']
+            pending[name] = job
+        elif job:
+            task['job_id'] = job
+            task['state'] = 'running'
+        else:
+            task['state'] = 'failed'
+            logger.error(f"Submission of {name} failed.")
+
+    job_ids = submit_jobs(list(pending.values()), logger, use_arrays, concurrency)
+    for name, job_id in zip(pending, job_ids):
+        if job_id:
+            dag[name]['job_id'] = job_id
+            dag[name]['state'] = 'running'
+        else:
+            dag[name]['state'] = 'failed'
+            logger.error(f"Submission of {name} failed.")
+    return len(pending)
+
+
+def run_dag(dag, base_output_dir, logger, pbs_depend=False, cleanup=True, use_cache=True, min_interval=5, max_interval=60,
+            cancel_siblings=True, use_arrays=False, concurrency=SUBMIT_CONCURRENCY):
+    """
+    Submit and track every task of the DAG until nothing is left to run.
+
+    By default a task is submitted once all its dependencies have finished successfully.
+    With pbs_depend=True a task is submitted as soon as its dependencies are in the queue,
+    chained with -W depend=afterok, so the whole DAG is queued up front, one wave per level, and
+    PBS starts each job itself; the tracking here is then only used to report the outcome.
+    The tasks of a wave are submitted concurrently, up to concurrency at a time, with retries;
+    with use_arrays those of one stage without queue dependencies go in as one job array
+    (see submit_ready). PBS cannot chain a job onto a single subjob of an array, so arrays are
+    not used together with pbs_depend. A task whose submission fails for good fails like a job would.
+
+    A failure only stops the tasks downstream of it, the other subbands carry on.
+    With use_cache, a task whose manifest matches is skipped, as long as everything upstream of
+    it was skipped too; a task that does run gets a fresh manifest once it succeeds, and its
+    runtime goes into the history that growth.size_stage sizes the next run from.
+    The live logs of the running jobs are followed (see wait_for_any_job), so a job that hits a
+    SEVERE message fails right away. With cancel_siblings, running jobs whose work can no longer
+    be used because of a failure are cancelled as well.
+    Returns (all_successful, failed_tasks) where failed_tasks lists failed and skipped tasks.
+    """
+    monitors = {}
+    use_arrays = use_arrays and not pbs_depend
+    while True:
+        skip_downstream(dag, logger)
+
+        # With pbs_depend the next level can be queued behind the jobs just submitted
+        while submit_ready(dag, base_output_dir, logger, pbs_depend, use_cache, use_arrays, concurrency) and pbs_depend:
+            pass
+
+        running = {task['job_id']: name for name, task in dag.items() if task['state'] == 'running'}
+        if not running:
+            # Submissions that failed for good leave their chains behind, report those too
+            skip_downstream(dag, logger)
+            break
+
+        jobs = [(job_id, dag[name]['subband'], dag[name]['prefix']) for job_id, name in running.items()]
+        for job_id, subband, prefix in wait_for_any_job(jobs, base_output_dir, logger, min_interval, max_interval, monitors=monitors):
+            name = running[job_id]
+            task = dag[name]
+            monitor = monitors.pop(job_id, None)
+            if task['state'] != 'running':
+                # Already written off because something upstream failed in the same batch
+                continue
+            if check_job_log(job_id, subband, base_output_dir, logger, prefix, monitor):
+                task['state'] = 'done'
+                logger.info(f"{name} done.")
+                record_runtime(os.path.join(base_output_dir, subband), subband, prefix, logger)
+                if task['cache'] is not None and task['key'] is not None:
+                    write_manifest(manifest_file_path(os.path.join(base_output_dir, subband), subband, prefix), task['key'], task['cache'])
+                if cleanup:
+                    cleanup_files(subband, logger, prefix)
+                continue
+
+            task['state'] = 'failed'
+            logger.error(f"{name} failed, stopping the rest of its chain.")
+            queued = []
+            for other in dependants(dag, name):
+                if dag[other]['state'] == 'running':
+                    queued.append(dag[other]['job_id'])
+                if dag[other]['state'] in ('waiting', 'running'):
+                    dag[other]['state'] = 'skipped'
+            if cancel_siblings:
+                for other in siblings(dag, name):
+                    logger.warning(f"Cancelling {other}, nothing can use its output after {name} failed.")
+                    queued.append(dag[other]['job_id'])
+                    dag[other]['state'] = 'skipped'
+            # Held afterok jobs are not always removed by the server, do it here
+            delete_jobs(queued, logger)
+
+    failed_tasks = [name for name, task in dag.items() if task['state'] in ('failed', 'skipped')]
+    return not failed_tasks, failed_tasks
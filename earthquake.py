@@ -2,109 +2,321 @@
 
 
 import logging
+import warnings
+
 import numpy as np
 
 
+CUTOFF_METHODS = ('median', 'stddev', 'mad', 'sigma_clip')
+
+# MAD x 1.4826 is the standard deviation for Gaussian data
+MAD_TO_SIGMA = 1.4826
+
+def cutoff_along_last_axis(values, method='mad', factor=1.5, clip=3.0, niter=5):
+    """
+    Cutoff of every row of values along the last axis, NaNs ignored:
+    - median: the median, which puts about half of the antennas below it; only on request
+    - stddev: mean - factor * standard deviation
+    - mad: median - factor * 1.4826 * median absolute deviation, not pulled down by the outliers
+    - sigma_clip: mean - factor * standard deviation after dropping the values more than clip
+      standard deviations from the mean, up to niter times
+    Rows without any value get NaN.
+    """
+    if method not in CUTOFF_METHODS:
+        raise ValueError("Unsupported method: {}".format(method))
+    values = np.asarray(values, dtype=float)
+    with warnings.catch_warnings():
+        warnings.simplefilter('ignore', RuntimeWarning)
+        if method == 'median':
+            return np.nanmedian(values, axis=-1)
+        if method == 'stddev':
+            return np.nanmean(values, axis=-1) - factor * np.nanstd(values, axis=-1)
+        if method == 'mad':
+            median = np.nanmedian(values, axis=-1)
+            mad = np.nanmedian(np.abs(values - median[..., None]), axis=-1)
+            return median - factor * MAD_TO_SIGMA * mad
+        kept = values
+        for _ in range(niter):
+            mean = np.nanmean(kept, axis=-1, keepdims=True)
+            std = np.nanstd(kept, axis=-1, keepdims=True)
+            clipped = np.where(np.abs(kept - mean) > clip * std, np.nan, kept)
+            if np.array_equal(np.isnan(clipped), np.isnan(kept)):
+                break
+            kept = clipped
+        return np.nanmean(kept, axis=-1) - factor * np.nanstd(kept, axis=-1)
+
 def determine_cutoff(antenna_means, method='median', factor=1.5):
     """
     Determine a suitable cutoff value based on the mean amplitudes of antennas.
     
     Parameters:
     - antenna_means: List of tuples where each tuple contains (antenna_id, mean_amplitude).
-    - method: Method to calculate cutoff. Options are 'median' or 'stddev'.
-    - factor: Multiplier for the standard deviation method.
+    - method: Method to calculate cutoff, one of CUTOFF_METHODS (see cutoff_along_last_axis).
+    - factor: Multiplier for the standard deviation (stddev, sigma_clip) or the MAD (mad).
     
     Returns:
     - meancutoff: Calculated cutoff value.
     """
     # Extract mean amplitudes from the list of tuples
     amplitudes = [mean for _, mean in antenna_means]
-    
-    if method == 'median':
-        # Use the median of mean amplitudes as the cutoff value
-        meancutoff = np.median(amplitudes)
-    elif method == 'stddev':
-        # Use mean and standard deviation to set the cutoff value
-        mean = np.mean(amplitudes)
-        stddev = np.std(amplitudes)
-        meancutoff = mean - factor * stddev
-    else:
-        raise ValueError("Unsupported method: {}".format(method))
-    
-    return meancutoff
+    return float(cutoff_along_last_axis(amplitudes, method, factor))
+
+def scan_group_labels(nscan, scan_groups=None):
+    """
+    Group label of every scan: each scan on its own by default, blocks of scan_groups consecutive
+    scans for an int, or the labels themselves (e.g. the field of every scan) for a sequence.
+    """
+    if scan_groups is None:
+        return np.arange(nscan)
+    if isinstance(scan_groups, int):
+        return np.arange(nscan) // max(1, scan_groups)
+    labels = np.asarray(scan_groups)
+    if len(labels) != nscan:
+        raise ValueError("Got {} scan group labels for {} scans".format(len(labels), nscan))
+    return labels
+
+def determine_cutoffs(means, method='mad', factor=1.5, scan_groups=None, clip=3.0):
+    """
+    Cutoffs for a whole (scan, antenna, pol) array of mean amplitudes in one go, one per scan group
+    and polarization, over all antennas of all scans in the group (see scan_group_labels).
+    Returns an (nscan, npol) array, every scan getting the cutoff of its group.
+    """
+    means = np.asarray(means, dtype=float)
+    nscan, nant, npol = means.shape
+    _, group = np.unique(scan_group_labels(nscan, scan_groups), return_inverse=True)
+    group = group.ravel()
+    # Scans of a group side by side, padded with NaN up to the largest group
+    sizes = np.bincount(group)
+    order = np.argsort(group, kind='stable')
+    position = np.empty(nscan, dtype=int)
+    position[order] = np.arange(nscan) - np.repeat(np.cumsum(sizes) - sizes, sizes)
+    samples = np.full((len(sizes), sizes.max(), nant, npol), np.nan)
+    samples[group, position] = means
+    samples = samples.transpose(0, 3, 1, 2).reshape(len(sizes), npol, -1)
+    return cutoff_along_last_axis(samples, method, factor, clip)[group]
+
+def bad_antenna_mask(means, method='mad', factor=1.5, scan_groups=None, clip=3.0):
+    """
+    Boolean (scan, antenna, pol) mask of the means below the cutoff of their scan group and polarization.
+    Antennas without data (NaN) are never flagged.
+    """
+    means = np.asarray(means, dtype=float)
+    cutoffs = determine_cutoffs(means, method, factor, scan_groups, clip)
+    return means < cutoffs[:, None, :]
+
+# CORR_TYPE codes of the POLARIZATION table
+CORR_NAMES = {5: 'RR', 6: 'RL', 7: 'LR', 8: 'LL', 9: 'XX', 10: 'XY', 11: 'YX', 12: 'YY'}
+
+def get_correlations(msfilename):
+    """
+    Names of the correlations in the MS, in the order they are stored in DATA.
+    """
+    tb.open(msfilename + '/POLARIZATION')
+    corr_type = tb.getcell('CORR_TYPE', 0)
+    tb.close()
+    return [CORR_NAMES.get(int(corr), str(corr)) for corr in corr_type]
+
+def get_all_antenna_means(msfilename, mygoodchans, scans=None, datacolumn='DATA', scans_per_chunk=20):
+    """
+    Get the flag-aware mean amplitude of every antenna and correlation in every scan.
+
+    DATA and FLAG are read in bulk, scans_per_chunk scans per table query, and the per-antenna
+    means come from one bincount over the ANTENNA1/ANTENNA2 columns. Auto-correlations are left out.
+
+    Returns (scans, antennas, correlations, means) where means has shape (nscan, nant, ncorr)
+    and is NaN where an antenna has no unflagged data in a scan.
+    """
+    chans = np.asarray(mygoodchans)
+    first, last = int(chans.min()), int(chans.max())
+    chans = chans - first  # index into the channel slice that is read
+
+    correlations = get_correlations(msfilename)
+    tb.open(msfilename + '/ANTENNA')
+    nant = tb.nrows()
+    tb.close()
+
+    tb.open(msfilename)
+    if scans is None:
+        scans = np.unique(tb.getcol('SCAN_NUMBER'))
+    scans = np.sort(np.asarray(scans))
+    nscan, ncorr = len(scans), len(correlations)
+
+    sums = np.zeros(ncorr * nscan * nant)
+    counts = np.zeros(ncorr * nscan * nant)
+    for i in range(0, nscan, scans_per_chunk):
+        chunk = scans[i:i + scans_per_chunk]
+        query = "SCAN_NUMBER IN [{}] AND ANTENNA1 != ANTENNA2".format(','.join(str(scan) for scan in chunk))
+        sub = tb.query(query, columns='SCAN_NUMBER,ANTENNA1,ANTENNA2,{},FLAG'.format(datacolumn))
+        if sub.nrows() == 0:
+            sub.close()
+            continue
+        scan_col = sub.getcol('SCAN_NUMBER')
+        ant1 = sub.getcol('ANTENNA1')
+        ant2 = sub.getcol('ANTENNA2')
+        # Shapes are (ncorr, nchan, nrow)
+        data = sub.getcolslice(datacolumn, [0, first], [ncorr - 1, last], [1, 1])[:, chans, :]
+        good = ~sub.getcolslice('FLAG', [0, first], [ncorr - 1, last], [1, 1])[:, chans, :]
+        sub.close()
+
+        row_sums = (np.abs(data) * good).sum(axis=1)  # (ncorr, nrow)
+        row_counts = good.sum(axis=1)
+
+        scan_index = np.searchsorted(scans, scan_col)
+        corr_offset = (np.arange(ncorr) * nscan * nant)[:, None]
+        for ant in (ant1, ant2):
+            index = (corr_offset + scan_index * nant + ant).ravel()
+            sums += np.bincount(index, weights=row_sums.ravel(), minlength=sums.size)
+            counts += np.bincount(index, weights=row_counts.ravel(), minlength=counts.size)
+    tb.close()
+
+    with np.errstate(invalid='ignore', divide='ignore'):
+        means = sums / counts
+    means = means.reshape(ncorr, nscan, nant).transpose(1, 2, 0)
+    return scans, np.arange(nant), correlations, means
 
 def get_antenna_means(msfilename, scan_number, poldata, mygoodchans, meancutoff):
     """
     Get the mean amplitude values for each antenna in a single scan
     and identify antennas that are outliers based on the cutoff value.
     """
-    # Open MS and initialize the MSMetaData tool
-    msmd.open(msfilename)
-    msmd.select({'scan': scan_number})
-    
-    # Get antenna list
-    antennas = msmd.antennaids()
-    
-    # Initialize lists to store mean values and bad antennas
-    antenna_means = []
-    bad_antennas = []
-    
-    for ant in antennas:
-        # Retrieve amplitude data for the specified polarization
-        if poldata == 'RR':
-            data = msmd.getdata(['DATA'], antenna=ant, scan=scan_number, pol='RR')
-        elif poldata == 'LL':
-            data = msmd.getdata(['DATA'], antenna=ant, scan=scan_number, pol='LL')
-        else:
-            raise ValueError("Unsupported polarization: {}".format(poldata))
-        
-        # Calculate the mean amplitude for the given channels
-        amplitudes = data['data'][0, 0, mygoodchans]  # Select the channels
-        mean_amplitude = np.mean(np.abs(amplitudes))
-        
-        antenna_means.append((ant, mean_amplitude))
-        
-        # Identify outliers based on the mean cutoff
-        if mean_amplitude < meancutoff:
-            bad_antennas.append(ant)
-    
-    msmd.close()
-    
+    scans, antennas, correlations, means = get_all_antenna_means(msfilename, mygoodchans, scans=[scan_number])
+    if poldata not in correlations:
+        raise ValueError("Unsupported polarization: {}".format(poldata))
+    scan_means = means[0, :, correlations.index(poldata)]
+
+    antenna_means = list(zip(antennas.tolist(), scan_means.tolist()))
+    bad_antennas = antennas[scan_means < meancutoff].tolist()
+
     return antenna_means, bad_antennas
 
+def summary_antenna_means(summary):
+    """
+    The (scans, antennas, correlations, means) of get_all_antenna_means from an amplitude summary
+    (surf.load_summary) instead of the MS. The summary covers a channel range, not a channel list.
+    """
+    means = summary.by_scan_antenna(summary.mean('scan_antenna'))
+    return summary.scans, np.arange(summary.nant), summary.correlations, means
+
+def find_bad_antennas(msfilename, poldata, mygoodchans, method='mad', factor=1.5, summary=None, scan_groups=None):
+    """
+    Find the bad antennas of every scan with one bulk read of the MS, or none with an amplitude summary.
+    The cutoffs of all scans come from one determine_cutoffs call. poldata is one correlation or a
+    list of them, an antenna is bad in a scan if it is bad in any of them.
+    Returns a dict {scan_number: [bad antennas]}.
+    """
+    if summary is not None:
+        scans, antennas, correlations, means = summary_antenna_means(summary)
+    else:
+        scans, antennas, correlations, means = get_all_antenna_means(msfilename, mygoodchans)
+    pols = [poldata] if isinstance(poldata, str) else list(poldata)
+    for pol in pols:
+        if pol not in correlations:
+            raise ValueError("Unsupported polarization: {}".format(pol))
+    pol_index = [correlations.index(pol) for pol in pols]
+
+    mask = bad_antenna_mask(means[:, :, pol_index], method, factor, scan_groups).any(axis=2)
+    return {scan: antennas[scan_mask].tolist() for scan, scan_mask in zip(scans.tolist(), mask)}
+
+def scan_ranges(scans, all_scans=None):
+    """
+    Compress scan numbers into CASA scan ranges, e.g. [1, 2, 3, 7] -> '1~3,7'. With all_scans (the scans
+    of the MS) a range runs over the scans that are not in the MS, so [1, 3] -> '1~3' if 2 is not.
+    """
+    if all_scans is None:
+        position = {scan: scan for scan in scans}
+    else:
+        position = {scan: index for index, scan in enumerate(sorted(set(all_scans) | set(scans)))}
+    ranges = []
+    for scan in sorted(set(scans)):
+        if ranges and position[scan] == position[ranges[-1][1]] + 1:
+            ranges[-1][1] = scan
+        else:
+            ranges.append([scan, scan])
+    return ','.join(str(first) if first == last else '{}~{}'.format(first, last) for first, last in ranges)
+
+class FlagAccumulator:
+    """
+    Gathers the bad antennas of every scan of an observation and merges them into a few flag commands:
+    one command per set of antennas that are bad over the same scans, with the scans as ranges.
+    all_scans are the scans of the MS (see scan_ranges), without them ranges only cover consecutive numbers.
+    """
+    def __init__(self, all_scans=None):
+        self.all_scans = set(all_scans) if all_scans is not None else None
+        self.bad = {}  # antenna -> set of scans
+
+    def add(self, scan_number, bad_antennas):
+        for ant in bad_antennas:
+            self.bad.setdefault(ant, set()).add(scan_number)
+
+    def add_all(self, bad_antennas):
+        """
+        Add a {scan_number: [bad antennas]} dict as returned by find_bad_antennas.
+        """
+        for scan_number, bad in bad_antennas.items():
+            self.add(scan_number, bad)
+
+    def commands(self):
+        antennas_by_scans = {}
+        for ant, scans in sorted(self.bad.items()):
+            antennas_by_scans.setdefault(scan_ranges(scans, self.all_scans), []).append(ant)
+        return ["mode='manual' antenna='{}' scan='{}'".format(','.join(str(ant) for ant in ants), scans)
+                for scans, ants in antennas_by_scans.items()]
+
+    def write(self, flag_file):
+        with open(flag_file, 'w') as file:
+            file.write('\n'.join(self.commands()) + '\n')
+        return flag_file
+
+    def apply(self, msfilename, flagbadants=True, flag_file=None):
+        """
+        Log the commands and apply them in one flagdata call, through flag_file if given.
+        """
+        flag_commands = self.commands()
+        if not flag_commands:
+            logging.info("No bad antennas found")
+            return flag_commands
+
+        logging.info("Flagging commands:")
+        for cmd in flag_commands:
+            logging.info(cmd)
+
+        if flagbadants:
+            logging.info("Now flagging the bad antennas of {} scans in one pass.".format(
+                len(set().union(*self.bad.values()))))
+            inpfile = self.write(flag_file) if flag_file else flag_commands
+            default(flagdata)
+            flagdata(vis=msfilename, mode='list', inpfile=inpfile, flagbackup=True)
+        return flag_commands
+
+def flag_all_bad_antennas(msfilename, bad_antennas, flagbadants=True, flag_file=None):
+    """
+    Flag the bad antennas of every scan, a {scan_number: [bad antennas]} dict, with one flagdata call.
+    """
+    accumulator = FlagAccumulator(bad_antennas.keys())
+    accumulator.add_all(bad_antennas)
+    return accumulator.apply(msfilename, flagbadants, flag_file)
+
 def flag_bad_antennas(msfilename, scan_number, bad_antennas, flagbadants=True):
     """
     Flag bad antennas in the MS file for a given scan number.
+    For more than one scan use flag_all_bad_antennas, which needs a single pass over the MS.
     """
     if not bad_antennas:
         logging.info("No bad antennas found for scan {}".format(scan_number))
         return
     
     logging.info("Bad antennas for scan {}: {}".format(scan_number, bad_antennas))
-    
-    flag_commands = []
-    for ant in bad_antennas:
-        flag_command = "mode='manual' antenna='{}' scan='{}'".format(ant, scan_number)
-        flag_commands.append(flag_command)
-    
-    # Execute the flagging commands
-    logging.info("Flagging commands:")
-    for cmd in flag_commands:
-        logging.info(cmd)
-    
-    if flagbadants:
-        logging.info("Now flagging the bad antennas.")
-        default(flagdata)
-        flagdata(vis=msfilename, mode='list', inpfile=flag_commands)
+    flag_all_bad_antennas(msfilename, {scan_number: bad_antennas}, flagbadants)
 
 # Example usage
-msfilename = 'your_measurement_set.ms'
-scan_number = 1
-poldata = 'RR'  # or 'LL'
-mygoodchans = range(0, 100)  # Example channel range
+if __name__ == '__main__':
+    msfilename = 'your_measurement_set.ms'
+    poldata = 'RR'  # or 'LL'
+    mygoodchans = range(0, 100)  # Example channel range
 
-# Get the mean amplitudes and determine the cutoff value
-antenna_means, bad_antennas = get_antenna_means(msfilename, scan_number, poldata, mygoodchans, meancutoff=0.5)
+    # Get the mean amplitudes of the whole observation and the bad antennas of every scan, below the
+    # median by more than 1.5 x the robust standard deviation of their scan
+    bad_antennas = find_bad_antennas(msfilename, poldata, mygoodchans, method='mad', factor=1.5)
 
-# Flag bad antennas
-flag_bad_antennas(msfilename, scan_number, bad_antennas)
+    # Flag the bad antennas of all scans at once
+    flag_all_bad_antennas(msfilename, bad_antennas, flag_file=msfilename.rstrip('/') + '.badants.flg')
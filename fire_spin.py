@@ -0,0 +1,272 @@
+# Long-lived CASA workers. Instead of starting CASA (and micromamba) from scratch for every stage of
+# every subband, one worker is started per subband and the stage scripts that dragon_breath writes are
+# sent to it over a TCP socket and run inside the already initialised CASA session.
+#
+# The worker side is this same file run inside CASA:
+#     casa --nologger --nogui --nologfile -c fire_spin.py serve spw0/worker.address [head node]
+# It listens on the interface of the node that reaches the head node (the hostname's address without one).
+# Run it with plain python and it is a stand-in worker without CASA, good for timing the dispatch.
+
+import json
+import os
+import secrets
+import socket
+import struct
+import sys
+import time
+import traceback
+
+from dragon_breath import sentinel_file_path, clear_sentinel, submit_pbs_script, query_job_states
+from quick_attack import walltime_seconds
+
+MESSAGE_TIMEOUT = 60    # seconds a connection gets to deliver its message, or a worker to answer a shutdown
+LIVENESS_INTERVAL = 60  # seconds between checks that the worker job is still there while a payload runs
+
+
+def send_message(sock, message):
+    payload = json.dumps(message).encode()
+    sock.sendall(struct.pack('!Q', len(payload)) + payload)
+
+
+def recv_message(sock, idle=None):
+    """
+    Read one message, None if the other side closed the connection. With a socket timeout set, idle is
+    called whenever nothing arrived for that long and can raise to give up; without idle the timeout
+    is raised.
+    """
+    header = recv_exactly(sock, 8, idle)
+    if header is None:
+        return None
+    payload = recv_exactly(sock, struct.unpack('!Q', header)[0], idle)
+    if payload is None:
+        return None
+    return json.loads(payload.decode())
+
+
+def recv_exactly(sock, size, idle=None):
+    chunks = []
+    while size:
+        try:
+            chunk = sock.recv(min(size, 1 << 20))
+        except socket.timeout:
+            if idle is None:
+                raise
+            idle()
+            continue
+        if not chunk:
+            return None
+        chunks.append(chunk)
+        size -= len(chunk)
+    return b''.join(chunks)
+
+
+def cluster_address(client_host=None):
+    """
+    Address of this node on the network that client_host is on: the source address of a route to it
+    (a UDP connect sends nothing). Without client_host, the address the hostname resolves to.
+    """
+    if client_host:
+        with socket.socket(socket.AF_INET, socket.SOCK_DGRAM) as probe:
+            probe.connect((client_host, 9))
+            return probe.getsockname()[0]
+    return socket.gethostbyname(socket.gethostname())
+
+
+def serve(address_file, namespace, client_host=None):
+    """
+    Run payloads sent by dispatch() one after the other until a shutdown message arrives.
+    Every payload runs in a fresh copy of namespace, which inside CASA holds all the tasks.
+    The worker listens on the cluster interface only (cluster_address) and its address and a random
+    token are written to address_file; only clients that can read that file can talk to the worker.
+    A client gets MESSAGE_TIMEOUT seconds to send its message, so a silent one cannot block the worker.
+    """
+    token = secrets.token_hex(16)
+    host = cluster_address(client_host)
+    server = socket.socket(socket.AF_INET, socket.SOCK_STREAM)
+    server.setsockopt(socket.SOL_SOCKET, socket.SO_REUSEADDR, 1)
+    server.bind((host, 0))
+    server.listen(4)
+
+    tmp_file = address_file + '.tmp'
+    with open(os.open(tmp_file, os.O_WRONLY | os.O_CREAT | os.O_TRUNC, 0o600), 'w') as file:
+        json.dump({'host': host, 'port': server.getsockname()[1], 'token': token, 'pid': os.getpid()}, file)
+    os.replace(tmp_file, address_file)
+
+    running = True
+    while running:
+        conn, _ = server.accept()
+        conn.settimeout(MESSAGE_TIMEOUT)
+        with conn:
+            try:
+                message = recv_message(conn)
+            except (OSError, ValueError):
+                continue
+            if message is None or message.get('token') != token:
+                continue
+            if message.get('shutdown'):
+                try:
+                    send_message(conn, {'status': 'ok'})
+                except OSError:
+                    pass
+                running = False
+                continue
+
+            start = time.monotonic()
+            reply = {'status': 'ok', 'name': message.get('name')}
+            try:
+                cwd = message.get('cwd')
+                if cwd:
+                    os.chdir(cwd)
+                exec(compile(message['script'], message.get('name') or '<payload>', 'exec'), dict(namespace))
+            except BaseException:
+                reply['status'] = 'error'
+                reply['error'] = traceback.format_exc()
+            reply['elapsed'] = time.monotonic() - start
+            try:
+                send_message(conn, reply)
+            except OSError:
+                # The client gave up on this payload, the worker carries on with the next one
+                pass
+
+    server.close()
+    os.remove(address_file)
+
+
+def read_address(address_file):
+    """
+    Return the worker address written by serve(), or None if the worker is not up yet.
+    """
+    try:
+        with open(address_file, 'r') as file:
+            return json.load(file)
+    except (OSError, ValueError):
+        return None
+
+
+def dispatch(address, script, name=None, cwd=None, timeout=None, job_id=None, poll_interval=LIVENESS_INTERVAL):
+    """
+    Run a script on a worker and wait for it. Returns the reply: status is 'ok' or 'error',
+    with the traceback in 'error' and the run time in 'elapsed'.
+    Gives up with an error after timeout seconds, or as soon as the worker job job_id has left
+    the queue (checked every poll_interval seconds while waiting), so a dead worker cannot hang the run.
+    """
+    deadline = None if timeout is None else time.monotonic() + timeout
+
+    def still_running():
+        if deadline is not None and time.monotonic() > deadline:
+            raise TimeoutError(f"no reply within {timeout} s")
+        if job_id is not None:
+            try:
+                alive = job_id in query_job_states([job_id])
+            except OSError:
+                # Server hiccup, look again next time
+                alive = True
+            if not alive:
+                raise ConnectionError(f"worker job {job_id} left the queue")
+
+    try:
+        with socket.create_connection((address['host'], address['port']), timeout=MESSAGE_TIMEOUT) as sock:
+            send_message(sock, {'token': address['token'], 'name': name, 'script': script, 'cwd': cwd})
+            sock.settimeout(poll_interval if deadline is None else min(poll_interval, timeout))
+            reply = recv_message(sock, still_running)
+    except OSError as e:
+        return {'status': 'error', 'error': f"no reply from the worker: {e}", 'name': name}
+    if reply is None:
+        return {'status': 'error', 'error': 'worker closed the connection', 'name': name}
+    return reply
+
+
+def stop_worker(address):
+    with socket.create_connection((address['host'], address['port']), timeout=MESSAGE_TIMEOUT) as sock:
+        send_message(sock, {'token': address['token'], 'shutdown': True})
+        recv_message(sock)
+
+
+def start_worker(subband, casa_dir, logger, ppn=6, walltime='24:00:00', depend=None):
+    """
+    Create a PBS script that keeps a CASA worker running for the given subband and submit it.
+    The worker writes its address to {subband}/worker.address once CASA is up.
+    """
+    address_file = os.path.join(subband, 'worker.address')
+    if os.path.exists(address_file):
+        os.remove(address_file)
+
+    worker_script = os.path.abspath(__file__)
+    working_dir = os.getcwd()
+    sentinel_file = sentinel_file_path(subband, subband, 'worker')
+    clear_sentinel(sentinel_file, logger)
+    pbs_script_content = f"""#!/bin/bash
+#PBS -N worker_{subband}
+#PBS -l nodes=1:ppn={ppn}
+#PBS -l walltime={walltime}
+#PBS -j oe
+#PBS -o {subband}/worker_{subband}.log
+#PBS -q workq
+
+cd {working_dir}
+trap 'echo $? > {sentinel_file}' EXIT
+source ~/.bashrc
+micromamba activate 38data
+export PYTHONPATH={os.path.dirname(worker_script)}:$PYTHONPATH
+{casa_dir}/bin/casa --nologger --nogui --nologfile -c {worker_script} serve {address_file} {socket.gethostname()}
+"""
+
+    pbs_script_file = f"worker_{subband}.pbs"
+    with open(pbs_script_file, "w") as file:
+        file.write(pbs_script_content)
+
+    return submit_pbs_script(pbs_script_file, subband, logger, depend)
+
+
+def wait_for_worker(job_id, address_file, logger, poll_interval=5):
+    """
+    Wait until the worker job has started CASA and published its address.
+    Returns the address, or None if the job left the queue without coming up.
+    """
+    while True:
+        address = read_address(address_file)
+        if address is not None:
+            logger.info(f"Worker {job_id} is up on {address['host']}:{address['port']}")
+            return address
+        if job_id not in query_job_states([job_id]):
+            logger.error(f"Worker job {job_id} ended before publishing {address_file}")
+            return None
+        time.sleep(poll_interval)
+
+
+def run_chain_on_worker(subband, stages, casa_dir, logger, ppn=6, walltime='24:00:00'):
+    """
+    Start a worker for the subband and run the stage scripts on it in order.
+    stages is a list of (name, script). Stops at the first failing stage.
+    Returns (all_successful, failed_stage).
+    """
+    job_id, _ = start_worker(subband, casa_dir, logger, ppn, walltime)
+    if not job_id:
+        return False, 'worker'
+    address = wait_for_worker(job_id, os.path.join(subband, 'worker.address'), logger)
+    if address is None:
+        return False, 'worker'
+
+    failed_stage = None
+    try:
+        for name, script in stages:
+            logger.info(f"Running {name} on the {subband} worker.")
+            reply = dispatch(address, script, name, os.getcwd(), timeout=walltime_seconds(walltime), job_id=job_id)
+            if reply['status'] != 'ok':
+                logger.error(f"{name} failed on the {subband} worker:\n{reply.get('error')}")
+                failed_stage = name
+                break
+            logger.info(f"{name} done in {reply['elapsed']:.1f} s.")
+    finally:
+        try:
+            stop_worker(address)
+        except OSError as e:
+            logger.warning(f"Could not stop the {subband} worker: {e}")
+
+    return failed_stage is None, failed_stage
+
+
+if __name__ == '__main__' and 'serve' in sys.argv:
+    # Inside CASA the globals of this script are the CASA session with all its tasks
+    _serve_args = sys.argv[sys.argv.index('serve') + 1:]
+    serve(_serve_args[0], globals(), _serve_args[1] if len(_serve_args) > 1 else None)
@@ -7,23 +7,46 @@
 
 import os 
 import sys
-from dragon_breath import subbanding,wait_for_jobs_to_finish,cleanup_files,flag_cal,flag_src,apply_cal,flag_after_cal
+from functools import partial
+from concurrent.futures import ThreadPoolExecutor
+from dragon_breath import subbanding,split_band,flag_cal,flag_src,apply_cal,flag_after_cal,image,combine_images
+from dragon_breath import subbanding_script,split_band_script,flag_cal_script,flag_src_script,apply_cal_script,flag_after_cal_script
+from dragon_breath import image_script,combine_images_script,wsclean_command,image_product
+from dragon_breath import selfcal,selfcal_script,pol_cal,pol_cal_script,pol_tables_of
+from dragon_dance import add_task, run_dag
+from fire_spin import run_chain_on_worker
+from rock_slide import make_executor, use_executor
+from rest import cache_entry
+from scale_shot import plan_from_ms, UGMRT_BAND_EDGES
+from growth import use_node_limits
+from foresight import write_profile_report
 from datetime import datetime 
 
-from dragon_breath import configure_logger
+from dragon_breath import configure_logger, part_prefix, use_staging
 
 
-# Get some metadata from the file.....
-n_chan = 2048
-n_pol = 2
-freq_0 = 550.048 # in MHz
-n_bw = 200 # in MHz
-chan_width = 200/2048
 ms_name = 'rcs.ms'
 casa_dir = '/home/apal/casa-6.6.4-34-py3.8.el8'
 
-# Now the first step is to split the files in to four subbands .... I am writing it to make it hardcoded for now. Users will have two options, going 
-# with default config or defining it itself.
+# The first step is to split the file into subbands, by default along the fixed map further down.
+# With auto_plan the subbands are planned from the SPECTRAL_WINDOW table of the MS and the size of the
+# allocation (scale_shot.py): one subband per node, more if a subband would not fit in memory. The
+# planner opens the MS with casatools, so this node needs CASA for it.
+auto_plan = False
+n_nodes = 4
+mem_per_node_gb = 256
+band_edges = UGMRT_BAND_EDGES[4] # in MHz
+
+# Every job asks for cores, memory and walltime according to the size of its MS and the runtimes of
+# earlier runs (growth.py), within the size of one node
+cores_per_node = 16
+use_node_limits(max_ranks=cores_per_node, mem_per_node_gb=mem_per_node_gb)
+
+# Write cal.ms and src.ms as Multi-MSs partitioned along this axis ('scan', 'baseline' or 'auto'), so the
+# flagging and calibration stages run under mpicasa with one server per sub-MS. None, the default, keeps
+# plain MSs and every stage runs in a single CASA process.
+mms_axis = None
+numsubms = cores_per_node - 1
 
 # Let's setup some directories...
 
@@ -33,9 +56,21 @@ tech_log = 'gripper_{}.log'.format(start_time)
 # Configure the technical logger
 logger_t = configure_logger('gripper_logger', tech_log)
 
+# Define subband ranges for splitting
+if auto_plan:
+    subbands_dict = plan_from_ms(ms_name, n_nodes, mem_per_node_gb, band_edges)
+else:
+    subbands_dict = {
+        "spw0": "0:124~573",
+        "spw1": "0:574~1023",
+        "spw2": "0:1024~1473",
+        "spw3": "0:1474~1923"
+    }
+logger_t.info(f"Subbands: {subbands_dict}")
+
 # Setting up the directories....
 
-dirs = ['spw0', 'spw1', 'spw2', 'spw3']
+dirs = list(subbands_dict)
 
 phase_cal='1634+627'
 amp_cal = '3C286'
@@ -43,6 +78,16 @@ cal_name = phase_cal+','+amp_cal
 
 src_name = 'RXCS'
 
+# Polarization calibration (dragon_breath.pol_cal) after the bandpass of each subband, next to flag_src:
+# cross-hand delay and phase on pol_cal_name, which needs a model in dragon_breath.POL_MODELS, and the
+# leakage ('Df') on the phase calibrator, taken to be unpolarized. Name a polarized leakage calibrator with
+# enough parallactic angle coverage in polarized_leak_cal to solve its Q and U as well ('Df+QU').
+# apply_cal then applies the tables too.
+use_polcal = False
+pol_cal_name = amp_cal
+polarized_leak_cal = None
+leak_cal, leak_poltype = (polarized_leak_cal, 'Df+QU') if polarized_leak_cal else (phase_cal, 'Df')
+
 # Create main directories
 for directory in dirs:
     try:
@@ -98,152 +143,188 @@ for directory in dirs:
 logger_t.info('Subbanding the MS and separating the calibrators.')
 
 
-# Define subband ranges for splitting
-subbands_dict = {
-    "spw0": "0:124~573",
-    "spw1": "0:574~1023",
-    "spw2": "0:1024~1473",
-    "spw3": "0:1474~1923"
-}
-
-logger_t.info('Subbanding the MS into 4 sub-MSs and splitting the source and calibrators.......')
-
-job_info = []
-for subband, spw in subbands_dict.items():
-    job_id, subband_name = subbanding(ms_name, subband, spw, subband, '/home/apal/casa-6.6.4-34-py3.8.el8', logger_t, cal_name, src_name)
-    if job_id:
-        job_info.append((job_id, subband_name))
-
-# Specify the base output directory
-base_output_dir = '/home/apal/rcs'
-
-# Wait for all jobs to finish
-all_successful, failed_jobs = wait_for_jobs_to_finish(job_info, base_output_dir, logger_t,'mstransform')
-
-if all_successful:
-    logger_t.info('All PBS scripts have run successfully. Proceeding to next steps.')
-    for subband, spw in subbands_dict.items():
-        cleanup_files(subband,logger_t,'mstransform')
-
-    # Proceed to next steps
-else:
-    logger_t.error('Some PBS scripts failed. The following subbands had issues: ' + ', '.join(failed_jobs))
-    sys.exit(1)
-    # Handle failure case
-
-
-logger_t.info('Subbanding Done....')
-logger_t.info('Proceeding with flagging and calibration.....')
-logger_t.info('Flagging the calibrators....')
-
-#submitting jobs to flag and get solutions of calibrators.....
-
-job_info = []
-for subband, spw in subbands_dict.items():
-    caltable_pref = subband + '/caltables/cal'
-    job_id, subband_name = flag_cal(subband+'/cal.ms', subband, caltable_pref,casa_dir , logger_t, amp_cal, phase_cal)
-    if job_id:
-        job_info.append((job_id, subband_name))
-
-# Specify the base output directory
-base_output_dir = '/home/apal/rcs'
-
-#submitting jobs to flag source.....
-
-job_info1= []
-for subband, spw in subbands_dict.items():
-    job_id1, subband_name1 = flag_src(subband+'/src.ms',subband,casa_dir, logger_t, src_name)
-    if job_id1:
-        job_info1.append((job_id1, subband_name))
-
-
-# Wait for all jobs to finish
-all_successful, failed_jobs = wait_for_jobs_to_finish(job_info, base_output_dir, logger_t,'flag_cal')
-
-# Wait for all jobs to finish
-all_successful1, failed_jobs1 = wait_for_jobs_to_finish(job_info1, base_output_dir, logger_t,'flag_src')
-
-if all_successful:
-    logger_t.info('All PBS scripts for calibrations have run successfully. Proceeding to next steps.')
-    logger_t.info('Calibrators are flagged and calibration solutions are written......')
-    for subband, spw in subbands_dict.items():
-        cleanup_files(subband,logger_t,flag_cal)
-
-    # Proceed to next steps
-else:
-    logger_t.error('Flagging and calibration solution scripts failed. The following subbands had issues: ' + ', '.join(failed_jobs))
-    sys.exit(1)
-    # Handle failure case
-
-
-if all_successful1:
-    logger_t.info('All PBS scripts for source have run successfully. Proceeding to next steps.')
-    logger_t.info('Sources are flagged.....')
-    for subband, spw in subbands_dict.items():
-        cleanup_files(subband,logger_t,flag_src)
+# Where the jobs leave their sentinels, logs, profiles and manifests: the job scripts write them relative
+# to the directory they are written from, which is this one
+base_output_dir = os.getcwd()
+
+# Where the jobs run: 'pbs', 'slurm' or 'local' (every subband on this machine, sharing its cores)
+executor = 'pbs'
+use_executor(make_executor(executor))
+
+# Hand the chaining to the scheduler (-W depend=afterok) so every job is queued up front
+pbs_depend = False
+
+# The jobs that become ready together are submitted side by side (quick_attack.py), at most submit_concurrency
+# qsub calls at a time, each retried with backoff when the server does not answer. With use_job_arrays the
+# jobs of one stage that wait for nothing in the queue go in as a single job array (qsub -J or -t, sbatch --array),
+# not together with pbs_depend. Off by default: every subjob asks for the largest ppn, memory and walltime
+# of its stage.
+use_job_arrays = False
+submit_concurrency = 8
+
+# Node-local scratch for the subband jobs: each job copies its MSs and tables there, runs on the copy and
+# copies back only what it changed, so the shared filesystem is not hammered by every subband at once.
+# Shell variables are expanded on the node ('$TMPDIR', '/scratch/$USER'); a job whose inputs do not fit
+# (staging_headroom x their size) runs in place. None runs every job on the shared filesystem.
+scratch_dir = None
+staging_headroom = 2.0
+use_staging(scratch_dir, staging_headroom)
+
+# 'band' splits every subband in one job that reads the parent MS once,
+# 'subband' runs one split job per subband (the parent is then read once per subband)
+split_mode = 'band'
+
+# Skip stages that already finished for the same inputs, so a failed run resumes where it broke
+use_cache = True
+
+# Who flags the source in flag_src and flag_after_cal: 'casa' (flagdata) or 'native' (slash.py, the
+# same passes in NumPy, one process per job spread over its cores). flag_cal always uses flagdata.
+flagger = 'casa'
+
+# Image the source of every subband as soon as it is flagged: 'tclean' (under mpicasa with parallel major
+# cycles on the Multi-MS) or 'wsclean' (one process on all cores of the job). None, the default, stops
+# after flag_after_cal.
+# imaging_params go on top of dragon_breath.IMAGING (imsize, cell, gridder, facets, ...). The subband
+# images are then combined into one wideband image, weighted by their noise.
+imager = None
+imaging_params = {}
+wideband_image = 'band/' + src_name + '.wideband.image'
+
+# Self-calibrate the source of every subband before its final image, see dragon_breath.SELFCAL_ROUNDS.
+# Each subband stops on its own once its dynamic range stops improving; the final image is then made
+# from spwN/src.selfcal.ms. Only used when there is an imager; off by default, it runs up to
+# len(SELFCAL_ROUNDS) tclean and gaincal rounds per subband.
+use_selfcal = False
+
+# 'pbs' submits every stage as its own job, 'worker' keeps one CASA session per subband alive
+# (fire_spin.py) and runs the stages of that subband in it one after the other
+execution_mode = 'pbs'
+
+logger_t.info('Subbanding, flagging and calibrating each subband independently.......')
+
+if execution_mode == 'worker':
+    def subband_stages(subband, spw):
+        caltable_pref = subband + '/caltables/cal'
+        stages = [
+            ('mstransform', subbanding_script(ms_name, spw, subband, cal_name, src_name)),
+            ('flag_cal', flag_cal_script(subband+'/cal.ms', caltable_pref, amp_cal, phase_cal)),
+            ('flag_src', flag_src_script(subband+'/src.ms', src_name, flagger)),
+            ('apply_cal', apply_cal_script(subband+'/cal.ms', subband+'/src.ms', caltable_pref, amp_cal, phase_cal, src_name,
+                                           polcal=use_polcal)),
+            ('flag_after_cal', flag_after_cal_script(subband+'/cal.ms', subband+'/src.ms', flagger=flagger)),
+        ]
+        if use_polcal:
+            stages.insert(2, ('pol_cal', pol_cal_script(subband+'/cal.ms', caltable_pref, pol_cal_name, leak_cal, leak_poltype=leak_poltype)))
+        image_ms = subband + '/src.ms'
+        if imager and use_selfcal:
+            stages.append(('selfcal', selfcal_script(image_ms, subband+'/src.selfcal.ms', subband+'/selfcal/'+src_name, imaging_params)))
+            image_ms = subband + '/src.selfcal.ms'
+        if imager:
+            stages.append(('image', image_script(image_ms, subband+'/images/'+src_name, imaging_params)))
+        return stages
+
+    if imager == 'wsclean':
+        raise ValueError("The worker mode runs CASA scripts only, image with tclean or use execution_mode = 'pbs'")
+
+    with ThreadPoolExecutor(max_workers=len(subbands_dict)) as pool:
+        results = list(pool.map(lambda item: run_chain_on_worker(item[0], subband_stages(*item), casa_dir, logger_t),
+                                subbands_dict.items()))
+    failed_tasks = [f'{stage}_{subband}' for subband, (ok, stage) in zip(subbands_dict, results) if not ok]
+    all_successful = not failed_tasks
+
+    if imager and all_successful:
+        os.makedirs('band', exist_ok=True)
+        images = [image_product(subband+'/images/'+src_name, imager, imaging_params) for subband in subbands_dict]
+        ok, stage = run_chain_on_worker('band', [('combine_images', combine_images_script(images, wideband_image))], casa_dir, logger_t)
+        if not ok:
+            failed_tasks.append(f'{stage}_band')
+            all_successful = False
 
-    # Proceed to next steps
 else:
-    logger_t.error('Source flagging has failed, check out.... ' + ', '.join(failed_jobs))
-    sys.exit(1)
-    # Handle failure case
-
-
-if all_successful & all_successful1:
-    logger_t.info('Proceeding with applying the solutions.....')
-else:
-    sys.exit(1)
-
-
-
-job_info = []
-for subband, spw in subbands_dict.items():
-    caltable_pref = subband + '/caltables/cal'
-    job_id, subband_name = apply_cal(subband+'/cal.ms', subband+'/src.ms',subband, caltable_pref,casa_dir , logger_t, amp_cal, phase_cal,src_name)
-    if job_id:
-        job_info.append((job_id, subband_name))
-
-# Specify the base output directory
-base_output_dir = '/home/apal/rcs'
-
-# Wait for all jobs to finish
-all_successful, failed_jobs = wait_for_jobs_to_finish(job_info, base_output_dir, logger_t,'mstransform')
+    # Every subband runs through its own chain and moves on as soon as its own inputs are ready:
+    #   mstransform -> flag_cal -> apply_cal_cal -> flag_after_cal_cal
+    #              \-> flag_src -(+ flag_cal)-> apply_cal_src -> flag_after_cal_src -> selfcal -> image
+    # with pol_cal after flag_cal, next to flag_src, when the polarization tables are applied as well
+    # and the images of all subbands meet in combine_images
+
+    dag = {}
+    images = {}
+    os.makedirs('band', exist_ok=True)
+    if split_mode == 'band':
+        band_outputs = [f'{subband}/{name}' for subband in subbands_dict for name in ('cal.ms', 'src.ms')]
+        band_split = add_task(dag, 'split_band', 'band', 'split',
+                              partial(split_band, ms_name, subbands_dict, casa_dir, logger_t, cal_name, src_name, mms_axis=mms_axis, numsubms=numsubms),
+                              cache=cache_entry(split_band_script(ms_name, subbands_dict, cal_name, src_name, 'band', mms_axis, numsubms),
+                                                band_outputs, [ms_name], scratch=['band/band.ms']))
 
-if all_successful:
-    logger_t.info('All PBS scripts to apply_cal have run successfully. Proceeding to next steps.')
     for subband, spw in subbands_dict.items():
-        cleanup_files(subband,logger_t,'apply_cal')
-
-    # Proceed to next steps
-else:
-    logger_t.error('Some PBS scripts failed. The following subbands had issues: ' + ', '.join(failed_jobs))
-    sys.exit(1)
-    # Handle failure case
-
-
-
-job_info = []
-for subband, spw in subbands_dict.items():
-    job_id, subband_name = flag_after_cal(subband+'/cal.ms', subband+'/src.ms', subband,casa_dir, logger_t)
-    if job_id:
-        job_info.append((job_id, subband_name))
-
-# Specify the base output directory
-base_output_dir = '/home/apal/rcs'
-
-# Wait for all jobs to finish
-all_successful, failed_jobs = wait_for_jobs_to_finish(job_info, base_output_dir, logger_t,'flag_after_cal')
+        caltable_pref = subband + '/caltables/cal'
+        if split_mode == 'band':
+            split = band_split
+        else:
+            split = add_task(dag, f'mstransform_{subband}', subband, 'mstransform',
+                             partial(subbanding, ms_name, subband, spw, subband, casa_dir, logger_t, cal_name, src_name,
+                                     mms_axis=mms_axis, numsubms=numsubms),
+                             cache=cache_entry(subbanding_script(ms_name, spw, subband, cal_name, src_name, mms_axis, numsubms),
+                                               [subband+'/cal.ms', subband+'/src.ms'], [ms_name], scratch=[subband+'/fields.ms']))
+        caltables = [caltable_pref + ext for ext in ('.G0', '.K1', '.B1', '.AP.G', '.fluxscale')]
+        cal = add_task(dag, f'flag_cal_{subband}', subband, 'flag_cal',
+                       partial(flag_cal, subband+'/cal.ms', subband, caltable_pref, casa_dir, logger_t, amp_cal, phase_cal), [split],
+                       cache=cache_entry(flag_cal_script(subband+'/cal.ms', caltable_pref, amp_cal, phase_cal), caltables))
+        src = add_task(dag, f'flag_src_{subband}', subband, 'flag_src',
+                       partial(flag_src, subband+'/src.ms', subband, casa_dir, logger_t, src_name, flagger=flagger), [split],
+                       cache=cache_entry(flag_src_script(subband+'/src.ms', src_name, flagger), []))
+        if use_polcal:
+            cal = add_task(dag, f'pol_cal_{subband}', subband, 'pol_cal',
+                           partial(pol_cal, subband+'/cal.ms', subband, caltable_pref, casa_dir, logger_t, pol_cal_name, leak_cal,
+                                   leak_poltype=leak_poltype), [cal],
+                           cache=cache_entry(pol_cal_script(subband+'/cal.ms', caltable_pref, pol_cal_name, leak_cal, leak_poltype=leak_poltype),
+                                             pol_tables_of(caltable_pref)))
+        # The calibrators are corrected and flagged as soon as their tables exist, the source once its own
+        # tfcrop is done as well, so each subband takes as long as the slower of the two branches
+        for part, deps in (('cal', [cal]), ('src', [cal, src])):
+            apply = add_task(dag, f'apply_cal_{part}_{subband}', subband, part_prefix('apply_cal', (part,)),
+                             partial(apply_cal, subband+'/cal.ms', subband+'/src.ms', subband, caltable_pref, casa_dir, logger_t, amp_cal, phase_cal, src_name,
+                                     targets=(part,), polcal=use_polcal), deps,
+                             cache=cache_entry(apply_cal_script(subband+'/cal.ms', subband+'/src.ms', caltable_pref, amp_cal, phase_cal, src_name, (part,),
+                                                                use_polcal), []))
+            flagged = add_task(dag, f'flag_after_cal_{part}_{subband}', subband, part_prefix('flag_after_cal', (part,)),
+                               partial(flag_after_cal, subband+'/cal.ms', subband+'/src.ms', subband, casa_dir, logger_t, targets=(part,),
+                                       flagger=flagger), [apply],
+                               cache=cache_entry(flag_after_cal_script(subband+'/cal.ms', subband+'/src.ms', (part,), flagger), []))
+        image_ms, image_deps = subband + '/src.ms', [flagged]
+        if imager and use_selfcal:
+            selfcal_ms = subband + '/src.selfcal.ms'
+            image_deps = [add_task(dag, f'selfcal_{subband}', subband, 'selfcal',
+                                   partial(selfcal, image_ms, selfcal_ms, subband, subband+'/selfcal/'+src_name, casa_dir, logger_t,
+                                           params=imaging_params), image_deps,
+                                   cache=cache_entry(selfcal_script(image_ms, selfcal_ms, subband+'/selfcal/'+src_name, imaging_params),
+                                                     [selfcal_ms]))]
+            image_ms = selfcal_ms
+        if imager:
+            imagename = subband + '/images/' + src_name
+            image_cache = (image_script(image_ms, imagename, imaging_params) if imager == 'tclean'
+                           else wsclean_command(image_ms, imagename, imaging_params))
+            product = image_product(imagename, imager, imaging_params)
+            imaged = add_task(dag, f'image_{subband}', subband, 'image',
+                              partial(image, image_ms, subband, imagename, casa_dir, logger_t, imager=imager, params=imaging_params),
+                              image_deps, cache=cache_entry(image_cache, [product]))
+            images[imaged] = product
+
+    if images:
+        add_task(dag, 'combine_images_band', 'band', 'combine_images',
+                 partial(combine_images, list(images.values()), wideband_image, casa_dir, logger_t), list(images),
+                 cache=cache_entry(combine_images_script(list(images.values()), wideband_image), [wideband_image]))
+
+    all_successful, failed_tasks = run_dag(dag, base_output_dir, logger_t, pbs_depend=pbs_depend, use_cache=use_cache,
+                                           use_arrays=use_job_arrays, concurrency=submit_concurrency)
+
+    # Where the time went, per CASA task, stage and subband, for the jobs that ran this time
+    ran = [(task['subband'], task['prefix']) for task in dag.values() if task['job_id'] is not None]
+    write_profile_report(base_output_dir, ran, f'profile_{start_time}.json', logger_t)
 
 if all_successful:
-    logger_t.info('All PBS scripts to apply_cal have run successfully. Proceeding to next steps.')
-    for subband, spw in subbands_dict.items():
-        cleanup_files(subband,logger_t,'flag_after_cal')
-
-    # Proceed to next steps
+    logger_t.info('All subbands are split, flagged and calibrated' + (f', the wideband image is {wideband_image}.' if imager else '.'))
 else:
-    logger_t.error('Some PBS scripts failed. The following subbands had issues: ' + ', '.join(failed_jobs))
+    logger_t.error('Some PBS scripts failed or were skipped: ' + ', '.join(failed_tasks))
     sys.exit(1)
-    # Handle failure case
-
-
-
@@ -0,0 +1,190 @@
+# Where the walltime goes. Every CASA script written by dragon_breath gets a preamble that wraps the CASA
+# tasks it calls; each call records its wall time, CPU time, peak RSS and the bytes read and written
+# (/proc/self/io) to a JSON file next to the job log. At the end of a run the files of all jobs are
+# merged into one profile, per task and per subband.
+#
+# Under mpicasa the servers do most of the reading and writing, the numbers are those of the client.
+
+import json
+import os
+
+PROFILED_TASKS = ('flagdata', 'setjy', 'gaincal', 'bandpass', 'fluxscale', 'applycal', 'mstransform', 'split',
+                  'tclean', 'imsmooth', 'imregrid', 'polcal')
+
+PROFILE_PREAMBLE = """# --- profiling preamble (foresight.py) ---
+import json as _json
+import os as _os
+import resource as _resource
+import time as _time
+
+_profile_file = {profile_file!r}
+_profile = []
+
+def _read_io():
+    counters = {{}}
+    try:
+        with open('/proc/self/io', 'r') as file:
+            for line in file:
+                key, value = line.split(':')
+                counters[key] = int(value)
+    except OSError:
+        pass
+    return counters
+
+def _reset_peak_rss():
+    # Writing 5 to clear_refs resets VmHWM, so the peak is that of the call alone
+    try:
+        with open('/proc/self/clear_refs', 'w') as file:
+            file.write('5')
+        return True
+    except OSError:
+        return False
+
+def _peak_rss_kb(reset):
+    if reset:
+        try:
+            with open('/proc/self/status', 'r') as file:
+                for line in file:
+                    if line.startswith('VmHWM:'):
+                        return int(line.split()[1])
+        except OSError:
+            pass
+    return _resource.getrusage(_resource.RUSAGE_SELF).ru_maxrss
+
+class _Profiled:
+    def __init__(self, name, task):
+        self._name = name
+        self._task = task
+
+    def __getattr__(self, attr):
+        return getattr(self._task, attr)
+
+    def __call__(self, *args, **kwargs):
+        reset = _reset_peak_rss()
+        io_before = _read_io()
+        children_before = _resource.getrusage(_resource.RUSAGE_CHILDREN)
+        cpu_before = _time.process_time()
+        start = _time.monotonic()
+        status = 'error'
+        try:
+            result = self._task(*args, **kwargs)
+            status = 'ok'
+            return result
+        finally:
+            children_after = _resource.getrusage(_resource.RUSAGE_CHILDREN)
+            io_after = _read_io()
+            _profile.append({{
+                'task': self._name,
+                'vis': kwargs.get('vis', args[0] if args else None),
+                'status': status,
+                'wall_seconds': _time.monotonic() - start,
+                'cpu_seconds': _time.process_time() - cpu_before
+                               + children_after.ru_utime - children_before.ru_utime
+                               + children_after.ru_stime - children_before.ru_stime,
+                'peak_rss_kb': _peak_rss_kb(reset),
+                'read_bytes': io_after.get('read_bytes', 0) - io_before.get('read_bytes', 0),
+                'write_bytes': io_after.get('write_bytes', 0) - io_before.get('write_bytes', 0),
+                'rchar': io_after.get('rchar', 0) - io_before.get('rchar', 0),
+                'wchar': io_after.get('wchar', 0) - io_before.get('wchar', 0),
+            }})
+            # Written after every call, so a job that dies still leaves what it got through
+            with open(_profile_file + '.tmp', 'w') as file:
+                _json.dump(_profile, file, indent=1)
+            _os.replace(_profile_file + '.tmp', _profile_file)
+
+for _name in {tasks!r}:
+    if _name in globals():
+        globals()[_name] = _Profiled(_name, globals()[_name])
+
+if 'default' in globals():
+    _default = default
+    def default(task):
+        return _default(task._task if isinstance(task, _Profiled) else task)
+# --- end of profiling preamble ---
+
+"""
+
+
+def profile_file_path(output_dir, subband, prefix):
+    return os.path.join(output_dir, f"{prefix}_{subband}.profile.json")
+
+
+def instrument_script(script, profile_file, tasks=PROFILED_TASKS):
+    """
+    Put the profiling preamble in front of a CASA script, so the calls to tasks are recorded in profile_file.
+    """
+    return PROFILE_PREAMBLE.format(profile_file=profile_file, tasks=tuple(tasks)) + script
+
+
+def read_profile(profile_file):
+    try:
+        with open(profile_file, 'r') as file:
+            return json.load(file)
+    except (OSError, ValueError):
+        return []
+
+
+def merge_profiles(base_output_dir, jobs):
+    """
+    Collect the task calls of the given jobs, a list of (subband, prefix).
+    Returns a list of calls, each with the subband and stage (prefix) it ran in.
+    """
+    calls = []
+    for subband, prefix in jobs:
+        for call in read_profile(profile_file_path(os.path.join(base_output_dir, subband), subband, prefix)):
+            calls.append(dict(call, subband=subband, stage=prefix))
+    return calls
+
+
+def summarise(calls, key):
+    """
+    Totals of the calls grouped by key ('task', 'subband' or 'stage'), largest wall time first.
+    """
+    totals = {}
+    for call in calls:
+        total = totals.setdefault(call[key], {'calls': 0, 'wall_seconds': 0.0, 'cpu_seconds': 0.0, 'peak_rss_kb': 0,
+                                              'read_bytes': 0, 'write_bytes': 0})
+        total['calls'] += 1
+        total['wall_seconds'] += call['wall_seconds']
+        total['cpu_seconds'] += call['cpu_seconds']
+        total['peak_rss_kb'] = max(total['peak_rss_kb'], call['peak_rss_kb'])
+        total['read_bytes'] += call['read_bytes']
+        total['write_bytes'] += call['write_bytes']
+    return dict(sorted(totals.items(), key=lambda item: -item[1]['wall_seconds']))
+
+
+def format_summary(title, totals):
+    lines = [f"{title:<16} {'calls':>5} {'wall [s]':>10} {'cpu [s]':>10} {'peak RSS [GB]':>13} {'read [GB]':>10} {'written [GB]':>12}"]
+    for name, total in totals.items():
+        lines.append(f"{name:<16} {total['calls']:>5} {total['wall_seconds']:>10.1f} {total['cpu_seconds']:>10.1f} "
+                     f"{total['peak_rss_kb'] / 1e6:>13.2f} {total['read_bytes'] / 1e9:>10.2f} {total['write_bytes'] / 1e9:>12.2f}")
+    return "\n".join(lines)
+
+
+def write_profile_report(base_output_dir, jobs, report_file, logger, slowest=10):
+    """
+    Merge the profiles of the jobs into report_file (JSON) and log the totals per task, stage and
+    subband and the slowest single calls, which is where to look for the bottleneck.
+    """
+    calls = merge_profiles(base_output_dir, jobs)
+    if not calls:
+        logger.info("No task profiles to report.")
+        return None
+
+    report = {
+        'tasks': summarise(calls, 'task'),
+        'stages': summarise(calls, 'stage'),
+        'subbands': summarise(calls, 'subband'),
+        'calls': sorted(calls, key=lambda call: -call['wall_seconds']),
+    }
+    with open(report_file, 'w') as file:
+        json.dump(report, file, indent=2)
+
+    logger.info("Profile per task:\n" + format_summary('task', report['tasks']))
+    logger.info("Profile per stage:\n" + format_summary('stage', report['stages']))
+    logger.info("Profile per subband:\n" + format_summary('subband', report['subbands']))
+    logger.info("Slowest calls:\n" + "\n".join(
+        f"{call['wall_seconds']:10.1f} s  {call['stage']}_{call['subband']}  {call['task']}({call['vis']})"
+        for call in report['calls'][:slowest]))
+    logger.info(f"Profile written to {report_file}")
+    return report
@@ -0,0 +1,201 @@
+# Resource requests per stage. Instead of asking for ppn=6 and 10 hours for every job, each stage is sized
+# from the number of visibilities it has to go through (rows x channels x correlations of its MS) and a
+# cost per visibility. The cost starts from a rough guess per stage and is replaced by the runtimes of
+# earlier runs as soon as there are some, so short jobs ask for short walltimes and backfill quickly.
+#
+# mpicasa only helps tasks that run on a Multi-MS (one sub-MS per rank), so a plain MS always gets a
+# single rank.
+
+import json
+import math
+import os
+
+from rest import fingerprint_path
+from scale_shot import open_table
+
+# Runtimes of earlier runs, kept in the working directory
+HISTORY_FILE = 'stage_history.json'
+HISTORY_LENGTH = 20
+
+# Per stage: first guess of the core-seconds per visibility, whether the stage spreads over the
+# sub-MSs of a Multi-MS, the memory per CASA process in GB and, for stages that run some of their
+# tasks side by side, the cores they need for that
+STAGE_COSTS = {
+    'mstransform': {'seconds_per_vis': 5e-7, 'parallel': False, 'mem_per_rank_gb': 4},
+    'split': {'seconds_per_vis': 8e-7, 'parallel': False, 'mem_per_rank_gb': 8},
+    'flag_cal': {'seconds_per_vis': 3e-6, 'parallel': True, 'mem_per_rank_gb': 4, 'min_ppn': 2},
+    'pol_cal': {'seconds_per_vis': 1e-6, 'parallel': False, 'mem_per_rank_gb': 4},
+    'flag_src': {'seconds_per_vis': 1.5e-6, 'parallel': True, 'mem_per_rank_gb': 3},
+    'apply_cal': {'seconds_per_vis': 1e-6, 'parallel': True, 'mem_per_rank_gb': 3},
+    'flag_after_cal': {'seconds_per_vis': 6e-6, 'parallel': True, 'mem_per_rank_gb': 3},
+    # One CASA session for every round, about the cost of four imaging jobs
+    'selfcal': {'seconds_per_vis': 8e-5, 'parallel': True, 'mem_per_rank_gb': 6, 'min_ppn': 4},
+    'image': {'seconds_per_vis': 2e-5, 'parallel': True, 'mem_per_rank_gb': 6, 'min_ppn': 4},
+    # Sized from the first subband image, its size on disk stands in for the visibilities
+    'combine_images': {'seconds_per_vis': 1e-6, 'parallel': False, 'mem_per_rank_gb': 16},
+}
+
+# Rough size of one visibility on disk (data, flag and weight), used when the MS cannot be opened
+BYTES_PER_VIS = 12
+
+_limits = {
+    'max_ranks': 16,            # cores of one node
+    'mem_per_node_gb': 256,
+    'target_seconds': 3600,     # add ranks until a job is expected to take about this long
+    'safety': 2.0,              # walltime = estimate x safety
+    'min_walltime': 1800,
+    'max_walltime': 24 * 3600,
+}
+
+def use_node_limits(**limits):
+    """
+    Change the node size and walltime bounds the stages are sized against, see _limits.
+    """
+    for key in limits:
+        if key not in _limits:
+            raise ValueError(f"Unknown limit: {key}")
+    _limits.update(limits)
+
+
+def is_multi_ms(ms_name):
+    return os.path.isdir(os.path.join(ms_name, 'SUBMSS'))
+
+
+def count_sub_ms(ms_name):
+    if not is_multi_ms(ms_name):
+        return 1
+    return max(1, len(os.listdir(os.path.join(ms_name, 'SUBMSS'))))
+
+
+def count_visibilities(ms_name):
+    """
+    Rows x channels x correlations of an MS, estimated from its size on disk when neither casatools
+    nor casacore can open it. Returns None if the MS is not there (yet).
+    """
+    try:
+        tb = open_table(ms_name)
+        rows = tb.nrows()
+        tb.close()
+        tb = open_table(ms_name + '/SPECTRAL_WINDOW')
+        chans = max(tb.getcol('NUM_CHAN'))
+        tb.close()
+        tb = open_table(ms_name + '/POLARIZATION')
+        corrs = max(tb.getcol('NUM_CORR'))
+        tb.close()
+        return int(rows) * int(chans) * int(corrs)
+    except Exception:
+        pass
+    fingerprint = fingerprint_path(ms_name)
+    if fingerprint is None:
+        return None
+    return fingerprint['size'] // BYTES_PER_VIS
+
+
+def read_history(history_file=HISTORY_FILE):
+    try:
+        with open(history_file, 'r') as file:
+            return json.load(file)
+    except (OSError, ValueError):
+        return {}
+
+
+def seconds_per_vis(stage, history_file=HISTORY_FILE):
+    """
+    Core-seconds per visibility of a stage: the median of the recorded runs, the first guess without any.
+    """
+    runs = read_history(history_file).get(stage, [])
+    rates = sorted(run['seconds'] * run['workers'] / run['visibilities'] for run in runs if run['visibilities'] > 0)
+    if not rates:
+        return STAGE_COSTS[stage]['seconds_per_vis']
+    return rates[len(rates) // 2]
+
+
+def format_walltime(seconds):
+    # Whole quarters of an hour
+    minutes = int(math.ceil(seconds / 900.0)) * 15
+    return f"{minutes // 60:02d}:{minutes % 60:02d}:00"
+
+
+def size_stage(stage, ms_name, history_file=HISTORY_FILE):
+    """
+    Work out the resources of one job. Returns a dict with ppn, ranks, mem_gb and walltime for the
+    PBS script, plus the stage and visibility count, which are stored with the job so its runtime can
+    be recorded afterwards. An MS that does not exist yet gets one rank and the longest walltime.
+    """
+    cost = STAGE_COSTS[stage]
+    visibilities = count_visibilities(ms_name)
+    if visibilities is None:
+        ranks, seconds = 1, _limits['max_walltime']
+    else:
+        serial_seconds = seconds_per_vis(stage, history_file) * visibilities
+        ranks = 1
+        if cost['parallel'] and is_multi_ms(ms_name):
+            # One client plus servers, no more servers than there are sub-MSs
+            wanted = 1 + math.ceil(serial_seconds / _limits['target_seconds'])
+            ranks = max(1, min(wanted, count_sub_ms(ms_name) + 1, _limits['max_ranks']))
+        servers = max(1, ranks - 1)
+        seconds = serial_seconds / servers * _limits['safety']
+        seconds = min(max(seconds, _limits['min_walltime']), _limits['max_walltime'])
+
+    ppn = max(ranks, cost.get('min_ppn', 1))
+    mem_gb = min(int(math.ceil(ppn * cost['mem_per_rank_gb'])), _limits['mem_per_node_gb'])
+    return {
+        'stage': stage,
+        'visibilities': visibilities,
+        'ranks': ranks,
+        'ppn': ppn,
+        'mem_gb': mem_gb,
+        'walltime': format_walltime(seconds),
+    }
+
+
+def sizing_file_path(output_dir, subband, prefix):
+    return os.path.join(output_dir, f"{prefix}_{subband}.sizing")
+
+
+def runtime_file_path(output_dir, subband, prefix):
+    """
+    The PBS scripts write the seconds they ran for here when they exit.
+    """
+    return os.path.join(output_dir, f"{prefix}_{subband}.runtime")
+
+
+def write_sizing(sizing_file, resources):
+    with open(sizing_file, 'w') as file:
+        json.dump(resources, file)
+
+
+def read_sizing(sizing_file):
+    """
+    The resources a job was given, or None if it was not sized.
+    """
+    try:
+        with open(sizing_file, 'r') as file:
+            return json.load(file)
+    except (OSError, ValueError):
+        return None
+
+
+def record_runtime(output_dir, subband, prefix, logger, history_file=HISTORY_FILE):
+    """
+    Add the runtime of a finished job to the history, so the next run sizes the stage from it.
+    """
+    resources = read_sizing(sizing_file_path(output_dir, subband, prefix))
+    try:
+        with open(runtime_file_path(output_dir, subband, prefix), 'r') as file:
+            seconds = int(file.read().strip())
+    except (OSError, ValueError):
+        return
+    if resources is None or not resources.get('visibilities'):
+        return
+
+    history = read_history(history_file)
+    runs = history.setdefault(resources['stage'], [])
+    runs.append({'visibilities': resources['visibilities'], 'workers': max(1, resources['ranks'] - 1), 'seconds': seconds})
+    del runs[:-HISTORY_LENGTH]
+
+    tmp_file = history_file + '.tmp'
+    with open(tmp_file, 'w') as file:
+        json.dump(history, file, indent=2)
+    os.replace(tmp_file, history_file)
+    logger.debug(f"{prefix}_{subband} took {seconds} s for {resources['visibilities']} visibilities on {resources['ppn']} cores")
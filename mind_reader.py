@@ -0,0 +1,110 @@
+# Follow the output of running jobs. Each job writes what CASA prints (with --log2term) to a live log;
+# a LogMonitor reads whatever was added since the last look, from the offset where it stopped, and sorts
+# the lines into CASA log levels, task start and end markers and Python tracebacks. A SEVERE message or a
+# traceback marks the job as failed while it is still running, so a long job that breaks in its first
+# minute is caught straight away instead of when it leaves the queue.
+
+import os
+import re
+
+# 2024-05-01 10:00:00	INFO	flagdata::::	##### Begin Task: flagdata           #####
+LOG_LINE = re.compile(r'^\d{4}-\d{2}-\d{2}\s+\d{2}:\d{2}:\d{2}(?:\.\d+)?\s+(SEVERE|WARN|INFO\d?|DEBUG\d?)\s+(\S*)\s*(.*)$')
+TASK_MARKER = re.compile(r'#+\s*(Begin|End) Task:\s*(\w+)')
+# Under mpicasa the servers put their rank in the origin of every message
+MPI_SERVER = re.compile(r'MPIServer-(\d+)')
+
+
+def classify_line(line):
+    """
+    Sort one line of job output. Returns (kind, task) where kind is 'begin', 'end', 'severe',
+    'traceback', 'warn', 'info' or 'other', and task is the CASA task named by a start or end
+    marker, or the origin of a log message when there is one.
+    """
+    match = LOG_LINE.match(line)
+    if match is None:
+        if line.startswith('Traceback (most recent call last)'):
+            return 'traceback', None
+        return 'other', None
+
+    level, origin, message = match.groups()
+    marker = TASK_MARKER.search(message)
+    if marker:
+        return ('begin' if marker.group(1) == 'Begin' else 'end'), marker.group(2)
+    task = origin.split(':')[0] or None
+    if level == 'SEVERE':
+        return 'severe', task
+    if level == 'WARN':
+        return 'warn', task
+    return 'info', task
+
+
+class LogMonitor:
+    """
+    Read a growing log file incrementally. poll() returns the new events as (kind, task, line),
+    leaving out plain info and other lines. The counts of started and finished tasks and warnings
+    are kept, servers holds the mpicasa ranks that logged anything, and fatal holds the first
+    SEVERE message or traceback line.
+    """
+
+    def __init__(self, log_file, chunk_size=1 << 20):
+        self.log_file = log_file
+        self.chunk_size = chunk_size
+        self.offset = 0
+        self.partial = b''
+        self.current_task = None
+        self.tasks_started = 0
+        self.tasks_done = 0
+        self.warnings = 0
+        self.servers = set()
+        self.fatal = None
+
+    def poll(self, final=False):
+        """
+        Read what was added to the file since the last call. A line that is still being written is
+        kept for the next call, unless final is set because the job is over.
+        """
+        try:
+            with open(self.log_file, 'rb') as file:
+                if os.fstat(file.fileno()).st_size < self.offset:
+                    # The file was started again, e.g. by a resubmitted job
+                    self.offset, self.partial = 0, b''
+                file.seek(self.offset)
+                data = file.read(self.chunk_size)
+                while data:
+                    self.offset += len(data)
+                    self.partial += data
+                    data = file.read(self.chunk_size)
+        except OSError:
+            return []
+
+        lines = self.partial.split(b'\n')
+        self.partial = lines.pop()
+        if final and self.partial:
+            lines.append(self.partial)
+            self.partial = b''
+
+        events = []
+        for raw in lines:
+            line = raw.decode(errors='replace').rstrip('\r')
+            kind, task = classify_line(line)
+            server = MPI_SERVER.search(line)
+            if server:
+                self.servers.add(int(server.group(1)))
+                if kind in ('begin', 'end'):
+                    # Servers run their share of a task the client already announced
+                    continue
+            if kind == 'begin':
+                self.current_task = task
+                self.tasks_started += 1
+            elif kind == 'end':
+                self.current_task = None
+                self.tasks_done += 1
+            elif kind == 'warn':
+                self.warnings += 1
+            elif kind in ('severe', 'traceback'):
+                if self.fatal is None:
+                    self.fatal = line
+            else:
+                continue
+            events.append((kind, task, line))
+        return events
@@ -0,0 +1,224 @@
+# Getting jobs into the queue. A qsub takes a second or more on a busy server and fails now and then when
+# the server is slow to answer, so submitting 32 subbands one blocking call after the other is slow, and a
+# subband whose qsub failed once would never run. Here every job of a wave is submitted at the same time
+# (asyncio, the blocking executor calls run on a thread pool), a failed submission is retried with
+# exponential backoff, and jobs of the same stage that wait for nothing go in as one job array
+# (qsub -J or -t, sbatch --array), one submission for all subbands.
+#
+# run_dag collects the jobs of a wave with deferred_submission(): inside it submit_pbs_script only
+# records the job (PendingJob) and the actual submission happens in submit_jobs.
+
+import asyncio
+import contextlib
+import os
+import random
+import subprocess
+import threading
+
+from rock_slide import current_executor, read_pbs_directives, ARRAY_LOG_DIR
+
+SUBMIT_RETRIES = 5
+SUBMIT_BACKOFF = 2.0        # seconds before the first retry, doubled for every further one
+SUBMIT_CONCURRENCY = 8      # submissions in flight at once, so the server is not flooded
+
+# Complaints of qsub and sbatch about the job itself, another try will not fix them
+PERMANENT_ERRORS = (
+    # qsub (Torque, PBS Pro)
+    'unknown queue', 'illegal attribute or resource value', 'unknown resource', 'job exceeds queue resource limits',
+    'job violates queue and/or server resource limits', 'unauthorized request', 'bad uid for job execution',
+    'job rejected by all possible destinations', 'illegal -l value', 'illegal -j value', 'illegal -w value',
+    # sbatch
+    'invalid account or account/partition combination', 'invalid partition', 'invalid qos specification',
+    'requested node configuration is not available', 'job violates accounting/qos policy', 'requested time limit is invalid',
+    'invalid job array specification', 'memory specification can not be satisfied', 'unable to open file',
+    # either, the script or the command is not there
+    'no such file or directory',
+)
+
+_local = threading.local()
+
+
+class PendingJob:
+    """
+    A job script that is written but not submitted yet. group is the stage prefix, jobs of the same group
+    without dependencies can share one job array.
+    """
+
+    def __init__(self, script_file, subband, depend=None, group=None):
+        self.script_file = script_file
+        self.subband = subband
+        self.depend = list(depend or [])
+        self.group = group
+
+    def __repr__(self):
+        return f"PendingJob({self.script_file!r})"
+
+
+@contextlib.contextmanager
+def deferred_submission():
+    """
+    Within this block submit_pbs_script records its job instead of submitting it (see submission_deferred).
+    """
+    _local.deferred = True
+    try:
+        yield
+    finally:
+        _local.deferred = False
+
+
+def submission_deferred():
+    return getattr(_local, 'deferred', False)
+
+
+def error_text(error):
+    text = str(error)
+    stderr = getattr(error, 'stderr', None)
+    if stderr:
+        text += ': ' + (stderr.decode() if isinstance(stderr, bytes) else stderr).strip()
+    return text
+
+
+def is_transient(error):
+    """
+    Whether a failed submission is worth another try: scheduler errors are, unless qsub or sbatch
+    rejected the job itself (PERMANENT_ERRORS).
+    """
+    if not isinstance(error, (subprocess.CalledProcessError, OSError)):
+        return False
+    text = error_text(error).lower()
+    return not any(message in text for message in PERMANENT_ERRORS)
+
+
+async def submit_with_retry(call, label, logger, semaphore, retries=SUBMIT_RETRIES, backoff=SUBMIT_BACKOFF):
+    """
+    Run the blocking submission call on a thread and return its result, retrying transient failures
+    after backoff, 2 x backoff, 4 x backoff, ... seconds (plus some jitter, so retries of a wave spread
+    out). Returns None once the retries are used up or the failure is permanent.
+    """
+    loop = asyncio.get_running_loop()
+    for attempt in range(retries + 1):
+        try:
+            async with semaphore:
+                return await loop.run_in_executor(None, call)
+        except (subprocess.CalledProcessError, OSError) as e:
+            if not is_transient(e) or attempt == retries:
+                logger.error(f"Submission of {label} failed for good after {attempt + 1} attempts: {error_text(e)}")
+                return None
+            delay = backoff * 2 ** attempt * (1 + random.random() / 2)
+            logger.warning(f"Submission of {label} failed ({error_text(e)}), retrying in {delay:.1f} s")
+            await asyncio.sleep(delay)
+
+
+def walltime_seconds(walltime):
+    hours, minutes, seconds = (int(part) for part in walltime.split(':'))
+    return hours * 3600 + minutes * 60 + seconds
+
+
+def array_script(jobs, group):
+    """
+    Write the job array script for jobs of one group and return its file name. Each subjob runs the
+    script of one job with bash, the #PBS lines of those scripts are comments then, so the array asks
+    for the largest ppn, memory and walltime of them. The scripts do their own logging and write their
+    own sentinels, the array only has a PBS log per subjob in ARRAY_LOG_DIR.
+    """
+    directives = [read_pbs_directives(job.script_file) for job in jobs]
+    ppn = max(d['ppn'] for d in directives)
+    mem = max((d['mem'] for d in directives if d['mem']), default=None)
+    walltimes = [d['walltime'] for d in directives if d['walltime']]
+    walltime = max(walltimes, key=walltime_seconds) if walltimes else None
+    queue = directives[0]['queue']
+    os.makedirs(ARRAY_LOG_DIR, exist_ok=True)
+
+    lines = ['#!/bin/bash', f'#PBS -N {group}_array', f'#PBS -l nodes=1:ppn={ppn}']
+    if mem:
+        lines.append(f'#PBS -l mem={mem}gb')
+    if walltime:
+        lines.append(f'#PBS -l walltime={walltime}')
+    lines += ['#PBS -j oe', f'#PBS -o {ARRAY_LOG_DIR}/']
+    if queue:
+        lines.append(f'#PBS -q {queue}')
+    scripts = ' '.join(os.path.abspath(job.script_file) for job in jobs)
+    lines += ['', f'cd {os.getcwd()}', f'scripts=({scripts})',
+              'index=${PBS_ARRAY_INDEX:-${PBS_ARRAYID:-$SLURM_ARRAY_TASK_ID}}', 'bash ${scripts[$index]}', '']
+
+    script_file = f"{group}_array.pbs"
+    with open(script_file, 'w') as file:
+        file.write('\n'.join(lines))
+    return script_file
+
+
+def array_groups(jobs, use_arrays):
+    """
+    Split the jobs into arrays (lists of two or more jobs of the same group without dependencies)
+    and single jobs. Arrays only go to executors that have submit_array and whose scheduler supports them
+    (supports_arrays, a Torque or PBS Pro qsub).
+    """
+    executor = current_executor()
+    if not use_arrays or not hasattr(executor, 'submit_array') or not executor.supports_arrays():
+        return [], list(jobs)
+    groups = {}
+    singles = []
+    for job in jobs:
+        if job.group and not job.depend:
+            groups.setdefault(job.group, []).append(job)
+        else:
+            singles.append(job)
+    arrays = []
+    for group_jobs in groups.values():
+        if len(group_jobs) > 1:
+            arrays.append(group_jobs)
+        else:
+            singles.extend(group_jobs)
+    return arrays, singles
+
+
+async def submit_all(jobs, logger, use_arrays=False, concurrency=SUBMIT_CONCURRENCY, retries=SUBMIT_RETRIES,
+                     backoff=SUBMIT_BACKOFF):
+    executor = current_executor()
+    semaphore = asyncio.Semaphore(concurrency)
+    job_ids = {}
+
+    async def submit_single(job):
+        label = f"{job.script_file} for {job.subband}"
+        logger.info(f"Submitting {label} to {executor.name}" + (f" after {', '.join(job.depend)}" if job.depend else ""))
+        job_id = await submit_with_retry(lambda: executor.submit(job.script_file, job.depend or None), label, logger,
+                                         semaphore, retries, backoff)
+        if job_id:
+            logger.info(f"PBS script {job.script_file} for {job.subband} submitted successfully with job ID: {job_id}")
+        job_ids[id(job)] = job_id
+
+    async def submit_array(group_jobs):
+        script_file = array_script(group_jobs, group_jobs[0].group)
+        subbands = ', '.join(job.subband for job in group_jobs)
+        logger.info(f"Submitting {script_file} as an array of {len(group_jobs)} jobs ({subbands}) to {executor.name}")
+        subjob_ids = await submit_with_retry(lambda: executor.submit_array(script_file, len(group_jobs)), script_file,
+                                             logger, semaphore, retries, backoff)
+        # qsub and sbatch keep their own copy of the script, the subjobs are tracked by their IDs from here on
+        os.remove(script_file)
+        if subjob_ids is None:
+            # One by one, so a problem with the array does not cost the subbands
+            logger.warning(f"Array {script_file} was not accepted, submitting its jobs one by one")
+            await asyncio.gather(*(submit_single(job) for job in group_jobs))
+            return
+        for job, job_id in zip(group_jobs, subjob_ids):
+            logger.info(f"PBS script {job.script_file} for {job.subband} submitted as array job {job_id}")
+            job_ids[id(job)] = job_id
+
+    arrays, singles = array_groups(jobs, use_arrays)
+    await asyncio.gather(*(submit_array(group_jobs) for group_jobs in arrays), *(submit_single(job) for job in singles))
+    return [job_ids.get(id(job)) for job in jobs]
+
+
+def submit_jobs(jobs, logger, use_arrays=False, concurrency=SUBMIT_CONCURRENCY, retries=SUBMIT_RETRIES, backoff=SUBMIT_BACKOFF):
+    """
+    Submit PendingJobs all at once and return their job IDs in the same order, None for a job that could
+    not be submitted even after the retries. The call takes about as long as the slowest submission.
+    """
+    if not jobs:
+        return []
+    loop = asyncio.new_event_loop()
+    try:
+        return loop.run_until_complete(submit_all(jobs, logger, use_arrays, concurrency, retries, backoff))
+    finally:
+        loop.close()
+
@@ -0,0 +1,117 @@
+# Stage cache, so a rerun picks up where the last run broke instead of starting again from the split.
+#
+# Every stage gets a key: the hash of its generated CASA script, its parameters, the size and mtime of the
+# external inputs (the parent MS) and the keys of the stages it depends on. When a stage finishes its key
+# and outputs go to a manifest next to its log. On the next run a stage is skipped when its manifest has
+# the same key, its outputs are still there and everything upstream of it was skipped as well.
+#
+# Stages downstream change their inputs in place (flags, CORRECTED_DATA), so inputs produced by the
+# pipeline itself are tracked through the keys of the stages that made them, not through their mtimes.
+
+import hashlib
+import json
+import os
+import shutil
+
+
+def fingerprint_path(path):
+    """
+    Size and modification time of a file, or the total size, newest mtime and file count of a
+    directory such as an MS. Returns None if the path does not exist.
+    """
+    if os.path.isfile(path):
+        stat = os.stat(path)
+        return {'size': stat.st_size, 'mtime': stat.st_mtime_ns}
+    if not os.path.isdir(path):
+        return None
+    size, mtime, count = 0, 0, 0
+    for root, _, files in os.walk(path):
+        for name in files:
+            stat = os.stat(os.path.join(root, name))
+            size += stat.st_size
+            mtime = max(mtime, stat.st_mtime_ns)
+            count += 1
+    return {'size': size, 'mtime': mtime, 'files': count}
+
+
+def cache_entry(script, outputs, inputs=(), params=None, scratch=()):
+    """
+    Describe a stage for the cache. script is the generated CASA script, outputs the tables the stage
+    creates, inputs the external files it reads and params anything else that changes its result.
+    scratch are temporary tables the stage removes when it succeeds; they are not needed for a cache
+    hit, but a run that broke off leaves them behind, so invalidate removes them too.
+    """
+    return {'script': script, 'outputs': list(outputs), 'inputs': list(inputs), 'params': params or {},
+            'scratch': list(scratch)}
+
+
+def stage_key(entry, upstream_keys):
+    """
+    Content address of a stage. Returns None if any upstream stage has no key.
+    """
+    if any(key is None for key in upstream_keys):
+        return None
+    content = {
+        'script': hashlib.sha256(entry['script'].encode()).hexdigest(),
+        'params': entry['params'],
+        'inputs': {path: fingerprint_path(path) for path in entry['inputs']},
+        'upstream': sorted(upstream_keys),
+    }
+    return hashlib.sha256(json.dumps(content, sort_keys=True, default=str).encode()).hexdigest()
+
+
+def manifest_file_path(output_dir, subband, prefix):
+    return os.path.join(output_dir, f"{prefix}_{subband}.manifest")
+
+
+def output_is_valid(path):
+    """
+    A CASA table (MS or caltable) has to have its table.dat, any other output just has to exist.
+    """
+    if os.path.isdir(path):
+        return os.path.exists(os.path.join(path, 'table.dat'))
+    return os.path.exists(path)
+
+
+def is_cached(manifest_file, key):
+    """
+    True if the manifest was written for the same key and all its outputs are still there.
+    """
+    if key is None:
+        return False
+    try:
+        with open(manifest_file, 'r') as file:
+            manifest = json.load(file)
+    except (OSError, ValueError):
+        return False
+    return manifest.get('key') == key and all(output_is_valid(path) for path in manifest.get('outputs', []))
+
+
+def write_manifest(manifest_file, key, entry):
+    manifest = {
+        'key': key,
+        'script_sha256': hashlib.sha256(entry['script'].encode()).hexdigest(),
+        'params': entry['params'],
+        'inputs': {path: fingerprint_path(path) for path in entry['inputs']},
+        'outputs': entry['outputs'],
+    }
+    tmp_file = manifest_file + '.tmp'
+    with open(tmp_file, 'w') as file:
+        json.dump(manifest, file, indent=2, default=str)
+    os.replace(tmp_file, manifest_file)
+
+
+def invalidate(manifest_file, entry, logger):
+    """
+    Forget a stage before it runs again: drop its manifest and whatever it left behind last time,
+    CASA refuses to write over an existing MS.
+    """
+    if os.path.exists(manifest_file):
+        os.remove(manifest_file)
+    for path in entry['outputs'] + entry.get('scratch', []):
+        if os.path.isdir(path):
+            shutil.rmtree(path)
+            logger.info(f"Removed stale output {path}")
+        elif os.path.exists(path):
+            os.remove(path)
+            logger.info(f"Removed stale output {path}")
@@ -0,0 +1,355 @@
+# Where the jobs run. dragon_breath writes every stage as a bash script with #PBS directives; an executor
+# takes such a script and runs it on PBS, on SLURM (the #PBS lines are turned into sbatch options) or
+# straight on the local machine, where several subbands share the cores of one big workstation.
+#
+# Pick one with use_executor() before submitting anything, PBS is the default.
+
+import os
+import re
+import shutil
+import signal
+import subprocess
+import threading
+import time
+
+
+def read_pbs_directives(script_file):
+    """
+    Read the #PBS lines of a job script into a dict with name, log, ppn, mem (in GB), walltime and queue.
+    """
+    directives = {'name': os.path.basename(script_file), 'log': None, 'ppn': 1, 'mem': None, 'walltime': None, 'queue': None}
+    with open(script_file, 'r') as file:
+        for line in file:
+            parts = line.split()
+            if len(parts) < 3 or parts[0] != '#PBS':
+                continue
+            flag, value = parts[1], parts[2]
+            if flag == '-N':
+                directives['name'] = value
+            elif flag == '-o':
+                directives['log'] = value
+            elif flag == '-q':
+                directives['queue'] = value
+            elif flag == '-l' and value.startswith('walltime='):
+                directives['walltime'] = value[len('walltime='):]
+            elif flag == '-l' and value.startswith('mem='):
+                mem = re.match(r'mem=(\d+)gb', value.lower())
+                if mem:
+                    directives['mem'] = int(mem.group(1))
+            elif flag == '-l':
+                ppn = re.search(r'ppn=(\d+)', value)
+                if ppn:
+                    directives['ppn'] = int(ppn.group(1))
+    return directives
+
+
+# Where the PBS or SLURM logs of the subjobs of a job array go
+ARRAY_LOG_DIR = 'array_logs'
+
+def subjob_ids(array_id, count, style):
+    """
+    IDs of the subjobs of an array: 1234[].server gives 1234[0].server, ... on PBS, 1234 gives 1234_0, ...
+    on SLURM.
+    """
+    if style == 'pbs':
+        match = re.match(r'^(\d+)\[\](.*)$', array_id)
+        if match is None:
+            raise OSError(f"qsub returned {array_id!r}, not an array job ID")
+        return [f"{match.group(1)}[{i}]{match.group(2)}" for i in range(count)]
+    return [f"{array_id}_{i}" for i in range(count)]
+
+
+class PBSExecutor:
+    """
+    Submit with qsub, track with one batched qstat, remove with qdel.
+    """
+    name = 'pbs'
+
+    def __init__(self):
+        self.array_option = None
+
+    def array_flag(self):
+        """
+        qsub option for job arrays: -J on PBS Pro and OpenPBS, -t on Torque, told apart by qsub --version
+        on the first call. None when qsub says neither, the jobs then go in one by one.
+        """
+        if self.array_option is None:
+            try:
+                result = subprocess.run(['qsub', '--version'], stdout=subprocess.PIPE, stderr=subprocess.PIPE)
+                version = (result.stdout + result.stderr).decode().lower()
+            except OSError:
+                version = ''
+            if 'pbs_version' in version:
+                self.array_option = '-J'
+            elif version.startswith('version:'):  # Torque
+                self.array_option = '-t'
+            else:
+                self.array_option = ''
+        return self.array_option or None
+
+    def supports_arrays(self):
+        return self.array_flag() is not None
+
+    def submit(self, script_file, depend=None):
+        submit_command = ['qsub', script_file]
+        if depend:
+            submit_command = ['qsub', '-W', f"depend=afterok:{':'.join(depend)}", script_file]
+        result = subprocess.run(submit_command, stdout=subprocess.PIPE, stderr=subprocess.PIPE, check=True)
+        return result.stdout.decode().strip()  # Job ID is the output from qsub
+
+    def submit_array(self, script_file, count):
+        """
+        Submit the script as a job array of count subjobs (qsub -J on PBS Pro, -t on Torque, see array_flag)
+        and return the subjob IDs.
+        """
+        result = subprocess.run(['qsub', self.array_flag(), f"0-{count - 1}", script_file], stdout=subprocess.PIPE,
+                                stderr=subprocess.PIPE, check=True)
+        return subjob_ids(result.stdout.decode().strip(), count, 'pbs')
+
+    def query(self, job_ids):
+        """
+        Returns a dict {job_id: state} for the jobs that are still queued or running.
+        Jobs that are no longer known to the server, or are reported as finished, are left out.
+        """
+        if not job_ids:
+            return {}
+        # No shell: subjob IDs like 1234[0].server would be glob patterns there
+        # qstat returns non-zero as soon as one of the ids is unknown, so only stdout matters here
+        result = subprocess.run(['qstat'] + list(job_ids), stdout=subprocess.PIPE, stderr=subprocess.PIPE)
+        stderr = result.stderr.decode()
+        if result.returncode != 0 and "unknown job" not in stderr.lower():
+            raise OSError(f"qstat failed: {stderr.strip()}")
+
+        # Long server names get truncated in the qstat table, so match on the sequence number
+        wanted = {job_id.split('.')[0]: job_id for job_id in job_ids}
+        states = {}
+        for line in result.stdout.decode().splitlines():
+            parts = line.split()
+            if len(parts) < 6:
+                continue
+            job_id = wanted.get(parts[0].split('.')[0])
+            if job_id is None:
+                continue
+            state = parts[4]
+            if state not in ('C', 'F', 'X'):  # Torque keeps completed jobs as C, PBS Pro shows F with -x, X for subjobs
+                states[job_id] = state
+        return states
+
+    def delete(self, job_ids):
+        """
+        Returns the complaint of the scheduler, empty if there was none.
+        """
+        result = subprocess.run(['qdel'] + list(job_ids), stdout=subprocess.PIPE, stderr=subprocess.PIPE)
+        return result.stderr.decode().strip() if result.returncode != 0 else ''
+
+
+class SlurmExecutor:
+    """
+    Submit the same scripts with sbatch. sbatch ignores the #PBS lines, so they are passed as options.
+    partition replaces the PBS queue name, which rarely exists under the same name on SLURM.
+    """
+    name = 'slurm'
+
+    def __init__(self, partition=None):
+        self.partition = partition
+
+    def submit(self, script_file, depend=None, extra_options=()):
+        directives = read_pbs_directives(script_file)
+        options = [f"--job-name={directives['name']}", '--nodes=1', '--ntasks=1', f"--cpus-per-task={directives['ppn']}"]
+        if directives['log'] and not any(option.startswith('--output=') for option in extra_options):
+            options.append(f"--output={directives['log']}")
+        if directives['mem']:
+            options.append(f"--mem={directives['mem']}G")
+        if directives['walltime']:
+            options.append(f"--time={directives['walltime']}")
+        if self.partition:
+            options.append(f"--partition={self.partition}")
+        if depend:
+            options.append(f"--dependency=afterok:{':'.join(depend)}")
+        options.extend(extra_options)
+        result = subprocess.run(['sbatch', '--parsable'] + options + [script_file], stdout=subprocess.PIPE,
+                                stderr=subprocess.PIPE, check=True)
+        return result.stdout.decode().strip().split(';')[0]  # --parsable prints jobid[;cluster]
+
+    def supports_arrays(self):
+        return True
+
+    def submit_array(self, script_file, count):
+        """
+        Submit the script as a job array of count tasks (sbatch --array) and return the task IDs.
+        """
+        name = read_pbs_directives(script_file)['name']
+        array_id = self.submit(script_file, extra_options=[f"--array=0-{count - 1}", f"--output={ARRAY_LOG_DIR}/{name}_%a.log"])
+        return subjob_ids(array_id, count, 'slurm')
+
+    def query(self, job_ids):
+        if not job_ids:
+            return {}
+        # Listing all of our own jobs avoids squeue failing on ids that were already purged
+        # -r lists every task of an array on its own line, pending ones too
+        result = subprocess.run(['squeue', '-h', '-r', '-u', os.environ.get('USER', ''), '-o', '%i %t'],
+                                stdout=subprocess.PIPE, stderr=subprocess.PIPE)
+        if result.returncode != 0:
+            raise OSError(f"squeue failed: {result.stderr.decode().strip()}")
+        wanted = set(job_ids)
+        states = {}
+        for line in result.stdout.decode().splitlines():
+            parts = line.split()
+            if len(parts) == 2 and parts[0] in wanted:
+                states[parts[0]] = parts[1]
+        return states
+
+    def delete(self, job_ids):
+        result = subprocess.run(['scancel'] + list(job_ids), stdout=subprocess.PIPE, stderr=subprocess.PIPE)
+        return result.stderr.decode().strip() if result.returncode != 0 else ''
+
+
+class LocalExecutor:
+    """
+    Run the job scripts on this machine with bash, as many at a time as the cores allow.
+    Every job gets ppn cores of its own (pinned with taskset, or sched_setaffinity without it) and waits
+    in the queue until that many are free. afterok dependencies are honoured, and a job whose
+    dependency failed is dropped like PBS does. Job states follow qstat: Q, H and R.
+    """
+    name = 'local'
+
+    def __init__(self, cores=None, poll_interval=0.2):
+        available = sorted(os.sched_getaffinity(0)) if hasattr(os, 'sched_getaffinity') else list(range(os.cpu_count()))
+        if cores is None:
+            cores = available
+        elif isinstance(cores, int):
+            # More slots than CPUs oversubscribes them evenly
+            cores = [available[i % len(available)] for i in range(cores)]
+        self.free_cores = list(cores)
+        self.total_cores = len(cores)
+        self.poll_interval = poll_interval
+        self.jobs = {}
+        self.counter = 0
+        self.lock = threading.Lock()
+        self.thread = threading.Thread(target=self._run, daemon=True)
+        self.thread.start()
+
+    def submit(self, script_file, depend=None):
+        directives = read_pbs_directives(script_file)
+        with self.lock:
+            self.counter += 1
+            job_id = f"{self.counter}.local"
+            self.jobs[job_id] = {
+                'script': os.path.abspath(script_file),
+                'cwd': os.getcwd(),
+                'log': directives['log'] or f"{directives['name']}.o{self.counter}",
+                'ppn': max(1, min(directives['ppn'], self.total_cores)),
+                'depend': list(depend or []),
+                'state': 'Q',
+                'process': None,
+                'cores': [],
+                'exit_status': None,
+            }
+        return job_id
+
+    def query(self, job_ids):
+        with self.lock:
+            return {job_id: self.jobs[job_id]['state'] for job_id in job_ids
+                    if job_id in self.jobs and self.jobs[job_id]['state'] in ('Q', 'H', 'R')}
+
+    def delete(self, job_ids):
+        unknown = []
+        with self.lock:
+            for job_id in job_ids:
+                job = self.jobs.get(job_id)
+                if job is None or job['state'] == 'F':
+                    unknown.append(job_id)
+                    continue
+                if job['process'] is not None:
+                    # The job runs in its own session, take CASA and everything else it started with it
+                    try:
+                        os.killpg(job['process'].pid, signal.SIGTERM)
+                    except ProcessLookupError:
+                        pass
+                else:
+                    job['state'] = 'F'
+                    job['exit_status'] = 271
+        return f"Unknown Job Id {' '.join(unknown)}" if unknown else ''
+
+    def _start(self, job_id, job):
+        cores = self.free_cores[:job['ppn']]
+        del self.free_cores[:job['ppn']]
+
+        # No preexec_fn: it is not safe in a process with threads. taskset pins the job before bash starts;
+        # without it the job is pinned right after it started, before it has done much
+        command = ['bash', job['script']]
+        taskset = shutil.which('taskset')
+        if taskset:
+            command = [taskset, '-c', ','.join(str(core) for core in cores)] + command
+
+        job['cores'] = cores
+        log_file = os.path.join(job['cwd'], job['log'])
+        try:
+            os.makedirs(os.path.dirname(log_file) or '.', exist_ok=True)
+            with open(log_file, 'w') as log:
+                job['process'] = subprocess.Popen(command, cwd=job['cwd'], stdout=log, stderr=subprocess.STDOUT,
+                                                  stdin=subprocess.DEVNULL, start_new_session=True)
+            if not taskset and hasattr(os, 'sched_setaffinity'):
+                try:
+                    os.sched_setaffinity(job['process'].pid, set(cores))
+                except ProcessLookupError:
+                    pass  # Already done
+        except (OSError, subprocess.SubprocessError):
+            # Could not even start, report it like a job that failed straight away
+            job['state'] = 'F'
+            job['exit_status'] = 1
+            self.free_cores.extend(cores)
+            return
+        job['state'] = 'R'
+
+    def _run(self):
+        while True:
+            with self.lock:
+                for job in self.jobs.values():
+                    if job['state'] == 'R' and job['process'].poll() is not None:
+                        job['exit_status'] = job['process'].returncode
+                        job['state'] = 'F'
+                        self.free_cores.extend(job['cores'])
+
+                # First come, first served, like a plain FIFO queue
+                for job_id, job in self.jobs.items():
+                    if job['state'] not in ('Q', 'H'):
+                        continue
+                    deps = [self.jobs.get(dep) for dep in job['depend']]
+                    if any(dep is not None and dep['state'] == 'F' and dep['exit_status'] != 0 for dep in deps):
+                        job['state'] = 'F'
+                        job['exit_status'] = 271
+                        continue
+                    if any(dep is not None and dep['state'] != 'F' for dep in deps):
+                        job['state'] = 'H'
+                        continue
+                    job['state'] = 'Q'
+                    if len(self.free_cores) < job['ppn']:
+                        break
+                    self._start(job_id, job)
+            time.sleep(self.poll_interval)
+
+
+_executor = None
+
+def use_executor(executor):
+    """
+    Make every later submission and status query go through the given executor.
+    """
+    global _executor
+    _executor = executor
+
+def current_executor():
+    global _executor
+    if _executor is None:
+        _executor = PBSExecutor()
+    return _executor
+
+def make_executor(name, **options):
+    """
+    Build an executor by name: 'pbs', 'slurm' (options: partition) or 'local' (options: cores).
+    """
+    executors = {'pbs': PBSExecutor, 'slurm': SlurmExecutor, 'local': LocalExecutor}
+    if name not in executors:
+        raise ValueError(f"Unknown executor: {name}")
+    return executors[name](**options)
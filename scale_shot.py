@@ -0,0 +1,93 @@
+# Subband planning. Instead of four hard-coded spw directories, read the channel layout of the MS and
+# cut the usable part of the band into as many equal, contiguous subbands as the allocation can run at
+# once, more if one subband would not fit in the memory of a node.
+
+import math
+
+import numpy as np
+
+from rest import fingerprint_path
+
+# Usable part of the uGMRT bands in MHz, the roll-off at the edges is dropped.
+# Band 4 matches the 124~1923 channel range of 2048 channels used so far.
+UGMRT_BAND_EDGES = {
+    4: (562.1, 737.9),
+}
+
+
+def open_table(path):
+    """
+    Open a CASA table with casatools when available, python-casacore otherwise.
+    """
+    try:
+        from casatools import table
+        tb = table()
+        tb.open(path)
+        return tb
+    except ImportError:
+        pass
+    try:
+        from casacore.tables import table
+    except ImportError:
+        raise ImportError("Reading the MS needs casatools or python-casacore")
+    return table(path, ack=False)
+
+
+def read_chan_freqs(ms_name, spw_id=0):
+    """
+    Channel frequencies of one spw of the MS in Hz.
+    """
+    tb = open_table(ms_name + '/SPECTRAL_WINDOW')
+    chan_freqs = np.asarray(tb.getcell('CHAN_FREQ', spw_id), dtype=float)
+    tb.close()
+    return chan_freqs
+
+
+def good_channel_range(chan_freqs, band_edges_mhz=None):
+    """
+    First and last channel inside the band edges (all channels without edges).
+    """
+    if band_edges_mhz is None:
+        return 0, len(chan_freqs) - 1
+    low, high = band_edges_mhz
+    inside = np.flatnonzero((chan_freqs >= low * 1e6) & (chan_freqs <= high * 1e6))
+    if inside.size == 0:
+        raise ValueError(f"No channels between {low} and {high} MHz")
+    return int(inside[0]), int(inside[-1])
+
+
+def plan_subbands(chan_freqs, ms_bytes, n_nodes, mem_per_node_gb, band_edges_mhz=None, spw_id=0,
+                  min_chans=32, mem_fraction=0.5):
+    """
+    Work out the subband map {'spw0': '0:first~last', ...} for the pipeline.
+
+    There is one subband per node. If one subband would take more than mem_fraction of the memory
+    of a node, the count goes up to the next multiple of n_nodes, so every wave still fills the
+    allocation. No subband gets fewer than min_chans channels, which keeps enough signal for the
+    calibration solves. All subbands are equally wide, leftover channels are dropped evenly at both
+    edges, which is what the single-sweep split (nspw) needs.
+    """
+    first, last = good_channel_range(chan_freqs, band_edges_mhz)
+    good_chans = last - first + 1
+
+    subband_budget = mem_per_node_gb * 1e9 * mem_fraction
+    band_bytes = ms_bytes * good_chans / len(chan_freqs)
+    n_subbands = max(n_nodes, 1)
+    if band_bytes / n_subbands > subband_budget:
+        needed = math.ceil(band_bytes / subband_budget)
+        n_subbands = math.ceil(needed / n_subbands) * n_subbands
+    n_subbands = max(1, min(n_subbands, good_chans // min_chans))
+
+    width = good_chans // n_subbands
+    spare = good_chans - width * n_subbands
+    start = first + spare // 2
+    return {f"spw{i}": f"{spw_id}:{start + i * width}~{start + (i + 1) * width - 1}" for i in range(n_subbands)}
+
+
+def plan_from_ms(ms_name, n_nodes, mem_per_node_gb, band_edges_mhz=None, spw_id=0, **kwargs):
+    """
+    Read the MS size and channel layout and plan its subbands, see plan_subbands.
+    """
+    chan_freqs = read_chan_freqs(ms_name, spw_id)
+    ms_bytes = fingerprint_path(ms_name)['size']
+    return plan_subbands(chan_freqs, ms_bytes, n_nodes, mem_per_node_gb, band_edges_mhz, spw_id, **kwargs)
@@ -0,0 +1,297 @@
+# RFI flagging in NumPy, without starting CASA and without flagdata. The data are read per scan and
+# ntime interval (surf.VisibilityReader) and put in a baseline x time x channel x correlation cube of
+# amplitudes. Every baseline is then flagged on its own, the baselines spread over threads (NumPy lets
+# go of the GIL in the sorts and ufuncs that do the work, so the cube is shared instead of copied):
+#
+# - 'mad' (for mode='rflag'): deviations from a running median along time and along frequency,
+#   flagged above timedevscale / freqdevscale times their robust (MAD) sigma
+# - 'sumthreshold' (for mode='tfcrop'): the same deviations, in units of sigma, through SumThreshold
+#   (Offringa et al. 2010) with timecutoff / freqcutoff as the single-sample threshold, which also
+#   catches weak RFI that spans several samples
+#
+# The passes are the flagdata parameter dicts the pipeline already uses (ntime, uvrange, the cutoffs),
+# so flag_ms(vis, [dict(RFLAG_AFTER_CAL, ntime='2min', uvrange='0~1klambda'), ...]) stands in for the
+# flagdata(mode='list') call. Passes with the same ntime share one read of the data, and the new flags
+# are or-ed into the FLAG column (nothing is unflagged). No flag version is saved.
+
+import logging
+import os
+import re
+from concurrent.futures import ThreadPoolExecutor
+
+import numpy as np
+from numpy.lib.stride_tricks import sliding_window_view
+
+from earthquake import MAD_TO_SIGMA
+from surf import VisibilityReader
+
+SPEED_OF_LIGHT = 299792458.0
+
+DATACOLUMNS = {'data': 'DATA', 'corrected': 'CORRECTED_DATA', 'model': 'MODEL_DATA'}
+
+# Lengths of the running medians the deviations are measured from, (integrations, channels) per
+# algorithm. SumThreshold looks for RFI that spans samples, so its background must not follow it:
+# the median of the whole ntime interval in time, and windows twice its longest run in frequency.
+BACKGROUND_WINDOWS = {'mad': (5, 9), 'sumthreshold': (None, 33)}
+
+# Channels the sigma of the time deviations is smoothed over, an ntime interval has few integrations
+SIGMA_WINDOW = 9
+
+# SumThreshold window lengths, the threshold for M samples is cutoff / rho ** log2(M)
+SUMTHRESHOLD_WINDOWS = (1, 2, 4, 8, 16)
+SUMTHRESHOLD_RHO = 1.5
+
+# Flagging rounds per cube: each round measures sigma again without what the last one flagged
+ROUNDS = 2
+
+UNITS = {'lambda': 1.0, 'klambda': 1e3, 'mlambda': 1e6, 'm': 1.0, 'km': 1e3}
+
+
+def parse_ntime(ntime):
+    """
+    flagdata ntime in seconds: '2min', '30s', '1h', a number of seconds, or 'scan' (infinite).
+    """
+    if isinstance(ntime, (int, float)):
+        return float(ntime)
+    if ntime in ('', 'scan'):
+        return np.inf
+    match = re.fullmatch(r'\s*([\d.]+)\s*(s|min|h)?\s*', ntime)
+    if not match:
+        raise ValueError(f"Cannot read ntime={ntime!r}")
+    return float(match.group(1)) * {'s': 1, 'min': 60, 'h': 3600, None: 1}[match.group(2)]
+
+
+def parse_uvrange(uvrange):
+    """
+    flagdata uvrange as (low, high, in_lambda): '0~1klambda', '>5klambda', '<2km', '' for everything.
+    """
+    if not uvrange:
+        return 0.0, np.inf, False
+    match = re.fullmatch(r'\s*([<>]?)\s*([\d.]+)\s*(?:~\s*([\d.]+))?\s*([a-zA-Z]*)\s*', uvrange)
+    if not match or match.group(4).lower() not in UNITS:
+        raise ValueError(f"Cannot read uvrange={uvrange!r}")
+    side, low, high, unit = match.groups()
+    scale = UNITS[unit.lower()]
+    in_lambda = unit.lower().endswith('lambda')
+    if side == '>':
+        return float(low) * scale, np.inf, in_lambda
+    if side == '<':
+        return 0.0, float(low) * scale, in_lambda
+    return float(low) * scale, float(high if high is not None else low) * scale, in_lambda
+
+
+def native_pass(params):
+    """
+    Settings of the native flagger for a flagdata parameter dict with mode 'rflag' or 'tfcrop'.
+    """
+    mode = params.get('mode')
+    if mode == 'rflag':
+        algorithm, time_scale, freq_scale = 'mad', params.get('timedevscale', 5.0), params.get('freqdevscale', 5.0)
+    elif mode == 'tfcrop':
+        algorithm, time_scale, freq_scale = 'sumthreshold', params.get('timecutoff', 4.0), params.get('freqcutoff', 3.0)
+    else:
+        raise ValueError(f"The native flagger does not do mode={mode!r}")
+    return {
+        'algorithm': algorithm,
+        'time_scale': float(time_scale),
+        'freq_scale': float(freq_scale),
+        'ntime': parse_ntime(params.get('ntime', 'scan')),
+        'uvrange': parse_uvrange(params.get('uvrange', '')),
+        'datacolumn': DATACOLUMNS[params.get('datacolumn', 'data').lower()],
+    }
+
+
+def median_of_sorted(ordered):
+    """
+    Median along the last axis of sorted values. np.sort puts NaNs last, so the valid values are the
+    first n of every row; NaN where there are none.
+    """
+    count = ordered.shape[-1] - np.isnan(ordered).sum(axis=-1, keepdims=True)
+    low = np.take_along_axis(ordered, np.maximum((count - 1) // 2, 0), axis=-1)
+    high = np.take_along_axis(ordered, np.maximum(count // 2, 0), axis=-1)
+    return np.where(count > 0, 0.5 * (low + high), np.nan)[..., 0]
+
+
+def nan_median(values, axis):
+    """
+    np.nanmedian(values, axis, keepdims=True) without its slow path for arrays with NaNs.
+    """
+    return np.expand_dims(median_of_sorted(np.sort(np.moveaxis(values, axis, -1), axis=-1)), axis)
+
+
+def running_median(values, window, axis):
+    """
+    Median over a centred window along axis, NaNs left out (NaN where the whole window is NaN).
+    """
+    pad = [(0, 0)] * values.ndim
+    pad[axis] = (window // 2, window // 2)
+    return median_of_sorted(np.sort(sliding_window_view(np.pad(values, pad, mode='edge'), window, axis=axis), axis=-1))
+
+
+def sumthreshold(normalised, axis, cutoff, windows=SUMTHRESHOLD_WINDOWS, rho=SUMTHRESHOLD_RHO):
+    """
+    SumThreshold along axis of deviations in units of sigma (NaN for missing samples). A run of M
+    samples is flagged when its mean deviation is above cutoff / rho ** log2(M); samples flagged by
+    a shorter run count at the threshold in the longer ones. Only catches positive deviations.
+    """
+    values = np.moveaxis(np.nan_to_num(normalised), axis, -1)
+    flags = np.zeros(values.shape, dtype=bool)
+    length = values.shape[-1]
+    sample = np.arange(length)
+    for window in windows:
+        if window > length:
+            break
+        threshold = cutoff / rho ** np.log2(window)
+        current = np.where(flags, threshold, values)
+        cumulative = np.concatenate([np.zeros(current.shape[:-1] + (1,)), np.cumsum(current, axis=-1)], axis=-1)
+        exceeds = (cumulative[..., window:] - cumulative[..., :-window]) > threshold * window
+        # A sample is flagged if any of the runs it is part of exceeds
+        hits = np.concatenate([np.zeros(exceeds.shape[:-1] + (1,), dtype=int), np.cumsum(exceeds, axis=-1)], axis=-1)
+        first = np.maximum(sample - window + 1, 0)
+        last = np.minimum(sample, length - window) + 1
+        flags |= (hits[..., last] - hits[..., first]) > 0
+    return np.moveaxis(flags, -1, axis)
+
+
+def flag_cube(amp, algorithm, time_scale, freq_scale, rounds=ROUNDS):
+    """
+    New flags for a (baseline, time, channel, correlation) amplitude cube with NaN for the data that
+    is flagged already or not selected. Deviations are measured per baseline and correlation: along
+    time per channel, along frequency per integration.
+    """
+    flags = np.zeros(amp.shape, dtype=bool)
+    present = ~np.isnan(amp)
+    windows = BACKGROUND_WINDOWS[algorithm]
+    for _ in range(rounds):
+        masked = np.where(flags, np.nan, amp)
+        new = np.zeros(amp.shape, dtype=bool)
+        for axis, scale, window in ((1, time_scale, windows[0]), (2, freq_scale, windows[1])):
+            if amp.shape[axis] < 3:
+                continue
+            if window is None:
+                residual = masked - nan_median(masked, axis)
+            else:
+                residual = masked - running_median(masked, min(window, 2 * (amp.shape[axis] // 2) - 1), axis)
+            # The sample a window's median is taken from has no residual, leave those out of sigma
+            spread = np.abs(residual)
+            spread[spread == 0] = np.nan
+            sigma = MAD_TO_SIGMA * nan_median(spread, axis)
+            if axis == 1 and amp.shape[2] > 1:
+                sigma = running_median(sigma, min(SIGMA_WINDOW, 2 * (amp.shape[2] // 2) - 1), 2)
+            with np.errstate(invalid='ignore', divide='ignore'):
+                normalised = residual / sigma
+                if algorithm == 'mad':
+                    new |= np.abs(normalised) > scale
+                else:
+                    new |= sumthreshold(normalised, axis, scale) | sumthreshold(-normalised, axis, scale)
+        new &= present & ~flags
+        if not new.any():
+            break
+        flags |= new
+    return flags
+
+
+def time_chunks(time, scan, ntime):
+    """
+    Runs of rows (start, stop) in the same scan and ntime interval, in row order.
+    """
+    scans, scan_index = np.unique(scan, return_inverse=True)
+    scan_start = np.full(len(scans), np.inf)
+    np.minimum.at(scan_start, scan_index, time)
+    interval = np.floor((time - scan_start[scan_index]) / ntime) if np.isfinite(ntime) else np.zeros(len(time))
+    change = np.flatnonzero((np.diff(scan) != 0) | (np.diff(interval) != 0)) + 1
+    bounds = np.concatenate([[0], change, [len(time)]])
+    return list(zip(bounds[:-1], bounds[1:]))
+
+
+def uv_selection(uvw, uvrange, chan_freqs):
+    """
+    Rows inside a parsed uvrange, lambdas at the centre frequency of the channels.
+    """
+    low, high, in_lambda = uvrange
+    if low == 0 and not np.isfinite(high):
+        return np.ones(len(uvw), dtype=bool)
+    uvdist = np.hypot(uvw[:, 0], uvw[:, 1])
+    if in_lambda:
+        uvdist = uvdist * np.mean(chan_freqs) / SPEED_OF_LIGHT
+    return (uvdist >= low) & (uvdist <= high)
+
+
+def flag_rows(reader, start, stop, time, uvw, passes, pool, workers):
+    """
+    Flag rows start to stop with the passes (native_pass settings), time and uvw being the TIME and
+    UVW of those rows. Returns the number of flags before and after.
+    """
+    ant1, ant2, _, data, flag = reader.read(start, stop - start)
+    baseline = ant1.astype(np.int64) * reader.nant + ant2
+    _, bl_index = np.unique(baseline, return_inverse=True)
+    times, time_index = np.unique(time, return_inverse=True)
+    nbl = bl_index.max() + 1
+
+    amp = np.abs(data)
+    amp[flag] = np.nan
+    amp[ant1 == ant2] = np.nan
+    cube = np.full((nbl, len(times), reader.nchan, reader.ncorr), np.nan, dtype=np.float32)
+    cube[bl_index, time_index] = amp
+
+    before = int(flag.sum())
+    new_flags = np.zeros(flag.shape, dtype=bool)
+    for settings in passes:
+        selected = uv_selection(uvw, settings['uvrange'], reader.chan_freqs)
+        if not selected.any():
+            continue
+        chosen = np.zeros((nbl, len(times)), dtype=bool)
+        chosen[bl_index[selected], time_index[selected]] = True
+        # Only the baselines with data in the uvrange go through the kernel
+        active = np.flatnonzero(chosen.any(axis=1))
+        pass_cube = np.where(chosen[active, :, None, None], cube[active], np.nan)
+        pass_flags = np.empty(pass_cube.shape, dtype=bool)
+
+        def run(part):
+            pass_flags[part] = flag_cube(pass_cube[part], settings['algorithm'], settings['time_scale'],
+                                         settings['freq_scale'])
+        bounds = np.linspace(0, len(active), min(workers, len(active)) + 1).astype(int)
+        list(pool.map(run, [slice(first, last) for first, last in zip(bounds[:-1], bounds[1:])]))
+
+        cube_flags = np.zeros(cube.shape, dtype=bool)
+        cube_flags[active] = pass_flags
+        new_flags |= cube_flags[bl_index, time_index] & selected[:, None, None]
+        # Later passes see what this one flagged
+        cube[cube_flags] = np.nan
+
+    flag |= new_flags
+    reader.write_flags(start, flag)
+    return before, int(flag.sum())
+
+
+def flag_ms(ms_name, passes, logger=None, workers=None, chans=None):
+    """
+    Run flag passes, flagdata parameter dicts with mode 'rflag' or 'tfcrop', on an MS and or the new
+    flags into its FLAG column. Passes with the same ntime and data column share one read.
+    workers is the number of threads, by default the cores this process may run on.
+    Returns the flagged fraction before and after.
+    """
+    logger = logger or logging.getLogger(__name__)
+    workers = workers or len(os.sched_getaffinity(0))
+    groups = {}
+    for params in passes:
+        settings = native_pass(params)
+        groups.setdefault((settings['ntime'], settings['datacolumn']), []).append(settings)
+
+    flagged_before = flagged_after = total = None
+    with ThreadPoolExecutor(max_workers=workers) as pool:
+        for (ntime, datacolumn), group in groups.items():
+            with VisibilityReader(ms_name, datacolumn, chans=chans, readonly=False) as reader:
+                time, scan, uvw = reader.getcol('TIME'), reader.getcol('SCAN_NUMBER'), reader.getcol('UVW')
+                before = after = 0
+                for start, stop in time_chunks(time, scan, ntime):
+                    old, new = flag_rows(reader, start, stop, time[start:stop], uvw[start:stop], group, pool, workers)
+                    before, after = before + old, after + new
+                total = reader.nrow * reader.nchan * reader.ncorr
+            flagged_before = before if flagged_before is None else flagged_before
+            flagged_after = after
+            logger.info(f"{ms_name}: {len(group)} pass(es) with ntime={ntime} on {datacolumn}, "
+                        f"flagged {100 * before / max(total, 1):.2f}% -> {100 * after / max(total, 1):.2f}%")
+    if total is None:
+        return None
+    return flagged_before / max(total, 1), flagged_after / max(total, 1)
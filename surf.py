@@ -0,0 +1,556 @@
+# Visibility statistics in plain Python, on the head node or inside a job, without CASA copying the MS
+# into fresh arrays. The main table is read in row chunks straight into buffers that are allocated once
+# (python-casacore getcolnp/getcolslicenp). Every chunk updates the running mean and variance (Welford /
+# Chan et al.) and a log-binned histogram, the quantile sketch, per antenna, baseline, channel, scan and
+# scan x antenna, so memory grows with the number of groups, not with the length of the observation.
+#
+# The result goes to a summary file next to the MS (load_summary), which the quality checks and the
+# cutoffs read instead of going through the MS again; it is made again when the MS changes.
+#
+# Without python-casacore the chunks come through casatools getcolslice, which does copy, but only one
+# chunk at a time. make_synthetic_ms writes a small MS with known bad antennas and RFI channels to try
+# the statistics (and the flagging built on them) on.
+
+import json
+import os
+import time
+
+import numpy as np
+
+from earthquake import CORR_NAMES
+from rest import fingerprint_path
+from scale_shot import open_table
+
+# Rows per chunk: 2000 rows of 2048 channels x 2 correlations take about 300 MB with the work buffers
+CHUNK_ROWS = 2000
+
+# Amplitude bins of the quantile sketches: log-spaced, so a quantile has the same relative error at
+# any amplitude (20 bins per decade, a few percent). Values outside the range go to the end bins.
+SKETCH_RANGE = (1e-6, 1e6)
+SKETCH_BINS = 240
+
+
+def _open_casacore(ms_name, readonly=True):
+    try:
+        from casacore.tables import table
+    except ImportError:
+        return None
+    return table(ms_name, readonly=readonly, ack=False)
+
+
+def _open_casatools(ms_name, readonly=True):
+    from casatools import table
+    tb = table()
+    tb.open(ms_name, nomodify=readonly)
+    return tb
+
+
+def read_layout(ms_name, spw_id=0):
+    """
+    Number of rows and antennas, channel frequencies (Hz) and correlation names of an MS.
+    """
+    tb = open_table(ms_name)
+    nrow = tb.nrows()
+    tb.close()
+    tb = open_table(ms_name + '/ANTENNA')
+    nant = tb.nrows()
+    tb.close()
+    tb = open_table(ms_name + '/SPECTRAL_WINDOW')
+    chan_freqs = np.asarray(tb.getcell('CHAN_FREQ', spw_id), dtype=float)
+    tb.close()
+    tb = open_table(ms_name + '/POLARIZATION')
+    corr_type = tb.getcell('CORR_TYPE', 0)
+    tb.close()
+    correlations = [CORR_NAMES.get(int(corr), str(corr)) for corr in corr_type]
+    return nrow, nant, chan_freqs, correlations
+
+
+class VisibilityReader:
+    """
+    Reads the main table of an MS in chunks of chunk_rows rows into preallocated buffers.
+    chans is an optional (first, last) channel range, inclusive. With readonly=False the FLAG
+    column can be written back with write_flags.
+
+    chunks() yields (ant1, ant2, scan, data, flag) with data and flag shaped (nrow, nchan, ncorr),
+    read() does the same for any run of rows. They are views into the same buffers on every step,
+    so copy what has to outlive the step.
+    """
+    def __init__(self, ms_name, datacolumn='DATA', chunk_rows=CHUNK_ROWS, chans=None, spw_id=0, readonly=True):
+        self.ms_name = ms_name
+        self.datacolumn = datacolumn
+        self.readonly = readonly
+        self.nrow, self.nant, chan_freqs, self.correlations = read_layout(ms_name, spw_id)
+        first, last = chans if chans is not None else (0, len(chan_freqs) - 1)
+        self.first, self.last = int(first), int(last)
+        self.chan_freqs = chan_freqs[self.first:self.last + 1]
+        self.nchan, self.ncorr = len(self.chan_freqs), len(self.correlations)
+        self.whole_band = self.nchan == len(chan_freqs)
+        self.chunk_rows = max(1, min(int(chunk_rows), self.nrow))
+        self._tb = None
+        self._allocate(self.chunk_rows)
+
+    def _allocate(self, nrow):
+        self.ant1 = np.empty(nrow, dtype=np.int32)
+        self.ant2 = np.empty(nrow, dtype=np.int32)
+        self.scan = np.empty(nrow, dtype=np.int32)
+        self.data = np.empty((nrow, self.nchan, self.ncorr), dtype=np.complex64)
+        self.flag = np.empty((nrow, self.nchan, self.ncorr), dtype=bool)
+
+    def open(self):
+        if self._tb is None:
+            self._tb = _open_casacore(self.ms_name, self.readonly)
+            self._casacore = self._tb is not None
+            if self._tb is None:
+                self._tb = _open_casatools(self.ms_name, self.readonly)
+        return self
+
+    def close(self):
+        if self._tb is not None:
+            self._tb.close()
+            self._tb = None
+
+    def __enter__(self):
+        return self.open()
+
+    def __exit__(self, *exc):
+        self.close()
+
+    def getcol(self, column):
+        """
+        A whole column with the rows first, whichever library reads it. For the small columns (TIME, UVW).
+        """
+        values = self._tb.getcol(column)
+        # casatools puts the rows last
+        return values if self._casacore else values.T
+
+    def _read_casacore(self, start, nrow):
+        tb = self._tb
+        for column, buffer in (('ANTENNA1', self.ant1), ('ANTENNA2', self.ant2), ('SCAN_NUMBER', self.scan)):
+            tb.getcolnp(column, buffer[:nrow], start, nrow)
+        for column, buffer in ((self.datacolumn, self.data), ('FLAG', self.flag)):
+            if self.whole_band:
+                tb.getcolnp(column, buffer[:nrow], start, nrow)
+            else:
+                tb.getcolslicenp(column, buffer[:nrow], [self.first, 0], [self.last, self.ncorr - 1], [],
+                                 start, nrow)
+
+    def _read_casatools(self, start, nrow):
+        tb = self._tb
+        for column, buffer in (('ANTENNA1', self.ant1), ('ANTENNA2', self.ant2), ('SCAN_NUMBER', self.scan)):
+            buffer[:nrow] = tb.getcol(column, start, nrow)
+        # casatools returns (ncorr, nchan, nrow)
+        for column, buffer in ((self.datacolumn, self.data), ('FLAG', self.flag)):
+            chunk = tb.getcolslice(column, [0, self.first], [self.ncorr - 1, self.last], [1, 1], start, nrow)
+            np.copyto(buffer[:nrow], chunk.transpose(2, 1, 0))
+
+    def read(self, start, nrow):
+        """
+        Rows start to start + nrow, the buffers grow if there are more than they hold.
+        """
+        if nrow > len(self.ant1):
+            self._allocate(nrow)
+        if self._casacore:
+            self._read_casacore(start, nrow)
+        else:
+            self._read_casatools(start, nrow)
+        return self.ant1[:nrow], self.ant2[:nrow], self.scan[:nrow], self.data[:nrow], self.flag[:nrow]
+
+    def write_flags(self, start, flag):
+        """
+        Write an (nrow, nchan, ncorr) flag array to the FLAG column from row start on.
+        """
+        nrow = len(flag)
+        if self._casacore:
+            if self.whole_band:
+                self._tb.putcol('FLAG', flag, start, nrow)
+            else:
+                self._tb.putcolslice('FLAG', flag, [self.first, 0], [self.last, self.ncorr - 1], [], start, nrow)
+        else:
+            self._tb.putcolslice('FLAG', flag.transpose(2, 1, 0), [0, self.first], [self.ncorr - 1, self.last],
+                                 [1, 1], start, nrow)
+
+    def scan_numbers(self):
+        tb = open_table(self.ms_name)
+        scans = np.unique(tb.getcol('SCAN_NUMBER'))
+        tb.close()
+        return scans
+
+    def chunks(self):
+        with self:
+            for start in range(0, self.nrow, self.chunk_rows):
+                yield self.read(start, min(self.chunk_rows, self.nrow - start))
+
+
+def pool_moments(count, mean, m2, index, size):
+    """
+    Combine the (count, mean, M2) moments of groups into size groups, index giving the group each
+    one goes to (Chan et al.).
+    """
+    total = np.zeros((size,) + count.shape[1:])
+    np.add.at(total, index, count)
+    with np.errstate(invalid='ignore', divide='ignore'):
+        pooled = np.zeros_like(total)
+        np.add.at(pooled, index, count * np.nan_to_num(mean))
+        pooled = np.where(total > 0, pooled / total, np.nan)
+        spread = np.zeros_like(total)
+        np.add.at(spread, index, np.nan_to_num(m2) + count * (np.nan_to_num(mean) - pooled[index]) ** 2)
+    spread[total == 0] = 0
+    return total, pooled, spread
+
+
+class AmplitudeSummary:
+    """
+    Amplitude statistics of an MS per group along each axis in AXES, per correlation: the count,
+    mean and M2 (sum of squared deviations) of the unflagged amplitudes and a quantile sketch, a
+    histogram over log-spaced amplitude bins. scan_antenna groups are scan-major (scan * nant + ant),
+    baseline groups ant1 * nant + ant2.
+
+    Filled chunk by chunk with SummaryAccumulator, or read back from a summary file with load().
+    """
+    AXES = ('antenna', 'baseline', 'channel', 'scan', 'scan_antenna')
+
+    def __init__(self, nant, scans, chan_freqs, correlations, sketch_range=SKETCH_RANGE, sketch_bins=SKETCH_BINS):
+        self.nant = int(nant)
+        self.scans = np.asarray(scans)
+        self.chan_freqs = np.asarray(chan_freqs, dtype=float)
+        self.correlations = list(correlations)
+        self.sketch_range = tuple(float(edge) for edge in sketch_range)
+        self.sketch_bins = int(sketch_bins)
+        self.meta = {}
+        ncorr = len(self.correlations)
+        self.count, self.mean_, self.m2, self.hist = {}, {}, {}, {}
+        for axis, size in self.sizes().items():
+            self.count[axis] = np.zeros((size, ncorr))
+            self.mean_[axis] = np.full((size, ncorr), np.nan)
+            self.m2[axis] = np.zeros((size, ncorr))
+            self.hist[axis] = np.zeros((size, ncorr, self.sketch_bins), dtype=np.uint32)
+
+    def sizes(self):
+        nscan = len(self.scans)
+        return {'antenna': self.nant, 'baseline': self.nant * self.nant, 'channel': len(self.chan_freqs),
+                'scan': nscan, 'scan_antenna': nscan * self.nant}
+
+    def bin_edges(self):
+        low, high = np.log10(self.sketch_range)
+        return np.logspace(low, high, self.sketch_bins + 1)
+
+    def mean(self, axis):
+        return self.mean_[axis].copy()
+
+    def std(self, axis):
+        with np.errstate(invalid='ignore', divide='ignore'):
+            return np.sqrt(self.m2[axis] / self.count[axis])
+
+    def quantile(self, axis, q):
+        """
+        Approximate q-quantile (0..1) of the amplitudes of every group of axis, interpolated
+        log-linearly inside the sketch bin it falls in. NaN for groups without data.
+        """
+        hist = self.hist[axis].astype(np.float64)
+        cumulative = np.cumsum(hist, axis=-1)
+        target = q * cumulative[..., -1:]
+        index = np.minimum((cumulative < target).sum(axis=-1, keepdims=True), self.sketch_bins - 1)
+        below = np.take_along_axis(cumulative, index, axis=-1) - np.take_along_axis(hist, index, axis=-1)
+        with np.errstate(invalid='ignore', divide='ignore'):
+            fraction = np.clip((target - below) / np.take_along_axis(hist, index, axis=-1), 0, 1)
+        low, high = np.log10(self.sketch_range)
+        value = 10 ** (low + (index + fraction) * (high - low) / self.sketch_bins)
+        return np.where(cumulative[..., -1:] > 0, value, np.nan)[..., 0]
+
+    def median(self, axis):
+        return self.quantile(axis, 0.5)
+
+    def mad(self, axis):
+        """
+        Approximate median absolute deviation from the median of every group of axis, from the sketch.
+        """
+        median = self.median(axis)[..., None]
+        edges = self.bin_edges()
+        deviation = np.abs(np.sqrt(edges[:-1] * edges[1:]) - median)
+        order = np.argsort(deviation, axis=-1)
+        cumulative = np.cumsum(np.take_along_axis(self.hist[axis].astype(np.float64), order, axis=-1), axis=-1)
+        half = (cumulative < 0.5 * cumulative[..., -1:]).sum(axis=-1, keepdims=True)
+        half = np.minimum(half, self.sketch_bins - 1)
+        mad = np.take_along_axis(np.take_along_axis(deviation, order, axis=-1), half, axis=-1)[..., 0]
+        return np.where(cumulative[..., -1] > 0, mad, np.nan)
+
+    def by_scan_antenna(self, values):
+        """
+        Reshape a scan_antenna array to (nscan, nant, ncorr).
+        """
+        return values.reshape(len(self.scans), self.nant, -1)
+
+    def save(self, summary_file):
+        arrays = {
+            'nant': self.nant, 'scans': self.scans, 'chan_freqs': self.chan_freqs,
+            'correlations': np.array(self.correlations), 'sketch_range': np.array(self.sketch_range),
+            'sketch_bins': self.sketch_bins, 'meta': json.dumps(self.meta, default=str),
+        }
+        for axis in self.AXES:
+            arrays.update({f'{axis}_count': self.count[axis], f'{axis}_mean': self.mean_[axis],
+                           f'{axis}_m2': self.m2[axis], f'{axis}_hist': self.hist[axis]})
+        # np.savez adds .npz to names that do not end in it, write the temporary file with the suffix
+        tmp_file = summary_file + '.tmp.npz'
+        np.savez_compressed(tmp_file, **arrays)
+        os.replace(tmp_file, summary_file)
+
+    @classmethod
+    def load(cls, summary_file):
+        with np.load(summary_file) as arrays:
+            summary = cls(int(arrays['nant']), arrays['scans'], arrays['chan_freqs'],
+                          [str(corr) for corr in arrays['correlations']], arrays['sketch_range'],
+                          int(arrays['sketch_bins']))
+            summary.meta = json.loads(str(arrays['meta']))
+            for axis in cls.AXES:
+                summary.count[axis] = arrays[f'{axis}_count']
+                summary.mean_[axis] = arrays[f'{axis}_mean']
+                summary.m2[axis] = arrays[f'{axis}_m2']
+                summary.hist[axis] = arrays[f'{axis}_hist']
+        return summary
+
+
+class SummaryAccumulator:
+    """
+    Fills an AmplitudeSummary one chunk of rows at a time. The moments of every chunk are merged into
+    the running ones (Chan et al.), the sketches are added up. The work buffers are allocated
+    once for chunk_rows rows, memory does not grow with the number of chunks.
+
+    The antenna axis is not accumulated, it is pooled from the baselines at the end (finish()).
+    """
+    def __init__(self, summary, chunk_rows=CHUNK_ROWS, autocorr=False):
+        self.summary = summary
+        self.autocorr = autocorr
+        self.nant = summary.nant
+        self.nchan, self.ncorr = len(summary.chan_freqs), len(summary.correlations)
+        self.nbins = summary.sketch_bins
+        low, high = np.log10(summary.sketch_range)
+        self._log_low, self._bins_per_dex = low, summary.sketch_bins / (high - low)
+        self._allocate(chunk_rows)
+
+    def _allocate(self, nrow):
+        shape = (nrow, self.nchan, self.ncorr)
+        self._amp = np.empty(shape, dtype=np.float32)
+        self._work = np.empty(shape, dtype=np.float32)
+        self._good = np.empty(shape, dtype=bool)
+        self._bin = np.empty(shape, dtype=np.intp)
+        self._index = np.empty(shape, dtype=np.intp)
+
+    def _merge(self, axis, count, total, total_sq):
+        # Moments of the chunk (from its sums, in double precision) merged into the running ones
+        summary = self.summary
+        with np.errstate(invalid='ignore', divide='ignore'):
+            mean = total / count
+            m2 = np.maximum(total_sq - count * mean ** 2, 0)
+            running = summary.count[axis]
+            merged = running + count
+            delta = np.where(count > 0, mean, 0) - np.where(running > 0, summary.mean_[axis], 0)
+            weight = np.where(merged > 0, count / merged, 0)
+            summary.mean_[axis] = np.where(running > 0, summary.mean_[axis] + delta * weight, mean)
+            summary.m2[axis] = summary.m2[axis] + np.where(count > 0, m2, 0) + delta ** 2 * running * weight
+        summary.count[axis] = merged
+
+    def _add_rows(self, axis, groups, size, row_values, row_sq, row_counts):
+        # groups is the group of every row, size (an extra group) for rows that do not count
+        corr_index = (groups[:, None] * self.ncorr + np.arange(self.ncorr)).ravel()
+        length = (size + 1) * self.ncorr
+        sums = [np.bincount(corr_index, weights.ravel(), length).reshape(-1, self.ncorr)[:size]
+                for weights in (row_counts, row_values, row_sq)]
+        self._merge(axis, *sums)
+
+        # Sketch: flagged values sit in an extra bin that is dropped
+        offset = (corr_index.reshape(-1, 1, self.ncorr) * (self.nbins + 1))
+        index = self._index[:len(groups)]
+        np.add(self._bin[:len(groups)], offset, out=index)
+        hist = np.bincount(index.ravel(), minlength=length * (self.nbins + 1))
+        hist = hist.reshape(size + 1, self.ncorr, self.nbins + 1)[:size, :, :self.nbins]
+        self.summary.hist[axis] += hist.astype(np.uint32)
+
+    def add(self, ant1, ant2, scan, data, flag):
+        nrow = len(ant1)
+        if nrow > len(self._amp):
+            self._allocate(nrow)
+        amp, work, good, bins = self._amp[:nrow], self._work[:nrow], self._good[:nrow], self._bin[:nrow]
+        np.abs(data, out=amp)
+        np.logical_not(flag, out=good)
+        good &= np.isfinite(amp)
+        if not self.autocorr:
+            good[ant1 == ant2] = False
+        np.multiply(amp, good, out=amp)
+
+        # Sketch bin of every value
+        with np.errstate(divide='ignore', invalid='ignore'):
+            np.log10(amp, out=work)
+        np.subtract(work, self._log_low, out=work)
+        np.multiply(work, self._bins_per_dex, out=work)
+        np.clip(work, 0, self.nbins - 1, out=work)
+        np.copyto(bins, work, casting='unsafe')
+        np.copyto(bins, self.nbins, where=~good)
+
+        row_values = amp.sum(axis=1, dtype=np.float64)  # (nrow, ncorr)
+        row_sq = np.einsum('ijk,ijk->ik', amp, amp, dtype=np.float64)
+        row_counts = good.sum(axis=1)
+
+        nant, nscan = self.nant, len(self.summary.scans)
+        scan_index = np.searchsorted(self.summary.scans, scan)
+        self._add_rows('baseline', ant1 * nant + ant2, nant * nant, row_values, row_sq, row_counts)
+        self._add_rows('scan', scan_index, nscan, row_values, row_sq, row_counts)
+        # An auto-correlation counts once for its antenna
+        size = nscan * nant
+        self._add_rows('scan_antenna', scan_index * nant + ant1, size, row_values, row_sq, row_counts)
+        self._add_rows('scan_antenna', np.where(ant1 != ant2, scan_index * nant + ant2, size), size,
+                       row_values, row_sq, row_counts)
+
+        counts = good.sum(axis=0)
+        self._merge('channel', counts, amp.sum(axis=0, dtype=np.float64),
+                    np.einsum('ijk,ijk->jk', amp, amp, dtype=np.float64))
+        chan_offset = (np.arange(self.nchan * self.ncorr).reshape(self.nchan, self.ncorr) * (self.nbins + 1))
+        index = self._index[:nrow]
+        np.add(bins, chan_offset, out=index)
+        hist = np.bincount(index.ravel(), minlength=self.nchan * self.ncorr * (self.nbins + 1))
+        self.summary.hist['channel'] += hist.reshape(self.nchan, self.ncorr, -1)[..., :self.nbins].astype(np.uint32)
+
+    def finish(self):
+        """
+        Pool the antenna axis from the baselines and return the summary.
+        """
+        summary, nant = self.summary, self.nant
+        ant1, ant2 = np.divmod(np.arange(nant * nant), nant)
+        cross = ant1 != ant2
+        index = np.concatenate([ant1, ant2[cross]])
+        rows = np.concatenate([np.arange(nant * nant), np.flatnonzero(cross)])
+        summary.count['antenna'], summary.mean_['antenna'], summary.m2['antenna'] = pool_moments(
+            summary.count['baseline'][rows], summary.mean_['baseline'][rows], summary.m2['baseline'][rows],
+            index, nant)
+        hist = np.zeros_like(summary.hist['antenna'], dtype=np.uint64)
+        np.add.at(hist, index, summary.hist['baseline'][rows])
+        summary.hist['antenna'] = hist.astype(np.uint32)
+        return summary
+
+
+def summary_file_path(ms_name, datacolumn='DATA'):
+    return f"{ms_name.rstrip('/')}.{datacolumn.lower()}.summary.npz"
+
+
+def stream_summary(ms_name, datacolumn='DATA', chans=None, chunk_rows=CHUNK_ROWS, autocorr=False):
+    """
+    Amplitude summary of a whole MS in one pass with constant memory.
+    """
+    reader = VisibilityReader(ms_name, datacolumn, chunk_rows, chans)
+    summary = AmplitudeSummary(reader.nant, reader.scan_numbers(), reader.chan_freqs, reader.correlations)
+    accumulator = SummaryAccumulator(summary, reader.chunk_rows, autocorr)
+    for ant1, ant2, scan, data, flag in reader.chunks():
+        accumulator.add(ant1, ant2, scan, data, flag)
+    summary = accumulator.finish()
+    summary.meta = {'ms': ms_name, 'datacolumn': datacolumn, 'chans': [reader.first, reader.last],
+                    'requested_chans': None if chans is None else [int(chans[0]), int(chans[1])],
+                    'autocorr': autocorr, 'fingerprint': fingerprint_path(ms_name)}
+    return summary
+
+
+def load_summary(ms_name, logger, datacolumn='DATA', chans=None, chunk_rows=CHUNK_ROWS, autocorr=False,
+                 summary_file=None):
+    """
+    The amplitude summary of an MS from its summary file, made (or made again) first when there is
+    none or the MS, channel range or settings have changed since. Quality checks and cutoffs should
+    read this instead of going through the MS.
+    """
+    summary_file = summary_file or summary_file_path(ms_name, datacolumn)
+    wanted = {'datacolumn': datacolumn, 'autocorr': autocorr,
+              'requested_chans': None if chans is None else [int(chans[0]), int(chans[1])],
+              'fingerprint': json.loads(json.dumps(fingerprint_path(ms_name)))}
+    if os.path.exists(summary_file):
+        summary = AmplitudeSummary.load(summary_file)
+        if all(summary.meta.get(key) == value for key, value in wanted.items()):
+            logger.info(f"Using the amplitude summary {summary_file}")
+            return summary
+        logger.info(f"Amplitude summary {summary_file} is out of date, making it again")
+
+    start = time.monotonic()
+    summary = stream_summary(ms_name, datacolumn, chans, chunk_rows, autocorr)
+    summary.save(summary_file)
+    logger.info(f"Amplitude summary of {ms_name} written to {summary_file} in {time.monotonic() - start:.1f} s")
+    return summary
+
+
+def make_synthetic_ms(ms_name, nant=30, nchan=256, correlations=('RR', 'LL'), nscan=4, times_per_scan=20,
+                      integration=8.0, start_freq=550e6, chan_width=195312.5, amplitude=1.0, noise=0.1,
+                      bad_antennas=(), rfi_channels=(), rfi_times=(), flagged_fraction=0.0, array_size=25e3, seed=0):
+    """
+    Write a minimal MS (main table, ANTENNA, SPECTRAL_WINDOW, POLARIZATION, DATA_DESCRIPTION) with
+    noisy visibilities of the given amplitude, auto-correlations included. The bad_antennas get a
+    tenth of the amplitude, rfi_channels and the time steps in rfi_times (counted from the start,
+    over all scans) ten times the amplitude, and flagged_fraction of the data is flagged at random.
+    The antennas are spread over array_size metres and the UVW follow the rotation of the earth.
+    Needs python-casacore.
+    """
+    from casacore.tables import default_ms, makearrcoldesc, maketabdesc, table
+
+    rng = np.random.default_rng(seed)
+    corr_codes = {name: code for code, name in CORR_NAMES.items()}
+    ncorr = len(correlations)
+    tabdesc = maketabdesc([
+        makearrcoldesc('DATA', 0j, shape=[nchan, ncorr], valuetype='complex', datamanagertype='TiledShapeStMan'),
+        makearrcoldesc('FLAG', False, shape=[nchan, ncorr], valuetype='boolean', datamanagertype='TiledShapeStMan'),
+    ])
+    default_ms(ms_name, tabdesc).close()
+
+    positions = rng.uniform(-array_size / 2, array_size / 2, (nant, 3)) * [1, 1, 0.01]
+    with table(ms_name + '/ANTENNA', readonly=False, ack=False) as tb:
+        tb.addrows(nant)
+        tb.putcol('NAME', [f'A{ant:02d}' for ant in range(nant)])
+        tb.putcol('POSITION', positions)
+        tb.putcol('DISH_DIAMETER', np.full(nant, 45.0))
+    with table(ms_name + '/SPECTRAL_WINDOW', readonly=False, ack=False) as tb:
+        tb.addrows(1)
+        tb.putcell('NUM_CHAN', 0, nchan)
+        tb.putcell('CHAN_FREQ', 0, start_freq + chan_width * np.arange(nchan))
+        tb.putcell('CHAN_WIDTH', 0, np.full(nchan, chan_width))
+        tb.putcell('EFFECTIVE_BW', 0, np.full(nchan, chan_width))
+        tb.putcell('RESOLUTION', 0, np.full(nchan, chan_width))
+        tb.putcell('REF_FREQUENCY', 0, start_freq)
+        tb.putcell('TOTAL_BANDWIDTH', 0, chan_width * nchan)
+    with table(ms_name + '/POLARIZATION', readonly=False, ack=False) as tb:
+        tb.addrows(1)
+        tb.putcell('NUM_CORR', 0, ncorr)
+        tb.putcell('CORR_TYPE', 0, np.array([corr_codes[name] for name in correlations], dtype=np.int32))
+        tb.putcell('CORR_PRODUCT', 0, np.zeros((ncorr, 2), dtype=np.int32))
+    with table(ms_name + '/DATA_DESCRIPTION', readonly=False, ack=False) as tb:
+        tb.addrows(1)
+        tb.putcell('SPECTRAL_WINDOW_ID', 0, 0)
+        tb.putcell('POLARIZATION_ID', 0, 0)
+
+    ant1, ant2 = np.triu_indices(nant)
+    nbl = len(ant1)
+    gain = np.ones(nant)
+    gain[list(bad_antennas)] = 0.1
+    spectrum = np.ones(nchan)
+    spectrum[list(rfi_channels)] = 10.0
+    rfi_times = set(rfi_times)
+
+    # One time step at a time, so the generator itself stays small whatever the size of the MS
+    with table(ms_name, readonly=False, ack=False) as tb:
+        row, step_number = 0, 0
+        for scan in range(1, nscan + 1):
+            for step in range(times_per_scan):
+                time = 4.5e9 + ((scan - 1) * (times_per_scan + 5) + step) * integration
+                hour_angle = 2 * np.pi * (time - 4.5e9) / 86164.0
+                rotation = np.array([[np.cos(hour_angle), -np.sin(hour_angle), 0],
+                                     [np.sin(hour_angle), np.cos(hour_angle), 0], [0, 0, 1]])
+                uvw = (positions[ant2] - positions[ant1]) @ rotation.T
+                tb.addrows(nbl)
+                tb.putcol('ANTENNA1', ant1.astype(np.int32), row, nbl)
+                tb.putcol('ANTENNA2', ant2.astype(np.int32), row, nbl)
+                tb.putcol('SCAN_NUMBER', np.full(nbl, scan, dtype=np.int32), row, nbl)
+                tb.putcol('TIME', np.full(nbl, time), row, nbl)
+                tb.putcol('INTERVAL', np.full(nbl, integration), row, nbl)
+                tb.putcol('EXPOSURE', np.full(nbl, integration), row, nbl)
+                tb.putcol('UVW', uvw, row, nbl)
+                scale = amplitude * gain[ant1] * gain[ant2] * (10.0 if step_number in rfi_times else 1.0)
+                shape = (nbl, nchan, ncorr)
+                data = (scale[:, None, None] * spectrum[None, :, None]
+                        + noise * (rng.standard_normal(shape) + 1j * rng.standard_normal(shape)))
+                tb.putcol('DATA', data.astype(np.complex64), row, nbl)
+                tb.putcol('FLAG', rng.random(shape) < flagged_fraction, row, nbl)
+                row += nbl
+                step_number += 1
+    return ms_name